@@ -0,0 +1,68 @@
+"""把长音频切成固定时长的片段，供并发转录
+
+WAV 用标准库 wave 在内存中按帧切分；其他格式在安装了 ffmpeg 时用其 segment 复用器切分并转成
+单声道MP3（同时缩小请求体积）。两者都不可用时整个文件作为一个片段。
+ffmpeg 通过项目根目录的 packages.txt 安装（开发容器创建时用 apt 安装其中列出的系统包）。
+"""
+import io
+import os
+import shutil
+import subprocess
+import tempfile
+import wave
+
+
+def _split_wav(data, segment_seconds):
+    with wave.open(io.BytesIO(data), "rb") as source:
+        params = source.getparams()
+        frames_per_segment = max(1, int(params.framerate * segment_seconds))
+        if params.nframes <= frames_per_segment:
+            return [(0.0, data, "wav")]
+        segments = []
+        for start_frame in range(0, params.nframes, frames_per_segment):
+            frames = source.readframes(frames_per_segment)
+            output = io.BytesIO()
+            with wave.open(output, "wb") as target:
+                target.setparams(params)
+                target.writeframes(frames)
+            segments.append((start_frame / params.framerate, output.getvalue(), "wav"))
+        return segments
+
+
+def _split_with_ffmpeg(data, file_extension, segment_seconds):
+    with tempfile.TemporaryDirectory() as work_dir:
+        input_path = os.path.join(work_dir, f"input.{file_extension}")
+        with open(input_path, "wb") as f:
+            f.write(data)
+        subprocess.run(
+            ["ffmpeg", "-nostdin", "-loglevel", "error", "-i", input_path, "-vn", "-ac", "1", "-ar", "16000",
+             "-b:a", "48k", "-f", "segment", "-segment_time", str(segment_seconds), "-reset_timestamps", "1",
+             os.path.join(work_dir, "segment%05d.mp3")],
+            check=True, capture_output=True)
+        segments = []
+        for index, file_name in enumerate(sorted(n for n in os.listdir(work_dir) if n.startswith("segment"))):
+            with open(os.path.join(work_dir, file_name), "rb") as f:
+                segments.append((float(index * segment_seconds), f.read(), "mp3"))
+        return segments
+
+
+def can_split(file_extension):
+    """该格式在当前环境中能否切分（WAV 总是可以，其他格式需要 ffmpeg）"""
+    return file_extension == "wav" or shutil.which("ffmpeg") is not None
+
+
+def split_audio(data, file_extension, segment_seconds=300):
+    """返回按时间顺序排列的 [(开始秒数, 音频字节, 格式)]；无法切分时只有一个片段（原始文件）"""
+    try:
+        if file_extension == "wav":
+            return _split_wav(data, segment_seconds)
+        if shutil.which("ffmpeg"):
+            return _split_with_ffmpeg(data, file_extension, segment_seconds) or [(0.0, data, file_extension)]
+    except (wave.Error, EOFError, OSError, subprocess.CalledProcessError) as e:
+        print(f"Could not split audio, sending it as a single segment: {e}")
+    return [(0.0, data, file_extension)]
+
+
+def format_timestamp(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
@@ -0,0 +1,206 @@
+"""离线性能基准脚本（使用 LocalEmbeddingClient，不调用真实API，也不需要 secrets.toml）
+
+用法:
+    python benchmark.py embeddings --chunks 300 --latency 0.05
+    python benchmark.py recall --vectors 200000 --nprobe 4,8,16,32
+    python benchmark.py storage --vectors 100000
+    python benchmark.py pdf --pages 1000
+"""
+import argparse
+import random
+import time
+
+import numpy as np
+
+from local_embeddings import LocalEmbeddingClient
+from rag import RAGManager, VectorIndex, IVFIndex
+
+
+def _random_chunks(count, words_per_chunk=200, seed=0):
+    rng = random.Random(seed)
+    vocabulary = [f"term{i}" for i in range(5000)]
+    return [" ".join(rng.choices(vocabulary, k=words_per_chunk)) for _ in range(count)]
+
+
+def bench_embeddings(args):
+    """对比逐块请求与批量请求的嵌入吞吐量"""
+    chunks = _random_chunks(args.chunks)
+
+    client = LocalEmbeddingClient(request_latency=args.latency)
+    manager = RAGManager(api_client=client)
+    manager.embedding_cache = None  # 测量原始请求吞吐，不经过缓存
+    start = time.perf_counter()
+    for chunk in chunks:
+        manager._get_embedding(chunk)
+    sequential_seconds = time.perf_counter() - start
+    sequential_requests = client.embeddings.request_count
+
+    client = LocalEmbeddingClient(request_latency=args.latency)
+    manager = RAGManager(api_client=client)
+    manager.embedding_cache = None  # 测量原始请求吞吐，不经过缓存
+    manager.max_workers = 1
+    start = time.perf_counter()
+    manager.embed_batch(chunks, batch_size=args.batch_size)
+    batched_seconds = time.perf_counter() - start
+    batched_requests = client.embeddings.request_count
+
+    client = LocalEmbeddingClient(request_latency=args.latency)
+    manager = RAGManager(api_client=client)
+    manager.embedding_cache = None  # 测量原始请求吞吐，不经过缓存
+    manager.max_workers = args.workers
+    start = time.perf_counter()
+    manager.embed_batch(chunks, batch_size=args.batch_size)
+    concurrent_seconds = time.perf_counter() - start
+
+    print(f"chunks: {len(chunks)}, simulated latency per request: {args.latency * 1000:.0f} ms")
+    print(f"one chunk per request: {sequential_requests} requests, {sequential_seconds:.2f} s "
+          f"({len(chunks) / sequential_seconds:.0f} chunks/s)")
+    print(f"batched:               {batched_requests} requests, {batched_seconds:.2f} s "
+          f"({len(chunks) / batched_seconds:.0f} chunks/s)")
+    print(f"batched, {args.workers} workers:    {batched_requests} requests, {concurrent_seconds:.2f} s "
+          f"({len(chunks) / concurrent_seconds:.0f} chunks/s)")
+
+
+def _clustered_vectors(count, dim, clusters, rng):
+    """生成带簇结构的合成向量，近似真实嵌入的分布"""
+    centers = rng.standard_normal((clusters, dim)).astype('float32')
+    noise = rng.standard_normal((count, dim)).astype('float32')
+    return centers[rng.integers(clusters, size=count)] + 0.6 * noise
+
+
+def _time_queries(index, queries, k, **search_kwargs):
+    """逐条检索（与应用中的用法一致），返回结果和每条查询的平均耗时"""
+    start = time.perf_counter()
+    indices = np.vstack([index.search(query, k, **search_kwargs)[1] for query in queries])
+    return indices, (time.perf_counter() - start) / len(queries)
+
+
+def bench_recall(args):
+    """对比IVF近似检索与精确检索的召回率和延迟"""
+    rng = np.random.default_rng(args.seed)
+    vectors = _clustered_vectors(args.vectors, args.dim, args.clusters, rng)
+    queries = _clustered_vectors(args.queries, args.dim, args.clusters, rng)
+
+    exact = VectorIndex(args.dim)
+    exact.add(vectors)
+    exact_indices, exact_latency = _time_queries(exact, queries, args.k)
+
+    start = time.perf_counter()
+    ivf = IVFIndex(args.dim, nlist=args.nlist, min_train_size=0)
+    ivf.add(vectors)
+    build_seconds = time.perf_counter() - start
+
+    print(f"vectors: {args.vectors}, dim: {args.dim}, queries: {args.queries}, k: {args.k}")
+    print(f"exact:  {exact_latency * 1000:.2f} ms/query")
+    print(f"ivf:    nlist={len(ivf.centroids)}, build {build_seconds:.1f} s")
+    for nprobe in (int(value) for value in args.nprobe.split(",")):
+        ivf_indices, ivf_latency = _time_queries(ivf, queries, args.k, nprobe=nprobe)
+        recall = np.mean([len(set(found) & set(expected)) / args.k
+                          for found, expected in zip(ivf_indices, exact_indices)])
+        print(f"  nprobe={nprobe:<4} recall@{args.k}={recall:.3f}  {ivf_latency * 1000:.2f} ms/query "
+              f"({exact_latency / ivf_latency:.1f}x faster)")
+
+
+def bench_storage(args):
+    """对比各向量存储格式的内存占用、召回率（含/不含精确重排）和延迟"""
+    rng = np.random.default_rng(args.seed)
+    vectors = _clustered_vectors(args.vectors, args.dim, args.clusters, rng)
+    queries = _clustered_vectors(args.queries, args.dim, args.clusters, rng)
+
+    exact = VectorIndex(args.dim)
+    exact.add(vectors)
+    exact_indices, _ = _time_queries(exact, queries, args.k)
+
+    print(f"vectors: {args.vectors}, dim: {args.dim}, queries: {args.queries}, k: {args.k}")
+    for storage in ("float32", "float16", "int8", "pq"):
+        index = VectorIndex(args.dim, storage=storage)
+        index.add(vectors)
+        for rerank in (False, True):
+            if rerank and not index.storage.lossy:
+                continue
+            index.rerank_source = (lambda ids: vectors[ids]) if rerank else None
+            found_indices, latency = _time_queries(index, queries, args.k)
+            recall = np.mean([len(set(found) & set(expected)) / args.k
+                              for found, expected in zip(found_indices, exact_indices)])
+            label = f"{storage}{' + rerank' if rerank else ''}"
+            print(f"{label:<16} {index.nbytes / 1024 / 1024:8.1f} MB  recall@{args.k}={recall:.3f}  "
+                  f"{latency * 1000:.2f} ms/query")
+
+
+def _synthetic_pdf(pages, lines_per_page=40, seed=0):
+    import fitz  # PyMuPDF
+
+    rng = random.Random(seed)
+    vocabulary = [f"term{i}" for i in range(5000)]
+    document = fitz.open()
+    for _ in range(pages):
+        page = document.new_page()
+        text = "\n".join(" ".join(rng.choices(vocabulary, k=12)) for _ in range(lines_per_page))
+        page.insert_text((36, 36), text, fontsize=8)
+    data = document.tobytes()
+    document.close()
+    return data
+
+
+def bench_pdf(args):
+    """对比单进程与多进程的PDF逐页提取耗时"""
+    from pdf_extractor import iter_pdf_pages
+
+    data = _synthetic_pdf(args.pages)
+    print(f"pages: {args.pages}, PDF size: {len(data) / 1024 / 1024:.1f} MB")
+    # 预热常驻进程池，不把进程启动时间计入提取耗时
+    list(iter_pdf_pages(data, workers=args.workers, pages_per_task=args.pages_per_task, min_parallel_pages=0))
+    baseline_pages = None
+    for workers in (1, args.workers):
+        start = time.perf_counter()
+        pages = list(iter_pdf_pages(data, workers=workers, pages_per_task=args.pages_per_task, min_parallel_pages=0))
+        seconds = time.perf_counter() - start
+        if baseline_pages is None:
+            baseline_pages, baseline_seconds = pages, seconds
+        assert pages == baseline_pages, "parallel extraction must return the same pages in the same order"
+        print(f"workers={workers:<3} {seconds:.2f}s  ({baseline_seconds / seconds:.1f}x)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="C-bot offline benchmarks")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    embeddings_parser = subparsers.add_parser("embeddings", help="embedding request throughput")
+    embeddings_parser.add_argument("--chunks", type=int, default=300)
+    embeddings_parser.add_argument("--latency", type=float, default=0.05, help="simulated seconds per request")
+    embeddings_parser.add_argument("--batch-size", type=int, default=None)
+    embeddings_parser.add_argument("--workers", type=int, default=4)
+    embeddings_parser.set_defaults(func=bench_embeddings)
+
+    recall_parser = subparsers.add_parser("recall", help="IVF recall and latency against exact search")
+    recall_parser.add_argument("--vectors", type=int, default=100000)
+    recall_parser.add_argument("--queries", type=int, default=200)
+    recall_parser.add_argument("--dim", type=int, default=768)
+    recall_parser.add_argument("--clusters", type=int, default=500, help="clusters in the synthetic data")
+    recall_parser.add_argument("--nlist", type=int, default=0, help="0 picks about 4*sqrt(N)")
+    recall_parser.add_argument("--nprobe", default="4,8,16,32")
+    recall_parser.add_argument("-k", type=int, default=10)
+    recall_parser.add_argument("--seed", type=int, default=0)
+    recall_parser.set_defaults(func=bench_recall)
+
+    storage_parser = subparsers.add_parser("storage", help="memory and recall of compressed vector storage")
+    storage_parser.add_argument("--vectors", type=int, default=100000)
+    storage_parser.add_argument("--queries", type=int, default=100)
+    storage_parser.add_argument("--dim", type=int, default=768)
+    storage_parser.add_argument("--clusters", type=int, default=500)
+    storage_parser.add_argument("-k", type=int, default=10)
+    storage_parser.add_argument("--seed", type=int, default=0)
+    storage_parser.set_defaults(func=bench_storage)
+
+    pdf_parser = subparsers.add_parser("pdf", help="serial vs process-pool PDF text extraction")
+    pdf_parser.add_argument("--pages", type=int, default=1000)
+    pdf_parser.add_argument("--workers", type=int, default=0, help="0 uses every CPU core")
+    pdf_parser.add_argument("--pages-per-task", type=int, default=16)
+    pdf_parser.set_defaults(func=bench_pdf)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """线程安全的内存LRU缓存，可选按TTL过期，可选按总字节数限制
+
+    按字节数限制时由调用者在 set() 中给出每个值的大小；总大小超出 max_bytes 时淘汰最久未使用的条目。
+    """
+
+    def __init__(self, max_entries=256, ttl=None, max_bytes=None):
+        self.max_entries = max_entries
+        self.ttl = ttl  # 秒；None 表示永不过期
+        self.max_bytes = max_bytes  # None 表示不限制
+        self.hits = 0
+        self.misses = 0
+        self.bytes = 0
+        self._entries = OrderedDict()  # key -> (value, expires_at, size)
+        self._lock = threading.Lock()
+
+    def _evict(self):
+        while len(self._entries) > self.max_entries or \
+                (self.max_bytes is not None and self.bytes > self.max_bytes and self._entries):
+            _, entry = self._entries.popitem(last=False)
+            self.bytes -= entry[2]
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] is not None and entry[1] < time.monotonic():
+                del self._entries[key]
+                self.bytes -= entry[2]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, size=0):
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            previous = self._entries.get(key)
+            if previous is not None:
+                self.bytes -= previous[2]
+            self._entries[key] = (value, expires_at, size)
+            self._entries.move_to_end(key)
+            self.bytes += size
+            self._evict()
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return default
+            self.bytes -= entry[2]
+            return entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
@@ -1,7 +1,8 @@
 import streamlit as st
 from openai import OpenAI
-from config import GEMINI_API_KEY, GEMINI_BASE_URL, GEMINI_MODEL, PERSONAS
+from config import GEMINI_API_KEY, GEMINI_BASE_URL, GEMINI_MODEL, PERSONAS, CHAT_PAGE_SIZE
 from database import save_chat
+from message_cache import get_message_cache
 from rag import get_enhanced_prompt
 
 # 初始化OpenAI客户端
@@ -27,27 +28,100 @@ def init_chat():
         "role": "system",
         "content": get_system_prompt()
     }]
+    reset_message_paging()
 
 
-def switch_conversation(conversation_id):
-    """切换到特定会话"""
-    from database import get_conversation_messages
+def reset_message_paging():
+    """当前会话没有尚未载入的更早消息（新建或清空会话之后）"""
+    st.session_state.messages_cursor = None
+    st.session_state.messages_has_more = False
+    st.session_state.messages_history_complete = True
+
+
+def _page_messages(rows):
+    """把 get_message_page 的结果转换为 (消息列表, 游标, 是否还有更早的消息)"""
+    messages = [{"role": role, "content": content} for _, _, role, content in rows]
+    cursor = (rows[0][1], rows[0][0]) if rows else None
+    return messages, cursor, len(rows) >= CHAT_PAGE_SIZE
 
-    st.session_state.current_conversation_id = conversation_id
 
-    # 加载会话消息
-    messages = get_conversation_messages(conversation_id)
+def _history_messages(messages):
+    """API历史只包含用户和助手的消息；与显示列表共用同一批消息字典，不复制内容"""
+    return [message for message in messages if message["role"] in ["user", "assistant"]]
 
-    # 重置消息显示
-    st.session_state.messages = []
-    for role, content in messages:
-        st.session_state.messages.append({"role": role, "content": content})
 
-    # 重置 API 历史记录
-    st.session_state.messages_history = [{"role": "system", "content": get_system_prompt()}]
-    for role, content in messages:
-        if role in ["user", "assistant"]:
-            st.session_state.messages_history.append({"role": role, "content": content})
+def switch_conversation(conversation_id):
+    """切换到特定会话：优先使用进程内的消息缓存，未缓存时从数据库载入最新的一页"""
+    from database import get_message_page
+
+    st.session_state.current_conversation_id = conversation_id
+
+    message_cache = get_message_cache()
+    cached = message_cache.snapshot(conversation_id)
+    if cached is not None:
+        messages, cursor, has_more = cached
+    else:
+        version = message_cache.version(conversation_id)
+        rows = get_message_page(conversation_id, CHAT_PAGE_SIZE)
+        messages, cursor, has_more = _page_messages(rows or [])
+        if rows is not None:
+            message_cache.put(conversation_id, list(messages), cursor, has_more, version)
+
+    # 显示列表和 API 历史记录由同一批消息构建；更早的消息在第一次提问前补进 API 历史（见 _load_full_history）
+    st.session_state.messages = messages
+    st.session_state.messages_history = [{"role": "system", "content": get_system_prompt()}] + \
+        _history_messages(messages)
+    st.session_state.messages_cursor = (conversation_id, cursor) if cursor else None
+    st.session_state.messages_has_more = has_more
+    st.session_state.messages_history_complete = not has_more
+
+
+def has_earlier_messages():
+    cursor = st.session_state.get("messages_cursor")
+    return bool(st.session_state.get("messages_has_more") and cursor
+                and cursor[0] == st.session_state.get("current_conversation_id"))
+
+
+def load_earlier_messages():
+    """载入当前会话中已显示消息之前的一页"""
+    from database import get_message_page
+
+    if not has_earlier_messages():
+        return
+    conversation_id, before = st.session_state.messages_cursor
+    rows = get_message_page(conversation_id, CHAT_PAGE_SIZE, before=before)
+    if rows is None:
+        return
+    messages, cursor, has_more = _page_messages(rows)
+    get_message_cache().prepend(conversation_id, messages, before, cursor, has_more)
+
+    # 插到显示列表的最前面；API历史还没有补齐时也插到其最前面（在系统提示之后）
+    st.session_state.messages[:0] = messages
+    if not st.session_state.get("messages_history_complete", True):
+        _prepend_history(messages)
+    if cursor:
+        st.session_state.messages_cursor = (conversation_id, cursor)
+    st.session_state.messages_has_more = has_more
+
+
+def _prepend_history(messages):
+    history_start = 1 if st.session_state.messages_history and \
+        st.session_state.messages_history[0]["role"] == "system" else 0
+    st.session_state.messages_history[history_start:history_start] = _history_messages(messages)
+
+
+def _load_full_history():
+    """显示列表只分页载入，但模型需要完整的上下文：提问前把尚未载入的更早消息全部补进 API 历史"""
+    from database import get_message_page
+
+    if st.session_state.get("messages_history_complete", True) or not has_earlier_messages():
+        return
+    conversation_id, before = st.session_state.messages_cursor
+    rows = get_message_page(conversation_id, limit=None, before=before)
+    if rows is None:
+        return  # 读取失败时本次只带已载入的消息，下次提问再试
+    _prepend_history(_page_messages(rows)[0])
+    st.session_state.messages_history_complete = True
 
 
 def get_answer():
@@ -59,7 +133,7 @@ def get_answer():
         with st.spinner("thinking..."):
             # RAG功能：如果启用了RAG且存在查询，进行检索
             enhanced_prompt = None
-            if 'rag_manager' in st.session_state and st.session_state.rag_manager.enabled and len(
+            if 'rag_manager' in st.session_state and st.session_state.get("rag_enabled") and len(
                     st.session_state.messages) > 0:
                 last_message = st.session_state.messages[-1]
                 if last_message["role"] == "user":
@@ -68,12 +142,14 @@ def get_answer():
                     enhanced_prompt = get_enhanced_prompt(user_query, search_results)
 
             # 准备消息
+            _load_full_history()
             api_messages = st.session_state.messages_history.copy()
             if enhanced_prompt:
                 # 将最后一个用户消息替换为增强提示
+                # （替换为新的字典：原消息字典与显示列表和消息缓存共用，不能修改）
                 for i in range(len(api_messages) - 1, -1, -1):
                     if api_messages[i]["role"] == "user":
-                        api_messages[i]["content"] = enhanced_prompt
+                        api_messages[i] = {"role": "user", "content": enhanced_prompt}
                         break
 
             # 调用API
@@ -93,6 +169,8 @@ def get_answer():
                     message_placeholder.markdown(ai_response_content + "▌")
 
             # 将AI响应添加到聊天记录
-            st.session_state.messages.append({"role": "assistant", "content": ai_response_content})
-            st.session_state.messages_history.append({"role": "assistant", "content": ai_response_content})
-            save_chat('assistant', ai_response_content, current_id)
\ No newline at end of file
+            # 显示列表、API 历史和消息缓存共用同一个字典
+            assistant_message = {"role": "assistant", "content": ai_response_content}
+            st.session_state.messages.append(assistant_message)
+            st.session_state.messages_history.append(assistant_message)
+            save_chat(assistant_message, current_id)
\ No newline at end of file
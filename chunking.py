@@ -0,0 +1,120 @@
+import re
+
+from config import RAG_CHUNK_TOKENS, RAG_CHUNK_OVERLAP_TOKENS
+
+# 中日韩字符大约一个字一个token，其他文本大约4个字符一个token
+_CJK_PATTERN = re.compile(r"[\u3000-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uff00-\uffef]")
+_PARAGRAPH_BREAK_PATTERN = re.compile(r"\n[ \t\r\f\v]*\n\s*")
+# 句子以西文句末标点加空白、或中文句末标点结束
+_SENTENCE_PATTERN = re.compile(r".+?(?:[.!?]+(?=\s)|[。！？]+|$)", re.S)
+
+
+def _token_cost(text):
+    """token数的小数估计，可以直接相加（拼接后文本的估计不超过各部分之和）"""
+    cjk_count = len(_CJK_PATTERN.findall(text))
+    return cjk_count + (len(text) - cjk_count) / 4
+
+
+def estimate_tokens(text):
+    """粗略估算文本的token数（中日韩字符按一个token，其余约4个字符一个token）"""
+    return max(1, int(_token_cost(text)))
+
+
+def _iter_paragraphs(text):
+    """按空行切分段落，逐个产出，不一次性生成整个列表"""
+    start = 0
+    for match in _PARAGRAPH_BREAK_PATTERN.finditer(text):
+        paragraph = text[start:match.start()].strip()
+        if paragraph:
+            yield paragraph
+        start = match.end()
+    paragraph = text[start:].strip()
+    if paragraph:
+        yield paragraph
+
+
+def _split_oversized(text, max_tokens):
+    """把超出预算的句子按词（没有空格时按字符）硬切开"""
+    words = text.split(" ")
+    if len(words) == 1:
+        # 字符数不小于估算的token数，按 max_tokens 个字符切分一定不会超预算
+        for start in range(0, len(text), max_tokens):
+            yield text[start:start + max_tokens]
+        return
+    current, current_tokens = [], 0
+    for word in words:
+        word_tokens = _token_cost(word + " ")
+        if word_tokens > max_tokens:
+            if current:
+                yield " ".join(current)
+                current, current_tokens = [], 0
+            yield from _split_oversized(word, max_tokens)
+            continue
+        if current and current_tokens + word_tokens > max_tokens:
+            yield " ".join(current)
+            current, current_tokens = [], 0
+        current.append(word)
+        current_tokens += word_tokens
+    if current:
+        yield " ".join(current)
+
+
+def _iter_units(text, max_tokens):
+    """产出 (分隔符, 文本) 单元：段落整体放得下时是整段，否则是句子或更小的片段"""
+    for paragraph in _iter_paragraphs(text):
+        separator = "\n\n"
+        if _token_cost(paragraph) <= max_tokens:
+            yield separator, paragraph
+            continue
+        for match in _SENTENCE_PATTERN.finditer(paragraph):
+            sentence = " ".join(match.group().split())
+            if not sentence:
+                continue
+            if _token_cost(sentence) <= max_tokens:
+                yield separator, sentence
+            else:
+                for piece in _split_oversized(sentence, max_tokens):
+                    yield separator, piece
+                    separator = " "
+            separator = " "
+
+
+def _join_units(units):
+    return "".join(separator + text for separator, text in units)[len(units[0][0]):]
+
+
+def iter_chunks(sections, max_tokens=RAG_CHUNK_TOKENS, overlap_tokens=RAG_CHUNK_OVERLAP_TOKENS):
+    """把 (文本, 元数据) 段序列切成不超过 max_tokens 的块，逐个产出 (块文本, 元数据)
+
+    sections 可以是生成器（例如逐页读取的PDF），内存占用只与单个块的大小有关。
+    元数据不同的相邻段（不同的页、幻灯片）之间一定断块，因此每个块的元数据都是准确的；
+    元数据相同的相邻段（例如Word文档的各个段落）会被合并。
+    相邻的块之间保留最多 overlap_tokens 的尾部段落或句子作为重叠。
+    """
+    units, unit_tokens, total_tokens = [], [], 0
+    section_metadata = None
+    for text, metadata in sections:
+        if metadata != section_metadata:
+            if units:
+                yield _join_units(units), section_metadata
+            units, unit_tokens, total_tokens = [], [], 0
+            section_metadata = metadata
+
+        for separator, unit in _iter_units(text, max_tokens):
+            tokens = _token_cost(separator + unit)
+            if units and total_tokens + tokens > max_tokens:
+                yield _join_units(units), section_metadata
+                # 从上一块的末尾保留若干完整单元作为重叠
+                keep, kept_tokens = 0, 0
+                while (keep < len(units) and kept_tokens + unit_tokens[-1 - keep] <= overlap_tokens
+                       and kept_tokens + unit_tokens[-1 - keep] + tokens <= max_tokens):
+                    kept_tokens += unit_tokens[-1 - keep]
+                    keep += 1
+                units = units[len(units) - keep:]
+                unit_tokens = unit_tokens[len(unit_tokens) - keep:]
+                total_tokens = kept_tokens
+            units.append((separator, unit))
+            unit_tokens.append(tokens)
+            total_tokens += tokens
+    if units:
+        yield _join_units(units), section_metadata
@@ -2,23 +2,154 @@ import os
 import streamlit as st
 
 
+def _secret(name, default=None):
+    """读取密钥：环境变量优先，其次是 Streamlit secrets；都没有时返回 default
 
+    离线运行（如 benchmark.py 或测试）不需要 secrets.toml，未配置的连接信息在真正连接时才会报错。
+    """
+    if name in os.environ:
+        return os.environ[name]
+    try:
+        return st.secrets[name]
+    except (KeyError, FileNotFoundError):
+        return default
 
-GEMINI_API_KEY = st.secrets["GEMINI_API_KEY"]
+
+GEMINI_API_KEY = _secret("GEMINI_API_KEY")
 GEMINI_BASE_URL = "https://generativelanguage.googleapis.com/v1beta/openai/"
 GEMINI_MODEL = "gemini-2.0-flash"
 GEMINI_PICTURE_MODEL = "gemini-2.0-flash"
 GEMINI_EMBEDDING_MODEL = "text-embedding-004"
 GEMINI_EMBEDDING_DIM = 768
 
+# RAG分块配置（text-embedding-004 单条输入上限为2048 token）
+RAG_CHUNK_TOKENS = 800  # 每个块的估算token上限
+RAG_CHUNK_OVERLAP_TOKENS = 100  # 相邻块之间重叠的估算token数
+RAG_INGEST_WINDOW = 512  # 入库时每次嵌入并写入索引的块数，使内存占用与文档大小无关
+
+# 入库去重：与知识库中已有块文本完全相同的块直接共用，不再嵌入；同一文档内SimHash指纹
+# 汉明距离不超过该值的块视为近似重复而跳过（不同文档之间的近似块照常入库，避免返回过时的文本）
+RAG_DEDUP_ENABLED = True
+RAG_DEDUP_MAX_DISTANCE = 3
+
+# PDF提取：页数达到阈值时把页码区间分给多个进程并行提取
+RAG_PDF_WORKERS = 0  # 进程数，0 表示使用全部CPU核
+RAG_PDF_PAGES_PER_TASK = 16  # 每个任务提取的页数
+RAG_PDF_PARALLEL_MIN_PAGES = 64  # 少于该页数时在当前进程中提取
+
+# xlsx工作表：直接分析时只给模型看每张表的结构、统计信息和抽样的行，避免把整张表放进提示
+XLSX_HEAD_ROWS = 10  # 每张表保留开头的行数
+XLSX_SAMPLE_ROWS = 30  # 从其余行中随机抽样的行数
+XLSX_MAX_COLUMNS = 50  # 每张表最多展示的列数
+XLSX_MAX_CELL_CHARS = 100  # 单元格文本的最大长度
+RAG_XLSX_INDEX_ROWS = True  # 入库时是否把全部数据行按行组写入知识库（否则只写入摘要）
+RAG_XLSX_ROWS_PER_SECTION = 100  # 入库时每次读取并交给分块器的行数
+
+# 图像分析：长边超过该像素数时先缩小并重新编码再发送给模型（0 表示发送原图）
+IMAGE_MAX_DIMENSION = 1536
+IMAGE_JPEG_QUALITY = 85
+IMAGE_ANALYSIS_CACHE_SIZE = 64  # 按图像内容哈希缓存的分析结果条数（进程内共享）
+
+# 音频转录：长录音切成固定时长的片段并发转录，再按时间顺序拼接
+AUDIO_SEGMENT_SECONDS = 300
+AUDIO_TRANSCRIBE_WORKERS = 4  # 同时进行的转录请求数
+# 非WAV格式需要 ffmpeg 才能切分；未安装时超过该大小（约为128kbps下一个片段的时长）的文件会提示只能整体转录
+AUDIO_UNSPLIT_WARNING_BYTES = 5 * 1024 * 1024
+
+# 每个会话缓存的已解析上传文件数（按内容哈希，直接分析和RAG入库共用）
+EXTRACTED_DOCUMENT_CACHE_SIZE = 8
+
+# 后台入库队列
+RAG_INGEST_WORKERS = 2  # 同时处理的上传文件数
+RAG_INGEST_SPOOL_DIR = ".cache/ingest_jobs"  # 未完成任务的文件暂存目录，进程重启后自动恢复
+RAG_INGEST_POLL_SECONDS = 1.0  # 任务进行中时页面刷新进度的间隔
+
+# 删除文档时块先标记为墓碑，墓碑超过全部块的这一比例时压缩索引
+RAG_COMPACT_DELETED_RATIO = 0.25
+
+# RAG嵌入批处理配置
+RAG_EMBEDDING_BATCH_SIZE = 100  # 每个嵌入请求最多包含的文本块数
+RAG_EMBEDDING_BATCH_TOKENS = 20000  # 每个嵌入请求的估算token预算
+RAG_EMBEDDING_WORKERS = 4  # 并发发送嵌入请求的线程数
+RAG_EMBEDDING_MAX_IN_FLIGHT = 8  # 整个进程同时进行中的嵌入请求上限
+RAG_EMBEDDING_MAX_RETRIES = 5  # 限流/临时错误的最大重试次数
+RAG_EMBEDDING_BACKOFF_SECONDS = 0.5  # 指数退避的初始等待时间
+RAG_EMBEDDING_BACKOFF_MAX_SECONDS = 20.0  # 单次退避等待的上限
+
+# 持久化嵌入缓存（设为空字符串可禁用）
+RAG_EMBEDDING_CACHE_PATH = ".cache/embedding_cache.sqlite3"
+RAG_EMBEDDING_CACHE_MAX_BYTES = 512 * 1024 * 1024  # 超出后按最近最少使用淘汰
+
+# 查询缓存
+RAG_QUERY_CACHE_SIZE = 1024  # 缓存的查询向量条数（进程内共享）
+RAG_QUERY_CACHE_TTL_SECONDS = 3600
+RAG_RESULT_CACHE_SIZE = 128  # 每个知识库缓存的检索结果条数
+RAG_RESULT_CACHE_TTL_SECONDS = 300  # 设为0可禁用检索结果缓存
+
+# 向量索引类型："flat" 为精确检索；"ivf" 为近似最近邻，适合数十万块以上的知识库
+RAG_INDEX_TYPE = "flat"
+RAG_IVF_NLIST = 0  # 簇数量，0 表示按数据量自动选择（约 4*sqrt(N)）
+RAG_IVF_NPROBE = 16  # 每次检索扫描的簇数，越大召回越高、延迟越高
+RAG_IVF_MIN_TRAIN_SIZE = 20000  # 向量数达到此值后才训练IVF，之前使用精确检索
+
+# 向量存储格式（每10万块768维向量的内存占用）：
+# "float32" 约300MB；"float16" 约150MB；"int8" 约77MB；"pq" 乘积量化，约19MB
+RAG_VECTOR_STORAGE = "float32"
+RAG_PQ_SUBQUANTIZERS = 192  # PQ分段数，必须整除嵌入维度；每个向量占这么多字节
+RAG_PQ_MIN_TRAIN_SIZE = 4096  # 攒够这么多向量后训练PQ码本，之前以float32暂存
+RAG_RERANK_FACTOR = 10  # 压缩存储时先取 k*该值 个候选，再用原始向量精确重排
+
+# 检索模式："vector" 纯向量；"lexical" 纯BM25关键词（不调用嵌入API）；"hybrid" 两者按倒数排名融合
+RAG_SEARCH_MODE = "hybrid"
+RAG_HYBRID_CANDIDATES = 20  # 混合检索时每一路取的候选数
+
+# 持久化知识库目录：重启后自动加载，进程内所有会话共用同一个知识库（设为空字符串可禁用）
+RAG_INDEX_DIR = ".cache/rag_index"
+# 添加和删除文档只写入新块的追加段和一行修改日志；追加段超过这么多个、或其中的块数超过
+# 上一次整体写入的块数的这一比例时（以及压缩时），才把整个索引重写为新的一代
+RAG_PERSIST_MAX_SEGMENTS = 64
+RAG_PERSIST_SEGMENT_RATIO = 0.5
+
+# 向量存储后端："memory" 为进程内索引；"pgvector" 把块和向量存入PostgreSQL（需要pgvector扩展）
+RAG_VECTOR_BACKEND = "memory"
+RAG_PGVECTOR_INDEX = "hnsw"  # "hnsw" 或 "ivfflat"
+RAG_PGVECTOR_EF_SEARCH = 64  # HNSW检索时的候选列表大小，越大召回越高
+RAG_PGVECTOR_PROBES = 10  # IVFFlat检索时扫描的列表数
+
 DB_CONFIG = {
-    "host": st.secrets["DB_HOST"],
-    "user": st.secrets["DB_USER"],
-    "password": st.secrets["DB_PASSWORD"],
-    "database": st.secrets["DB_NAME"],
-    "port": int(st.secrets["DB_PORT"])
+    "host": _secret("DB_HOST"),
+    "user": _secret("DB_USER"),
+    "password": _secret("DB_PASSWORD"),
+    "database": _secret("DB_NAME"),
+    "port": int(_secret("DB_PORT", 5432))
 }
 
+# 数据库连接池（进程内所有会话共享）
+DB_POOL_MIN_CONNECTIONS = 1
+DB_POOL_MAX_CONNECTIONS = 10
+DB_POOL_CHECKOUT_TIMEOUT = 10.0  # 池满时等待空闲连接的最长秒数
+DB_POOL_HEALTHCHECK_IDLE_SECONDS = 30.0  # 空闲超过该秒数的连接借出前先检查是否可用
+
+# 聊天记录写入：
+# "async" 消息先进入后台队列批量写入，对话不等待数据库提交（进程崩溃时可能丢失最近约一个刷新间隔的消息）；
+# "sync" 每条消息在请求中直接提交
+CHAT_WRITE_MODE = "async"
+CHAT_WRITE_FLUSH_INTERVAL = 0.5  # 后台批量写入的间隔秒数
+CHAT_WRITE_BATCH_SIZE = 200  # 每个事务最多写入的消息数
+CHAT_WRITE_FLUSH_TIMEOUT = 5.0  # 读取会话消息前等待队列写完的最长秒数
+CHAT_WRITE_SHUTDOWN_TIMEOUT = 10.0  # 进程退出时等待队列写完的最长秒数
+
+# 切换会话时先显示最新的这么多条消息，更早的消息按需分页载入（发给模型的历史仍然完整，在第一次提问前补齐）
+CHAT_PAGE_SIZE = 50
+
+# 会话消息缓存（进程内共享）：在最近的会话之间切换不查询数据库
+MESSAGE_CACHE_MAX_BYTES = 64 * 1024 * 1024  # 所有缓存会话的消息总大小上限，超出后按最近最少使用淘汰
+MESSAGE_CACHE_MAX_CONVERSATIONS = 256
+
+# 侧边栏会话列表：每页条数和缓存时间（新建、改名、删除会话或保存消息时立即失效）
+CONVERSATION_PAGE_SIZE = 20
+CONVERSATION_LIST_CACHE_TTL_SECONDS = 30
+
 # AI角色配置
 PERSONAS = {
     "Standard Assistant": {
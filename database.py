@@ -1,38 +1,157 @@
+import atexit
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
 import streamlit as st
 import psycopg2
 from psycopg2 import pool
-from config import DB_CONFIG
+from psycopg2.extras import execute_values
+from config import (DB_CONFIG, DB_POOL_MIN_CONNECTIONS, DB_POOL_MAX_CONNECTIONS, DB_POOL_CHECKOUT_TIMEOUT,
+                    DB_POOL_HEALTHCHECK_IDLE_SECONDS, CHAT_WRITE_MODE, CHAT_WRITE_FLUSH_INTERVAL,
+                    CHAT_WRITE_BATCH_SIZE, CHAT_WRITE_FLUSH_TIMEOUT, CHAT_WRITE_SHUTDOWN_TIMEOUT, CHAT_PAGE_SIZE,
+                    CONVERSATION_LIST_CACHE_TTL_SECONDS)
+from caching import LRUCache
+from message_cache import get_message_cache
 
 
-# 创建数据库连接池
-def init_db_pool():
-    from psycopg2 import pool
-    
-    st.session_state.db_connection_pool = pool.SimpleConnectionPool(
-        1, 10,  # min, max connections
-        host=st.secrets["DB_HOST"],
-        user=st.secrets["DB_USER"],
-        password=st.secrets["DB_PASSWORD"],
-        database=st.secrets["DB_NAME"],
-        port=int(st.secrets["DB_PORT"])
-    )
+class _RetainingConnectionPool(pool.ThreadedConnectionPool):
+    """归还的连接全部保留的 ThreadedConnectionPool
+
+    psycopg2 归还连接时，空闲连接数已达到 minconn 就关闭它，高峰期会反复建连。这里启动时只建立
+    minconn 个连接，之后把 minconn 设为 maxconn，归还的连接都留在池中，连接数稳定在实际并发的峰值。
+    psycopg2 2.x 只在构造函数（建立初始连接）和 _putconn（判断是否保留）中读取 minconn，
+    所以构造完成后修改它只影响保留策略；池的上限仍由 maxconn 控制。
+    """
+
+    def __init__(self, minconn, maxconn, *args, **kwargs):
+        super().__init__(minconn, maxconn, *args, **kwargs)
+        self.minconn = maxconn
 
 
-# 连接到PostgreSQL - 使用连接池
-def connect_db():
-    # 确保连接池已初始化
-    if 'db_connection_pool' not in st.session_state:
-        init_db_pool()
+class ConnectionPool:
+    """进程内所有会话和后台线程共享的线程安全连接池
 
-    # 如果连接池存在，从池中获取连接
-    if st.session_state.db_connection_pool:
+    连接用完后必须归还（推荐使用 connection() 上下文管理器）。池满时调用者最多等待
+    checkout_timeout 秒；空闲超过 healthcheck_idle_seconds 的连接在借出前先 SELECT 1 检查，
+    已断开的连接会被丢弃并重新建立。metrics() 返回借出数量、等待次数和借出耗时等指标。
+    """
+
+    def __init__(self, minconn, maxconn, checkout_timeout=DB_POOL_CHECKOUT_TIMEOUT,
+                 healthcheck_idle_seconds=DB_POOL_HEALTHCHECK_IDLE_SECONDS, **connect_kwargs):
+        self.maxconn = maxconn
+        self.checkout_timeout = checkout_timeout
+        self.healthcheck_idle_seconds = healthcheck_idle_seconds
+        self._pool = _RetainingConnectionPool(minconn, maxconn, **connect_kwargs)
+        # ThreadedConnectionPool 满了会直接抛异常，这里用信号量让调用者排队等待
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._returned_at = {}  # id(连接) -> 上次归还的时间
+        self._lock = threading.Lock()
+        self._in_use = 0
+        self._peak_in_use = 0
+        self._checkouts = 0
+        self._waits = 0
+        self._timeouts = 0
+        self._replaced = 0
+        self._checkout_seconds = 0.0
+        self._max_checkout_seconds = 0.0
+
+    def _healthy(self, db_conn):
+        if db_conn.closed:
+            return False
+        returned_at = self._returned_at.get(id(db_conn))
+        if returned_at is not None and time.monotonic() - returned_at < self.healthcheck_idle_seconds:
+            return True
         try:
-            return st.session_state.db_connection_pool.getconn()
-        except Exception as e:
-            print(f"Error getting connection from pool: {e}")
+            with db_conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            db_conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
 
-    # 原始连接方法作为后备
-    return psycopg2.connect(
+    def getconn(self):
+        """借出一个连接；池满时等待，超时抛出 pool.PoolError"""
+        started = time.perf_counter()
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._waits += 1
+            if not self._slots.acquire(timeout=self.checkout_timeout):
+                with self._lock:
+                    self._timeouts += 1
+                raise pool.PoolError(f"No database connection available within {self.checkout_timeout}s")
+        try:
+            db_conn = self._pool.getconn()
+            while not self._healthy(db_conn):
+                # 丢弃断开的连接，池会在下次借出时新建
+                self._returned_at.pop(id(db_conn), None)
+                self._pool.putconn(db_conn, close=True)
+                with self._lock:
+                    self._replaced += 1
+                db_conn = self._pool.getconn()
+        except Exception:
+            self._slots.release()
+            raise
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self._in_use += 1
+            self._peak_in_use = max(self._peak_in_use, self._in_use)
+            self._checkouts += 1
+            self._checkout_seconds += elapsed
+            self._max_checkout_seconds = max(self._max_checkout_seconds, elapsed)
+        return db_conn
+
+    def putconn(self, db_conn):
+        """归还连接（未提交的事务会被回滚）"""
+        try:
+            if db_conn.closed:
+                self._returned_at.pop(id(db_conn), None)
+                self._pool.putconn(db_conn, close=True)
+            else:
+                self._returned_at[id(db_conn)] = time.monotonic()
+                self._pool.putconn(db_conn)
+        finally:
+            with self._lock:
+                self._in_use -= 1
+            self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        db_conn = self.getconn()
+        try:
+            yield db_conn
+        except Exception:
+            if not db_conn.closed:
+                db_conn.rollback()
+            raise
+        finally:
+            self.putconn(db_conn)
+
+    def metrics(self):
+        with self._lock:
+            return {
+                "max_connections": self.maxconn,
+                "open_connections": len(self._pool._pool) + len(self._pool._used),
+                "in_use": self._in_use,
+                "peak_in_use": self._peak_in_use,
+                "checkouts": self._checkouts,
+                "waits": self._waits,
+                "timeouts": self._timeouts,
+                "replaced": self._replaced,
+                "avg_checkout_ms": self._checkout_seconds / self._checkouts * 1000 if self._checkouts else 0.0,
+                "max_checkout_ms": self._max_checkout_seconds * 1000,
+            }
+
+    def closeall(self):
+        self._pool.closeall()
+
+
+@st.cache_resource(show_spinner=False)
+def get_db_pool():
+    """进程内共享的连接池（所有会话和后台线程共用，Streamlit重跑脚本时不会重建）"""
+    return ConnectionPool(
+        DB_POOL_MIN_CONNECTIONS, DB_POOL_MAX_CONNECTIONS,
         host=DB_CONFIG["host"],
         port=DB_CONFIG["port"],
         dbname=DB_CONFIG["database"],
@@ -41,9 +160,162 @@ def connect_db():
     )
 
 
+# 创建数据库连接池（幂等：返回进程内共享的连接池），首次调用时建表并迁移
+def init_db_pool():
+    db_pool = get_db_pool()
+    ensure_schema()
+    return db_pool
+
+
+def db_connection():
+    """借出连接的上下文管理器，退出时归还（异常时先回滚）"""
+    return get_db_pool().connection()
+
+
+# 会话列表的短时缓存（进程内共享），避免每次重跑脚本都查询数据库
+_conversation_list_cache = LRUCache(max_entries=256, ttl=CONVERSATION_LIST_CACHE_TTL_SECONDS)
+
+
+def _insert_messages(cursor, rows):
+    """写入 (role, content, conversation_id, queued_at) 行，并把涉及的会话的 updated_at 合并为一条UPDATE
+
+    queued_at 为消息入队时的 time.monotonic()。created_at 取数据库当前时间减去消息在队列中等待的时长：
+    批量写入或重试时各条消息仍保留发送时的先后和时间，而不是都变成写入时刻；时间仍以数据库的时钟为准。
+    """
+    now = time.monotonic()
+    execute_values(
+        cursor,
+        "INSERT INTO chat_history (role, content, conversation_id, created_at) VALUES %s",
+        [(role, content, conversation_id, max(0.0, now - queued_at))
+         for role, content, conversation_id, queued_at in rows],
+        template="(%s, %s, %s, CURRENT_TIMESTAMP - %s * INTERVAL '1 second')")
+    conversation_ids = sorted({row[2] for row in rows})
+    cursor.execute("UPDATE conversations SET updated_at = CURRENT_TIMESTAMP WHERE id = ANY(%s)",
+                   (conversation_ids,))
+
+
+class ChatWriter:
+    """聊天消息的后台批量写入队列（write-behind）
+
+    save_chat 只把消息放进进程内队列；后台线程每 flush_interval 秒（或攒够 batch_size 条时）
+    在一个事务中批量插入，并按会话合并 updated_at 的更新。队列先进先出、只有一个写入线程，
+    同一会话的消息按提交顺序写入。数据库不可用时整批保留并退避重试；某条消息无法写入
+    （例如会话已被删除）时逐条重写并跳过该条。进程正常退出时会先把队列写完。
+    """
+
+    def __init__(self, flush_interval=CHAT_WRITE_FLUSH_INTERVAL, batch_size=CHAT_WRITE_BATCH_SIZE,
+                 shutdown_timeout=CHAT_WRITE_SHUTDOWN_TIMEOUT):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.shutdown_timeout = shutdown_timeout
+        self.written = 0
+        self.dropped = 0
+        self._pending = deque()
+        self._unflushed = 0  # 已入队但还没有写入（或放弃）的消息数
+        self._flush_requested = False
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="chat-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def enqueue(self, role, content, conversation_id):
+        with self._condition:
+            self._pending.append((role, content, conversation_id, time.monotonic()))
+            self._unflushed += 1
+            if len(self._pending) >= self.batch_size:
+                self._condition.notify_all()
+
+    def flush(self, timeout=CHAT_WRITE_FLUSH_TIMEOUT):
+        """等待队列中已有的消息全部写入，返回是否在超时前完成"""
+        with self._condition:
+            if not self._unflushed:
+                return True
+            self._flush_requested = True
+            self._condition.notify_all()
+            return self._condition.wait_for(lambda: not self._unflushed, timeout)
+
+    def close(self):
+        """写完队列中的消息后停止后台线程（进程退出时自动调用）"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join(self.shutdown_timeout)
+        if self._unflushed:
+            print(f"Chat writer stopped with {self._unflushed} unsaved messages")
+
+    def _run(self):
+        backoff = 0
+        while True:
+            with self._condition:
+                self._condition.wait_for(
+                    lambda: self._closed or self._flush_requested or len(self._pending) >= self.batch_size,
+                    0 if backoff else self.flush_interval)
+                if not self._pending:
+                    if self._closed:
+                        return
+                    continue
+                batch = [self._pending.popleft() for _ in range(min(len(self._pending), self.batch_size))]
+
+            if self._write(batch):
+                backoff = 0
+                with self._condition:
+                    self._unflushed -= len(batch)
+                    if not self._unflushed:
+                        self._flush_requested = False
+                    self._condition.notify_all()
+            else:
+                with self._condition:
+                    self._pending.extendleft(reversed(batch))
+                backoff = min(backoff * 2 or 0.5, 10.0)
+                time.sleep(backoff)
+
+    def _write(self, batch):
+        """写入一批消息；返回 False 表示数据库暂时不可用、整批需要重试"""
+        try:
+            with db_connection() as db_conn, db_conn.cursor() as cursor:
+                _insert_messages(cursor, batch)
+                db_conn.commit()
+            self.written += len(batch)
+            invalidate_conversation_list()
+            return True
+        except (psycopg2.OperationalError, psycopg2.InterfaceError, pool.PoolError) as e:
+            print(f"Failed to save chat batch, will retry: {e}")
+            return False
+        except psycopg2.Error as e:
+            print(f"Failed to save chat batch, saving messages one by one: {e}")
+        for row in batch:
+            try:
+                with db_connection() as db_conn, db_conn.cursor() as cursor:
+                    _insert_messages(cursor, [row])
+                    db_conn.commit()
+                self.written += 1
+                invalidate_conversation_list()
+            except Exception as e:
+                self.dropped += 1
+                print(f"Dropping chat message for conversation {row[2]}: {e}")
+        return True
+
+
+@st.cache_resource(show_spinner=False)
+def get_chat_writer():
+    """进程内共享的聊天消息写入队列"""
+    return ChatWriter()
+
+
+def flush_chats():
+    """写入模式为 async 时，等待队列中的消息写入数据库（读取或删除会话消息之前调用）"""
+    if CHAT_WRITE_MODE == "async":
+        get_chat_writer().flush()
+
+
 # 保存聊天功能，支持会话
-def save_chat(role, content, conversation_id=None):
-    """将聊天记录保存到特定会话"""
+def save_chat(message, conversation_id=None):
+    """将聊天记录保存到特定会话
+
+    message 是追加到 st.session_state.messages 的同一个字典（{"role": ..., "content": ...}），
+    原样放进消息缓存，不再另建副本。CHAT_WRITE_MODE 为 "async" 时只放进后台写入队列，立即返回；为 "sync" 时在当前请求中提交。
+    """
     # 如果未提供会话ID，则使用会话状态中的当前会话ID
     if conversation_id is None:
         if "current_conversation_id" not in st.session_state:
@@ -52,196 +324,210 @@ def save_chat(role, content, conversation_id=None):
             st.session_state.current_conversation_id = conversation_id
         else:
             conversation_id = st.session_state.current_conversation_id
-    cursor = None
-    db_conn = connect_db()
+    role, content = message["role"], message["content"]
+    if CHAT_WRITE_MODE == "async":
+        get_chat_writer().enqueue(role, content, conversation_id)
+        get_message_cache().append(conversation_id, message)
+        return True
     try:
-        cursor = db_conn.cursor()
-        sql = "INSERT INTO chat_history (role, content, conversation_id) VALUES (%s, %s, %s)"
-        cursor.execute(sql, (role, content, conversation_id))
-        db_conn.commit()
-
-        # 更新会话的 updated_at 时间戳
-        cursor.execute("UPDATE conversations SET updated_at = CURRENT_TIMESTAMP WHERE id = %s", (conversation_id,))
-        db_conn.commit()
+        with db_connection() as db_conn, db_conn.cursor() as cursor:
+            # 插入和 updated_at 的更新在同一个事务中提交
+            _insert_messages(cursor, [(role, content, conversation_id, time.monotonic())])
+            db_conn.commit()
+        invalidate_conversation_list()
+        get_message_cache().append(conversation_id, message)
         return True
     except Exception as e:
-        db_conn.rollback()
         print(f"Failed to save chat: {e}")
         return False
-    finally:
-        if cursor:
-            cursor.close()
-        if db_conn and not db_conn.closed:
-            st.session_state.db_connection_pool.putconn(db_conn)
 
 
 # 会话管理功能
 def create_conversation(title):
-    db_conn = connect_db()
-    cursor = db_conn.cursor()
     try:
-        # 使用RETURNING子句获取新插入的ID
-        cursor.execute(
-            "INSERT INTO conversations (title, created_at, updated_at) VALUES (%s, NOW(), NOW()) RETURNING id",
-            (title,)
-        )
-        new_id = cursor.fetchone()[0]  # 使用fetchone获取返回的ID
-        db_conn.commit()
+        with db_connection() as db_conn, db_conn.cursor() as cursor:
+            # 使用RETURNING子句获取新插入的ID
+            cursor.execute(
+                "INSERT INTO conversations (title, created_at, updated_at) VALUES (%s, NOW(), NOW()) RETURNING id",
+                (title,)
+            )
+            new_id = cursor.fetchone()[0]  # 使用fetchone获取返回的ID
+            db_conn.commit()
+        invalidate_conversation_list()
         return new_id
     except Exception as e:
         print(f"Error creating conversation: {e}")
         return None
-    finally:
-        cursor.close()
-        db_conn.close()
-
-def get_conversations():
-    """获取所有会话列表"""
-    db_conn = connect_db()
-    cursor = None
+
+def get_conversations(limit=None, after=None, search=None):
+    """按最近更新时间倒序获取会话列表，每行为 (id, title, created_at, updated_at)
+
+    limit 为每页条数（None 表示全部）；after 为上一页最后一行的 (updated_at, id)，用于键集分页；
+    search 按标题做不区分大小写的子串匹配。结果在进程内缓存 CONVERSATION_LIST_CACHE_TTL_SECONDS 秒，
+    新建、改名、删除会话和保存消息时清空缓存。
+    """
+    cache_key = (limit, after, search)
+    cached = _conversation_list_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    conditions, params = [], []
+    if after is not None:
+        conditions.append("(updated_at, id) < (%s, %s)")
+        params.extend(after)
+    if search:
+        # 转义 LIKE 的通配符，按字面匹配
+        pattern = search.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        conditions.append("title ILIKE %s")
+        params.append(f"%{pattern}%")
+    where_clause = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    limit_clause = "LIMIT %s" if limit is not None else ""
+    if limit is not None:
+        params.append(limit)
     try:
-        cursor = db_conn.cursor()
-        cursor.execute("""
-            SELECT id, title, created_at, updated_at 
-            FROM conversations 
-            ORDER BY updated_at DESC
-        """)
-        return cursor.fetchall()
+        with db_connection() as db_conn, db_conn.cursor() as cursor:
+            cursor.execute(f"""
+                SELECT id, title, created_at, updated_at 
+                FROM conversations 
+                {where_clause}
+                ORDER BY updated_at DESC, id DESC
+                {limit_clause}
+            """, params)
+            rows = cursor.fetchall()
     except Exception as e:
         print(f"Failed to get conversations: {e}")
         return []
-    finally:
-        if cursor:
-            cursor.close()
-        if db_conn and not db_conn.closed:
-            st.session_state.db_connection_pool.putconn(db_conn)
-
+    _conversation_list_cache.set(cache_key, rows)
+    return rows
 
 
+def invalidate_conversation_list():
+    _conversation_list_cache.clear()
 
 
 def update_conversation_title(conversation_id, new_title):
     """更新会话标题"""
-    db_conn = connect_db()
-    cursor = None
     try:
-        cursor = db_conn.cursor()
-        cursor.execute("""
-            UPDATE conversations 
-            SET title = %s 
-            WHERE id = %s
-        """, (new_title, conversation_id))
-        db_conn.commit()
+        with db_connection() as db_conn, db_conn.cursor() as cursor:
+            cursor.execute("""
+                UPDATE conversations 
+                SET title = %s 
+                WHERE id = %s
+            """, (new_title, conversation_id))
+            db_conn.commit()
+        invalidate_conversation_list()
         return True
     except Exception as e:
-        db_conn.rollback()
         print(f"Failed to update conversation title: {e}")
         return False
-    finally:
-        if cursor:
-            cursor.close()
-        if db_conn and not db_conn.closed:
-            st.session_state.db_connection_pool.putconn(db_conn)
 
 
 def delete_conversation(conversation_id):
     """删除一个会话及其所有消息"""
-    db_conn = connect_db()
-    cursor = None
+    flush_chats()  # 先写入队列中的消息，避免删除之后它们又被写回
     try:
-        cursor = db_conn.cursor()
-        # 由于外键约束，删除会话将删除其所有消息
-        cursor.execute("DELETE FROM conversations WHERE id = %s", (conversation_id,))
-        db_conn.commit()
+        with db_connection() as db_conn, db_conn.cursor() as cursor:
+            # 由于外键约束，删除会话将删除其所有消息
+            cursor.execute("DELETE FROM conversations WHERE id = %s", (conversation_id,))
+            db_conn.commit()
+        invalidate_conversation_list()
+        get_message_cache().invalidate(conversation_id)
         return True
     except Exception as e:
-        db_conn.rollback()
         print(f"Failed to delete conversation: {e}")
         return False
-    finally:
-        if cursor:
-            cursor.close()
-        if db_conn and not db_conn.closed:
-            st.session_state.db_connection_pool.putconn(db_conn)
 
 
-# 创建数据库表
+def clear_conversation_messages(conversation_id):
+    """删除一个会话中的所有消息，保留会话本身"""
+    flush_chats()  # 先写入队列中的消息，避免删除之后它们又被写回
+    with db_connection() as db_conn, db_conn.cursor() as cursor:
+        cursor.execute("DELETE FROM chat_history WHERE conversation_id = %s", (conversation_id,))
+        db_conn.commit()
+    get_message_cache().invalidate(conversation_id)
+
+
+# 创建数据库表（幂等，也负责旧表结构的迁移）
 def create_tables():
-    """创建必要的数据库表"""
-    db_conn = connect_db()
-    cursor = None
+    """创建必要的数据库表；失败时抛出异常（迁移失败时不能当作成功缓存）"""
     try:
-        cursor = db_conn.cursor()
-        
-        # 创建会话表
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS conversations (
-                id SERIAL PRIMARY KEY,
-                title VARCHAR(255) NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        
-        # 创建聊天历史表
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS chat_history (
-                id SERIAL PRIMARY KEY,
-                role VARCHAR(50) NOT NULL,
-                content TEXT NOT NULL,
-                conversation_id INTEGER REFERENCES conversations(id) ON DELETE CASCADE,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        
-        db_conn.commit()
+        with db_connection() as db_conn, db_conn.cursor() as cursor:
+            # 创建会话表
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS conversations (
+                    id SERIAL PRIMARY KEY,
+                    title VARCHAR(255) NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+
+            # 创建聊天历史表
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS chat_history (
+                    id SERIAL PRIMARY KEY,
+                    role VARCHAR(50) NOT NULL,
+                    content TEXT NOT NULL,
+                    conversation_id INTEGER REFERENCES conversations(id) ON DELETE CASCADE,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+
+            # 迁移：会话列表按 (updated_at, id) 分页的索引
+            cursor.execute("""
+                CREATE INDEX IF NOT EXISTS conversations_updated_idx
+                ON conversations (updated_at DESC, id DESC)
+            """)
+
+            # 迁移：旧表补上 created_at 列；按会话分页读取消息的复合索引
+            cursor.execute("ALTER TABLE chat_history ADD COLUMN IF NOT EXISTS created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP")
+            cursor.execute("""
+                CREATE INDEX IF NOT EXISTS chat_history_conversation_created_idx
+                ON chat_history (conversation_id, created_at, id)
+            """)
+
+            db_conn.commit()
         print("Database tables created successfully")
     except Exception as e:
-        db_conn.rollback()
         print(f"Failed to create tables: {e}")
-    finally:
-        if cursor:
-            cursor.close()
-        if db_conn and not db_conn.closed:
-            st.session_state.db_connection_pool.putconn(db_conn)
-            
-def get_conversation_messages(conversation_id=None):
-    """获取指定会话ID的所有消息"""
-    if conversation_id is None and "current_conversation_id" in st.session_state:
-        conversation_id = st.session_state.current_conversation_id
-    
+        raise
+
+
+def get_message_page(conversation_id, limit=CHAT_PAGE_SIZE, before=None):
+    """按键集分页读取会话消息：返回早于 before=(created_at, id) 的最新 limit 条，按时间先后排列
+
+    每行为 (id, created_at, role, content)；第一行的 (created_at, id) 可以作为读取更早一页的 before。
+    limit 为 None 时返回 before 之前的全部消息（补齐发给模型的完整历史）。
+    查询沿 (conversation_id, created_at, id) 索引倒序扫描 limit 行，耗时与会话长度无关。读取失败时返回 None。
+    """
     if not conversation_id:
-        return []  # 如果没有会话ID，返回空列表
-    
-    messages = []
-    
+        return []
+    flush_chats()  # 先写入队列中的消息，保证读到本会话刚发送的内容
     try:
-        db_conn = connect_db()
-        cursor = db_conn.cursor()
-        
-        # 使用参数化查询防止SQL注入
-        cursor.execute(
-            "SELECT role, content FROM chat_history WHERE conversation_id = %s ORDER BY timestamp ASC",
-            (conversation_id,)
-        )
-        
-        messages = cursor.fetchall()  # 获取所有结果
-        
+        with db_connection() as db_conn, db_conn.cursor() as cursor:
+            if before is None:
+                cursor.execute("""
+                    SELECT id, created_at, role, content FROM chat_history
+                    WHERE conversation_id = %s
+                    ORDER BY created_at DESC, id DESC
+                    LIMIT %s
+                """, (conversation_id, limit))
+            else:
+                cursor.execute("""
+                    SELECT id, created_at, role, content FROM chat_history
+                    WHERE conversation_id = %s AND (created_at, id) < (%s, %s)
+                    ORDER BY created_at DESC, id DESC
+                    LIMIT %s
+                """, (conversation_id, before[0], before[1], limit))
+            rows = cursor.fetchall()
     except Exception as e:
-        st.error(f"获取会话消息失败: {e}")
-        # 将错误记录到日志
-        print(f"Error in get_conversation_messages: {e}")
-    finally:
-        if 'cursor' in locals() and cursor:
-            cursor.close()
-        if 'db_conn' in locals() and db_conn:
-            try:
-                # 如果使用的是SimpleConnectionPool
-                if hasattr(st.session_state, 'db_connection_pool'):
-                    st.session_state.db_connection_pool.putconn(db_conn)
-                else:
-                    db_conn.close()
-            except Exception as e:
-                print(f"Error closing connection: {e}")
-    
-    return messages
\ No newline at end of file
+        print(f"Failed to load conversation messages: {e}")
+        return None
+    rows.reverse()
+    return rows
+
+
+@st.cache_resource(show_spinner=False)
+def ensure_schema():
+    """每个进程启动时执行一次建表和迁移（失败时抛出异常，cache_resource 不缓存异常，下次运行脚本时重试）"""
+    create_tables()
+    return True
@@ -0,0 +1,135 @@
+import hashlib
+import re
+from array import array
+
+import numpy as np
+
+from config import RAG_DEDUP_MAX_DISTANCE
+
+_SHINGLE_TOKEN_PATTERN = re.compile(r"[\u4e00-\u9fff]|[^\W\u4e00-\u9fff]+")
+_SHINGLE_SIZE = 3
+_BIT_POSITIONS = np.arange(64, dtype='uint64')
+
+
+def simhash(text):
+    """计算文本的64位SimHash指纹：相似的文本指纹之间的汉明距离小"""
+    tokens = _SHINGLE_TOKEN_PATTERN.findall(text.lower())
+    if len(tokens) > _SHINGLE_SIZE:
+        shingles = [" ".join(tokens[i:i + _SHINGLE_SIZE]) for i in range(len(tokens) - _SHINGLE_SIZE + 1)]
+    else:
+        shingles = tokens or [text]
+    hashes = np.fromiter(
+        (int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "little")
+         for shingle in shingles),
+        dtype='uint64', count=len(shingles))
+    # 每一位上取多数票
+    bit_counts = ((hashes[:, None] >> _BIT_POSITIONS) & np.uint64(1)).sum(axis=0)
+    bits = (bit_counts * 2 > len(shingles)).astype('uint64')
+    return int((bits << _BIT_POSITIONS).sum())
+
+
+class SimHashIndex:
+    """按汉明距离查找近似重复指纹的索引
+
+    指纹被切成 max_distance + 1 段：距离不超过 max_distance 的两个指纹至少有一段完全相同
+    （鸽巢原理），因此只需在各段的桶中查找候选再精确比较。已合并的部分按段排序存为数组
+    （可内存映射），新加入的指纹先放在字典中，积累到一定数量后再合并。
+    """
+
+    def __init__(self, max_distance=RAG_DEDUP_MAX_DISTANCE):
+        self.max_distance = max_distance
+        bands = max_distance + 1
+        widths = [64 // bands + (1 if band < 64 % bands else 0) for band in range(bands)]
+        self._shifts = [sum(widths[:band]) for band in range(bands)]
+        self._masks = [(1 << width) - 1 for width in widths]
+        self._fingerprints = array('Q')
+        # 已合并部分：每段一组按键排序的 (键, 指纹编号)
+        self._sorted_count = 0
+        self._band_keys = [np.empty(0, dtype='uint64') for _ in range(bands)]
+        self._band_ids = [np.empty(0, dtype='int64') for _ in range(bands)]
+        # 未合并部分：每段一个 键 -> [指纹编号] 字典
+        self._delta = [{} for _ in range(bands)]
+
+    @classmethod
+    def from_arrays(cls, fingerprints, band_keys, band_ids, max_distance=RAG_DEDUP_MAX_DISTANCE):
+        """从 to_arrays() 的结果恢复（数组可以是只读的内存映射）；分段方式不同时重新建立"""
+        index = cls(max_distance)
+        index._fingerprints = array('Q', np.asarray(fingerprints, dtype='uint64').tobytes())
+        if len(band_keys) == len(index._shifts):
+            index._sorted_count = len(fingerprints)
+            index._band_keys = list(band_keys)
+            index._band_ids = list(band_ids)
+        else:
+            index._merge()
+        return index
+
+    def __len__(self):
+        return len(self._fingerprints)
+
+    def _band_key(self, fingerprint, band):
+        return (fingerprint >> self._shifts[band]) & self._masks[band]
+
+    def add(self, fingerprints):
+        """追加指纹，编号依次递增（与知识库中块的位置一一对应）"""
+        for fingerprint in fingerprints:
+            position = len(self._fingerprints)
+            self._fingerprints.append(fingerprint)
+            for band, bucket in enumerate(self._delta):
+                bucket.setdefault(self._band_key(fingerprint, band), []).append(position)
+        if len(self._fingerprints) - self._sorted_count > max(4096, self._sorted_count // 4):
+            self._merge()
+
+    def _merge(self):
+        """把未合并的指纹并入排序数组（整体重排，均摊到每次追加是常数级开销）"""
+        fingerprints = np.frombuffer(self._fingerprints, dtype='uint64')
+        for band in range(len(self._shifts)):
+            keys = (fingerprints >> np.uint64(self._shifts[band])) & np.uint64(self._masks[band])
+            order = np.argsort(keys, kind="stable")
+            self._band_keys[band] = keys[order]
+            self._band_ids[band] = order.astype('int64')
+            self._delta[band] = {}
+        self._sorted_count = len(fingerprints)
+
+    def matches(self, fingerprint, max_distance=None):
+        """逐个产出汉明距离不超过 max_distance（默认为索引的 max_distance，不能更大）的已有指纹编号"""
+        max_distance = self.max_distance if max_distance is None else min(max_distance, self.max_distance)
+        seen = set()
+        for band in range(len(self._shifts)):
+            key = self._band_key(fingerprint, band)
+            keys = self._band_keys[band]
+            start = np.searchsorted(keys, key, side="left")
+            stop = np.searchsorted(keys, key, side="right")
+            candidates = self._band_ids[band][start:stop].tolist()
+            candidates.extend(self._delta[band].get(key, ()))
+            for candidate in candidates:
+                if candidate in seen:
+                    continue
+                seen.add(candidate)
+                if (self._fingerprints[candidate] ^ fingerprint).bit_count() <= max_distance:
+                    yield int(candidate)
+
+    def find(self, fingerprint, exclude=()):
+        """返回一个汉明距离不超过 max_distance 的已有指纹编号（跳过 exclude 中的编号），没有时返回-1"""
+        for candidate in self.matches(fingerprint):
+            if candidate not in exclude:
+                return candidate
+        return -1
+
+    def subset(self, ids):
+        """只保留给定编号的指纹并按顺序重新编号，用于知识库压缩"""
+        index = SimHashIndex(self.max_distance)
+        index._fingerprints = array('Q', np.frombuffer(self._fingerprints, dtype='uint64')[ids].tobytes())
+        index._merge()
+        return index
+
+    def to_arrays(self):
+        """导出为可持久化的数组：指纹、各段排序后的键和编号（均为副本，之后可以继续追加）"""
+        if self._sorted_count != len(self._fingerprints):
+            self._merge()
+        return {
+            "fingerprints": np.array(self._fingerprints, dtype='uint64'),
+            "band_keys": np.stack(self._band_keys) if self._band_keys[0].size else
+            np.empty((len(self._shifts), 0), dtype='uint64'),
+            "band_ids": np.stack(self._band_ids) if self._band_ids[0].size else
+            np.empty((len(self._shifts), 0), dtype='int64'),
+        }
@@ -0,0 +1,168 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+from config import (GEMINI_EMBEDDING_DIM, GEMINI_EMBEDDING_MODEL, RAG_EMBEDDING_CACHE_PATH,
+                    RAG_EMBEDDING_CACHE_MAX_BYTES)
+
+
+class EmbeddingCache:
+    """基于SQLite的持久化嵌入缓存，按 文本哈希+模型+维度 寻址，超出容量时按LRU淘汰"""
+
+    def __init__(self, path, model=GEMINI_EMBEDDING_MODEL, dim=GEMINI_EMBEDDING_DIM,
+                 max_bytes=RAG_EMBEDDING_CACHE_MAX_BYTES):
+        self.path = path
+        self.model = model
+        self.dim = dim
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # 同一个连接在多个线程间共享，由 self._lock 串行化访问
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS embeddings (
+                key TEXT PRIMARY KEY,
+                vector BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                last_access REAL NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_last_access ON embeddings (last_access)")
+        self._conn.commit()
+        self._total_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM embeddings").fetchone()[0]
+
+    def key(self, text):
+        """缓存键：模型、维度和文本内容共同决定"""
+        digest = hashlib.sha256()
+        digest.update(f"{self.model}\0{self.dim}\0".encode("utf-8"))
+        digest.update(text.encode("utf-8"))
+        return digest.hexdigest()
+
+    def get_many(self, texts, record_stats=True):
+        """批量查询缓存，返回与texts等长的列表，未命中的位置为None"""
+        keys = [self.key(text) for text in texts]
+        found = {}
+        with self._lock:
+            # 分段查询，避免超出SQLite的参数数量上限
+            for start in range(0, len(keys), 500):
+                key_slice = keys[start:start + 500]
+                placeholders = ",".join("?" * len(key_slice))
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", key_slice
+                ).fetchall()
+                found.update(rows)
+            if found:
+                now = time.time()
+                self._conn.executemany("UPDATE embeddings SET last_access = ? WHERE key = ?",
+                                       [(now, key) for key in found])
+                self._conn.commit()
+
+            results = []
+            for key in keys:
+                blob = found.get(key)
+                vector = None if blob is None else np.frombuffer(blob, dtype='float32')
+                if vector is not None and len(vector) != self.dim:
+                    vector = None
+                results.append(vector)
+            if record_stats:
+                hit_count = sum(1 for vector in results if vector is not None)
+                self.hits += hit_count
+                self.misses += len(results) - hit_count
+        return results
+
+    def get(self, text):
+        return self.get_many([text])[0]
+
+    def put_many(self, texts, vectors):
+        """写入嵌入向量（None会被跳过），必要时淘汰最久未使用的条目"""
+        now = time.time()
+        rows_by_key = {}  # 同一批次中的重复文本只写一次
+        for text, vector in zip(texts, vectors):
+            if vector is None:
+                continue
+            blob = np.asarray(vector, dtype='float32').tobytes()
+            key = self.key(text)
+            rows_by_key[key] = (key, blob, len(blob), now)
+        rows = list(rows_by_key.values())
+        if not rows:
+            return
+
+        with self._lock:
+            for key, _, size, _ in rows:
+                existing = self._conn.execute("SELECT size FROM embeddings WHERE key = ?", (key,)).fetchone()
+                self._total_bytes += size - (existing[0] if existing else 0)
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, size, last_access) VALUES (?, ?, ?, ?)", rows
+            )
+            self._evict_locked()
+            self._conn.commit()
+
+    def put(self, text, vector):
+        self.put_many([text], [vector])
+
+    def _evict_locked(self):
+        """淘汰到容量的90%以下，留出余量避免每次写入都触发淘汰"""
+        if self._total_bytes <= self.max_bytes:
+            return
+        target = int(self.max_bytes * 0.9)
+        while self._total_bytes > target:
+            rows = self._conn.execute(
+                "SELECT key, size FROM embeddings ORDER BY last_access ASC LIMIT 256"
+            ).fetchall()
+            if not rows:
+                self._total_bytes = 0
+                break
+            evicted = []
+            for key, size in rows:
+                if self._total_bytes <= target:
+                    break
+                evicted.append((key,))
+                self._total_bytes -= size
+            self._conn.executemany("DELETE FROM embeddings WHERE key = ?", evicted)
+
+    def stats(self):
+        """命中统计：每次命中都节省了一次块嵌入的API开销"""
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": entries,
+                "bytes": self._total_bytes,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM embeddings")
+            self._conn.commit()
+            self._total_bytes = 0
+
+
+_shared_cache = None
+_shared_cache_lock = threading.Lock()
+
+
+def get_embedding_cache():
+    """获取进程内共享的嵌入缓存；缓存不可用时返回None"""
+    global _shared_cache
+    with _shared_cache_lock:
+        if _shared_cache is None and RAG_EMBEDDING_CACHE_PATH:
+            try:
+                _shared_cache = EmbeddingCache(RAG_EMBEDDING_CACHE_PATH)
+            except Exception as e:
+                print(f"Embedding cache unavailable: {e}")
+                return None
+        return _shared_cache
@@ -0,0 +1,237 @@
+"""上传文件的统一解析层
+
+每种格式注册一个提取函数，把文件字节解析成结构化的文档模型（页、幻灯片、工作表、段落及其在
+全文中的偏移）。同一个 ExtractedDocument 可以同时供RAG入库和直接分析使用：各段只解析一次，
+边解析边缓存，后来的读取者直接读取已解析的部分。
+"""
+import hashlib
+import io
+import threading
+from bisect import bisect_right
+
+import docx
+from pptx import Presentation
+
+from config import (RAG_PDF_WORKERS, RAG_PDF_PAGES_PER_TASK, RAG_PDF_PARALLEL_MIN_PAGES, XLSX_HEAD_ROWS,
+                    XLSX_SAMPLE_ROWS, XLSX_MAX_COLUMNS, XLSX_MAX_CELL_CHARS, RAG_XLSX_INDEX_ROWS,
+                    RAG_XLSX_ROWS_PER_SECTION)
+from pdf_extractor import iter_pdf_pages
+from spreadsheet import iter_sheet_summaries, iter_row_groups
+
+# 各段在全文中以空行分隔
+SECTION_SEPARATOR = "\n\n"
+
+# 扩展名 -> 提取函数，提取函数接收文件字节，逐个产出 DocumentSection
+_EXTRACTORS = {}
+
+# 扩展名 -> 额外的RAG数据源：直接分析只需要摘要、知识库却需要全部数据的格式（如工作表），
+# 入库时在文档各段之后流式产出 (文本, 元数据)，不在文档中缓存
+_RAG_SOURCES = {}
+
+
+def register_extractor(*file_extensions):
+    """注册某些扩展名的提取函数（装饰器）"""
+    def decorator(func):
+        for file_extension in file_extensions:
+            _EXTRACTORS[file_extension] = func
+        return func
+    return decorator
+
+
+def register_rag_source(*file_extensions):
+    """注册某些扩展名在入库时追加的数据源（装饰器）"""
+    def decorator(func):
+        for file_extension in file_extensions:
+            _RAG_SOURCES[file_extension] = func
+        return func
+    return decorator
+
+
+def supported_extensions():
+    return sorted(_EXTRACTORS)
+
+
+class DocumentSection:
+    """文档中的一段：kind 为 "page"、"slide"、"sheet"、"paragraph" 或 "text"，number 从1开始"""
+
+    __slots__ = ("kind", "number", "text", "title", "offset")
+
+    def __init__(self, kind, number, text, title=None):
+        self.kind = kind
+        self.number = number
+        self.text = text
+        self.title = title  # 工作表名称等
+        self.offset = 0  # 在 ExtractedDocument.text 中的起始位置
+
+    @property
+    def metadata(self):
+        """RAG块的元数据：页、幻灯片和工作表会被记录；段落之间不需要断块，没有元数据"""
+        if self.kind in ("page", "slide"):
+            return {self.kind: self.number}
+        if self.kind == "sheet":
+            return {"sheet": self.title}
+        return {}
+
+    def render(self):
+        """直接分析时给模型看的文本，带页码、幻灯片或工作表标题"""
+        if self.kind == "page":
+            return f"Page {self.number}:\n{self.text}\n\n"
+        if self.kind == "slide":
+            return f"Slide {self.number}:\n{self.text}\n"
+        if self.kind == "sheet":
+            return f"Sheet: {self.title}\n{self.text}\n\n"
+        if self.kind == "paragraph":
+            return self.text + "\n"
+        return self.text
+
+
+class ExtractedDocument:
+    """解析后的文档：各段在第一次被读取时解析并缓存，之后的读取直接使用缓存
+
+    多个线程可以同时读取（例如后台入库和页面上的直接分析），底层解析器在锁内推进，
+    每一段只解析一次。解析全部完成后释放原始字节（有额外RAG数据源的格式除外）。
+    """
+
+    def __init__(self, name, file_extension, data, content_hash=None):
+        self.name = name
+        self.file_extension = file_extension
+        self.content_hash = content_hash or hashlib.sha256(data).hexdigest()
+        self.size = len(data)
+        self._source = _EXTRACTORS[file_extension](data)
+        # 有额外RAG数据源的格式需要保留原始字节，入库时再流式读取一遍
+        self._data = data if file_extension in _RAG_SOURCES else None
+        self._sections = []
+        self._offsets = []
+        self._length = 0
+        self._error = None
+        self._lock = threading.Lock()
+
+    @property
+    def complete(self):
+        return self._source is None and self._error is None
+
+    @property
+    def failed(self):
+        return self._error is not None
+
+    def _pull(self):
+        """解析下一段，没有更多时返回 None（调用者持有锁）"""
+        if self._error is not None:
+            raise self._error
+        if self._source is None:
+            return None
+        try:
+            section = next(self._source)
+        except StopIteration:
+            self._source = None
+            return None
+        except Exception as e:
+            self._source = None
+            self._error = e
+            raise
+        section.offset = self._length
+        self._length += len(section.text) + len(SECTION_SEPARATOR)
+        self._sections.append(section)
+        self._offsets.append(section.offset)
+        return section
+
+    def iter_sections(self):
+        """按顺序逐段产出 DocumentSection，未解析的部分边读边解析"""
+        position = 0
+        while True:
+            with self._lock:
+                if position < len(self._sections):
+                    section = self._sections[position]
+                else:
+                    section = self._pull()
+                    if section is None:
+                        return
+            position += 1
+            yield section
+
+    def sections(self):
+        """全部段的列表（需要时先解析完整个文档）"""
+        for _ in self.iter_sections():
+            pass
+        return list(self._sections)
+
+    def iter_rag_sections(self):
+        """按分块器需要的格式逐段产出 (文本, 元数据)"""
+        for section in self.iter_sections():
+            yield section.text, section.metadata
+        if self._data is not None:
+            yield from _RAG_SOURCES[self.file_extension](self._data)
+
+    @property
+    def text(self):
+        """全部段以空行连接成的纯文本，DocumentSection.offset 即在这段文本中的位置"""
+        return SECTION_SEPARATOR.join(section.text for section in self.sections())
+
+    def render(self):
+        """直接分析用的文本"""
+        return "".join(section.render() for section in self.sections())
+
+    def section_at(self, offset):
+        """返回纯文本中某个位置所在的段"""
+        sections = self.sections()
+        if not sections or offset < 0:
+            return None
+        return sections[bisect_right(self._offsets, offset) - 1]
+
+
+def is_supported(file_name):
+    return file_name.split('.')[-1].lower() in _EXTRACTORS
+
+
+def extract_document(file_name, data, content_hash=None):
+    """为上传的文件创建 ExtractedDocument（惰性解析）；不支持的格式抛出 ValueError"""
+    file_extension = file_name.split('.')[-1].lower()
+    if file_extension not in _EXTRACTORS:
+        raise ValueError(f"Unsupported file type: {file_extension}")
+    return ExtractedDocument(file_name, file_extension, data, content_hash)
+
+
+@register_extractor("pdf")
+def _extract_pdf(data):
+    # 长PDF在进程池中并行提取，结果仍按页码顺序产出
+    for page_num, page_text in iter_pdf_pages(data, workers=RAG_PDF_WORKERS, pages_per_task=RAG_PDF_PAGES_PER_TASK,
+                                              min_parallel_pages=RAG_PDF_PARALLEL_MIN_PAGES):
+        yield DocumentSection("page", page_num, page_text)
+
+
+@register_extractor("docx")
+def _extract_docx(data):
+    word_document = docx.Document(io.BytesIO(data))
+    for para_num, para in enumerate(word_document.paragraphs, start=1):
+        yield DocumentSection("paragraph", para_num, para.text)
+
+
+@register_extractor("pptx")
+def _extract_pptx(data):
+    presentation_doc = Presentation(io.BytesIO(data))
+    for slide_num, slide in enumerate(presentation_doc.slides, start=1):
+        shape_texts = [shape.text for shape in slide.shapes if hasattr(shape, "text")]
+        yield DocumentSection("slide", slide_num, "\n\n".join(shape_texts))
+
+
+@register_extractor("xlsx")
+def _extract_xlsx(data):
+    # 只读模式逐行读取，每张表只保留结构、统计信息和抽样的行，内存占用与行数无关
+    for sheet_num, sheet_name, summary in iter_sheet_summaries(
+            data, sample_rows=XLSX_SAMPLE_ROWS, head_rows=XLSX_HEAD_ROWS, max_columns=XLSX_MAX_COLUMNS,
+            max_cell_chars=XLSX_MAX_CELL_CHARS):
+        yield DocumentSection("sheet", sheet_num, summary, title=sheet_name)
+
+
+if RAG_XLSX_INDEX_ROWS:
+    @register_rag_source("xlsx")
+    def _iter_xlsx_rows(data):
+        for _, sheet_name, _, _, text in iter_row_groups(
+                data, rows_per_group=RAG_XLSX_ROWS_PER_SECTION, max_columns=XLSX_MAX_COLUMNS,
+                max_cell_chars=XLSX_MAX_CELL_CHARS):
+            yield text, {"sheet": sheet_name}
+
+
+@register_extractor("txt")
+def _extract_txt(data):
+    yield DocumentSection("text", 1, data.decode("utf-8"))
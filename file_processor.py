@@ -1,15 +1,16 @@
 import streamlit as st
+import hashlib
 import io
-import docx
-import fitz  # PyMuPDF
-from pptx import Presentation
-import pandas as pd
-import tempfile
-import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from PIL import Image
 import base64
 from openai import OpenAI
-from config import GEMINI_API_KEY, GEMINI_BASE_URL, GEMINI_PICTURE_MODEL
+from config import (GEMINI_API_KEY, GEMINI_BASE_URL, GEMINI_PICTURE_MODEL, EXTRACTED_DOCUMENT_CACHE_SIZE,
+                    IMAGE_MAX_DIMENSION, IMAGE_JPEG_QUALITY, IMAGE_ANALYSIS_CACHE_SIZE, AUDIO_SEGMENT_SECONDS,
+                    AUDIO_TRANSCRIBE_WORKERS, AUDIO_UNSPLIT_WARNING_BYTES)
+from audio_segments import can_split, split_audio, format_timestamp
+from caching import LRUCache
+from extractors import extract_document, is_supported
 
 # 创建Gemini客户端
 gemini_client = OpenAI(
@@ -17,52 +18,89 @@ gemini_client = OpenAI(
     base_url=GEMINI_BASE_URL
 )
 
+# 上传文件扩展名 -> 图像MIME子类型
+_IMAGE_MIME_SUBTYPES = {"jpg": "jpeg", "jpeg": "jpeg", "png": "png"}
+
+_SEGMENT_TRANSCRIBE_PROMPT = ("Please transcribe this audio segment verbatim. It is part of a longer recording. "
+                              "If there are multiple speakers, try to distinguish them. Output only the transcript.")
+
+
+def _prepare_image(data, file_extension):
+    """返回发送给模型的图像字节（memoryview）和MIME子类型
+
+    长边超过 IMAGE_MAX_DIMENSION 时在内存中缩小并重新编码（有透明通道的保存为PNG，其余为JPEG），
+    否则直接使用上传的原始字节，不做复制。
+    """
+    mime_subtype = _IMAGE_MIME_SUBTYPES.get(file_extension, file_extension)
+    if not IMAGE_MAX_DIMENSION:
+        return memoryview(data), mime_subtype
+    with Image.open(io.BytesIO(data)) as image:
+        if max(image.size) <= IMAGE_MAX_DIMENSION:
+            return memoryview(data), mime_subtype
+        image.thumbnail((IMAGE_MAX_DIMENSION, IMAGE_MAX_DIMENSION))
+        output = io.BytesIO()
+        if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+            image.save(output, format="PNG", optimize=True)
+            mime_subtype = "png"
+        else:
+            image.convert("RGB").save(output, format="JPEG", quality=IMAGE_JPEG_QUALITY)
+            mime_subtype = "jpeg"
+    return output.getbuffer(), mime_subtype
+
+
+@st.cache_resource(show_spinner=False)
+def _get_image_analysis_cache():
+    """进程内共享的图像分析结果缓存，键为图像内容哈希，重复上传同一张图片不再调用模型"""
+    return LRUCache(max_entries=IMAGE_ANALYSIS_CACHE_SIZE)
+
 
 def process_image_file(file_obj, file_extension):
     """使用Gemini API处理图像文件"""
-    temp_image_path = None
     extracted_text = ""
 
     try:
-        # 保存上传的文件到临时文件
-        with tempfile.NamedTemporaryFile(delete=False, suffix=f".{file_extension}") as temp_img_file:
-            temp_img_file.write(file_obj.read())
-            temp_image_path = temp_img_file.name
+        # 直接使用上传内容的字节，不写临时文件
+        image_bytes = file_obj.getvalue()
 
         # 显示上传的图像
-        image_obj = Image.open(temp_image_path)
-        st.image(image_obj, caption="Uploaded Image", width=600)
-
-        # 将图像编码为base64
-        with open(temp_image_path, "rb") as image_file:
-            base64_image = base64.b64encode(image_file.read()).decode('utf-8')
-
-        # 构建多模态消息请求
-        response = gemini_client.chat.completions.create(
-            model=GEMINI_PICTURE_MODEL,
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": "Please analyze this image in detail. Describe what you see, including objects, people, settings, colors, and any notable details. Also, what does this image show or represent?"
-                        },
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/{file_extension};base64,{base64_image}"
+        st.image(image_bytes, caption="Uploaded Image", width=600)
+
+        cache = _get_image_analysis_cache()
+        cache_key = (hashlib.sha256(image_bytes).hexdigest(), GEMINI_PICTURE_MODEL, IMAGE_MAX_DIMENSION)
+        image_analysis = cache.get(cache_key)
+        if image_analysis is None:
+            # 将图像（必要时先缩小）编码为base64
+            image_view, mime_subtype = _prepare_image(image_bytes, file_extension)
+            base64_image = base64.b64encode(image_view).decode('utf-8')
+
+            # 构建多模态消息请求
+            response = gemini_client.chat.completions.create(
+                model=GEMINI_PICTURE_MODEL,
+                messages=[
+                    {
+                        "role": "user",
+                        "content": [
+                            {
+                                "type": "text",
+                                "text": "Please analyze this image in detail. Describe what you see, including objects, people, settings, colors, and any notable details. Also, what does this image show or represent?"
+                            },
+                            {
+                                "type": "image_url",
+                                "image_url": {
+                                    "url": f"data:image/{mime_subtype};base64,{base64_image}"
+                                }
                             }
-                        }
-                    ]
-                }
-            ]
-        )
+                        ]
+                    }
+                ]
+            )
 
-        # 获取Gemini的图像分析结果
-        if response.choices and response.choices[0].message:
-            image_analysis = response.choices[0].message.content
+            # 获取Gemini的图像分析结果
+            if response.choices and response.choices[0].message:
+                image_analysis = response.choices[0].message.content
+                cache.set(cache_key, image_analysis)
 
+        if image_analysis:
             # 构建要发送给LLM的文本
             extracted_text = f"I've analyzed the uploaded image and here's what I found:\n\n{image_analysis}\n\nPlease provide more insights or answer any specific questions about this image."
         else:
@@ -71,160 +109,141 @@ def process_image_file(file_obj, file_extension):
     except Exception as e:
         st.error(f"Error processing image: {e}")
         extracted_text = f"There was an error processing the image: {str(e)}. Please try again or describe what you see in the image."
-    finally:
-        # 清理临时文件
-        if temp_image_path and os.path.exists(temp_image_path):
-            os.remove(temp_image_path)
 
     return extracted_text
 
 
-def process_document_for_rag(file_obj):
-    """处理上传的文档，提取文本用于RAG"""
-    extracted_content = ""
-    metadata = {"name": file_obj.name}
-    file_extension = file_obj.name.split('.')[-1].lower()
-    added_to_rag = False
-
-    if file_extension == "pdf":
-        current_doc_text = ""
-        with io.BytesIO(file_obj.getvalue()) as pdf_stream:
-            pdf_document = fitz.open(stream=pdf_stream, filetype="pdf")
-            for page_num in range(pdf_document.page_count):
-                page = pdf_document.load_page(page_num)
-                current_doc_text += page.get_text() + "\n\n"
-        extracted_content = current_doc_text
-
-    elif file_extension == "docx":
-        current_doc_text = ""
-        word_document = docx.Document(file_obj)
-        for para in word_document.paragraphs:
-            current_doc_text += para.text + '\n'
-        extracted_content = current_doc_text
-
-    elif file_extension == "pptx":
-        current_doc_text = ""
-        presentation_doc = Presentation(file_obj)
-        for slide_num, slide in enumerate(presentation_doc.slides, start=1):
-            slide_text_content = ""
-            for shape in slide.shapes:
-                if hasattr(shape, "text"):
-                    slide_text_content += shape.text + "\n"
-            current_doc_text += slide_text_content + "\n----SLIDE BREAK----\n"
-        extracted_content = current_doc_text
-
-    elif file_extension == "txt":
-        extracted_content = file_obj.getvalue().decode("utf-8")
-
-    if extracted_content:
-        st.session_state.rag_manager.add_document(extracted_content, metadata)
-        added_to_rag = True
-
-    if added_to_rag:
-        return f"Processed {file_obj.name} and added to the knowledge base."
-    else:
-        return f"Could not extract content from {file_obj.name}, or the file is empty. Not added to the knowledge base."
-
-
-def process_general_file(file_obj):
-    """处理一般文件上传，返回提取的文本内容"""
+def load_document(file_name, data):
+    """解析上传的文件（不支持的格式返回 None）；同一会话中相同内容的文件只解析一次
+
+    返回的 ExtractedDocument 同时供直接分析和RAG入库使用，按内容哈希缓存在会话状态中。
+    """
+    if not is_supported(file_name):
+        return None
+    if "extracted_documents" not in st.session_state:
+        st.session_state.extracted_documents = LRUCache(max_entries=EXTRACTED_DOCUMENT_CACHE_SIZE)
+    cache = st.session_state.extracted_documents
+    key = (hashlib.sha256(data).hexdigest(), file_name.split('.')[-1].lower())
+    document = cache.get(key)
+    if document is None or document.failed:
+        document = extract_document(file_name, data, content_hash=key[0])
+        cache.set(key, document)
+    return document
+
+
+def process_general_file(file_obj, progress=None):
+    """处理一般文件上传，返回提取的文本内容；progress 用于报告音频转录进度"""
     if not file_obj:
         return None
 
     file_extension = file_obj.name.split('.')[-1].lower()
     extracted_text = ""
 
-    if file_extension == "docx":
-        # 处理 Word 文件
-        word_doc = docx.Document(file_obj)
-        for para in word_doc.paragraphs:
-            extracted_text += para.text + '\n'
-
-    elif file_extension == "pdf":
-        # 处理 PDF 文件
-        with io.BytesIO(file_obj.getvalue()) as pdf_stream:
-            pdf_doc = fitz.open(stream=pdf_stream, filetype="pdf")
-            for page_num in range(pdf_doc.page_count):
-                page_content = pdf_doc.load_page(page_num)
-                extracted_text += f"Page {page_num + 1}:\n"
-                extracted_text += page_content.get_text() + '\n\n'
-
-    elif file_extension == "xlsx":
-        # 处理 Excel 文件
-        excel_dataframes = pd.read_excel(file_obj, sheet_name=None)
-        for sheet_name, df_sheet in excel_dataframes.items():
-            extracted_text += f"Sheet: {sheet_name}\n"
-            extracted_text += df_sheet.to_string() + '\n\n'
-
-    elif file_extension == "txt":
-        # 处理文本文件
-        extracted_text = file_obj.getvalue().decode("utf-8")
-
-    elif file_extension == "pptx":
-        # 处理 PPTX 文件
-        ppt_doc = Presentation(file_obj)
-        for slide_num, slide_item in enumerate(ppt_doc.slides, start=1):
-            extracted_text += f"Slide {slide_num}:\n"
-            for shape_item in slide_item.shapes:
-                if hasattr(shape_item, "text"):
-                    extracted_text += shape_item.text + "\n"
-            extracted_text += "\n"
-
+    document = load_document(file_obj.name, file_obj.getvalue())
+    if document is not None:
+        # docx/pdf/xlsx/txt/pptx：使用统一解析层（与RAG入库共享解析结果）
+        extracted_text = document.render()
 
     elif file_extension in ["jpg", "jpeg", "png"]:
-
         extracted_text = process_image_file(file_obj, file_extension)
 
     elif file_extension in ["mp3", "wav", "m4a", "ogg"]:
-        extracted_text = process_audio_file(file_obj, file_extension)
+        extracted_text = process_audio_file(file_obj, file_extension, progress)
 
     return extracted_text
 
 
-def process_audio_file(file_obj, file_extension):
-    """处理音频文件，使用Gemini API进行转录和理解"""
+def _audio_completion(prompt, audio_data, audio_format):
+    """发送一段音频和提示，返回模型的文本回复（没有回复时返回 None）"""
+    response = gemini_client.chat.completions.create(
+        model=GEMINI_PICTURE_MODEL,
+        messages=[
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": prompt
+                    },
+                    {
+                        "type": "input_audio",
+                        "input_audio": {
+                            "data": base64.b64encode(audio_data).decode('utf-8'),
+                            "format": audio_format
+                        }
+                    }
+                ]
+            }
+        ]
+    )
+    if response.choices and response.choices[0].message:
+        return response.choices[0].message.content
+    return None
+
+
+def _transcribe_segments(segments, progress=None):
+    """并发转录各片段，按时间顺序返回转录文本；单个片段失败时在对应位置注明，不影响其他片段"""
+    transcripts = [None] * len(segments)
+    with ThreadPoolExecutor(max_workers=AUDIO_TRANSCRIBE_WORKERS) as executor:
+        futures = {
+            executor.submit(_audio_completion, _SEGMENT_TRANSCRIBE_PROMPT, audio_data, audio_format): index
+            for index, (_, audio_data, audio_format) in enumerate(segments)
+        }
+        for done, future in enumerate(as_completed(futures), start=1):
+            index = futures[future]
+            try:
+                transcripts[index] = future.result() or "(no speech recognized)"
+            except Exception as e:
+                print(f"Transcription of audio segment {index + 1} failed: {e}")
+                transcripts[index] = f"(transcription failed: {e})"
+            if progress:
+                progress(done, len(segments))
+    return transcripts
+
+
+def process_audio_file(file_obj, file_extension, progress=None):
+    """处理音频文件，使用Gemini API进行转录和理解
+
+    长录音按 AUDIO_SEGMENT_SECONDS 切成片段并发转录，按时间顺序拼接后再单独请求一次摘要；
+    progress(已完成片段数, 总片段数) 在每个片段转录完成后调用。
+    """
     try:
-        # 读取音频文件并进行base64编码
         audio_bytes = file_obj.getvalue()
-        base64_audio = base64.b64encode(audio_bytes).decode('utf-8')
 
         # 显示音频播放器给用户
         st.audio(audio_bytes, format=f"audio/{file_extension}")
 
-        with st.spinner("Transcribing and analyzing audio..."):
-            # 调用Gemini API进行音频转录和理解
-            response = gemini_client.chat.completions.create(
+        if len(audio_bytes) > AUDIO_UNSPLIT_WARNING_BYTES and not can_split(file_extension):
+            st.warning(f"ffmpeg is not installed, so this {file_extension} file cannot be split into segments and "
+                       "will be transcribed in a single request. Long recordings may be slow or fail; install "
+                       "ffmpeg (see packages.txt) or upload a WAV file.")
+
+        segments = split_audio(audio_bytes, file_extension, AUDIO_SEGMENT_SECONDS)
+        if len(segments) == 1:
+            # 短录音：一次请求完成转录和理解
+            _, audio_data, audio_format = segments[0]
+            audio_analysis = _audio_completion(
+                "Please transcribe this audio and provide a summary of its content. If there are multiple speakers, try to distinguish them.",
+                audio_data, audio_format)
+            if progress:
+                progress(1, 1)
+        else:
+            transcripts = _transcribe_segments(segments, progress)
+            transcript = "\n\n".join(f"[{format_timestamp(start)}]\n{text}"
+                                      for (start, _, _), text in zip(segments, transcripts))
+            summary_response = gemini_client.chat.completions.create(
                 model=GEMINI_PICTURE_MODEL,
-                messages=[
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "text",
-                                "text": "Please transcribe this audio and provide a summary of its content. If there are multiple speakers, try to distinguish them."
-                            },
-                            {
-                                "type": "input_audio",
-                                "input_audio": {
-                                    "data": base64_audio,
-                                    "format": file_extension
-                                }
-                            }
-                        ]
-                    }
-                ]
+                messages=[{"role": "user", "content": f"Summarize the content of this transcript:\n\n{transcript}"}]
             )
+            summary = summary_response.choices[0].message.content if summary_response.choices else ""
+            audio_analysis = f"**Summary:**\n{summary}\n\n**Transcript:**\n{transcript}"
 
-            # 提取Gemini的回复
-            if response.choices and response.choices[0].message:
-                audio_analysis = response.choices[0].message.content
-
-                # 构建响应文本
-                result_text = f"**Audio Analysis Results:**\n\n{audio_analysis}\n\nIs there anything specific about this audio content you'd like me to explain?"
-                return result_text
-            else:
-                return "I couldn't analyze the audio properly. Is there something specific about the audio you'd like to ask about?"
+        # 构建响应文本
+        if audio_analysis:
+            return f"**Audio Analysis Results:**\n\n{audio_analysis}\n\nIs there anything specific about this audio content you'd like me to explain?"
+        else:
+            return "I couldn't analyze the audio properly. Is there something specific about the audio you'd like to ask about?"
 
     except Exception as e:
         st.error(f"Error processing audio: {e}")
-        return f"There was an error processing the audio file: {str(e)}. Please try uploading again or describe the audio content."
\ No newline at end of file
+        return f"There was an error processing the audio file: {str(e)}. Please try uploading again or describe the audio content."
@@ -0,0 +1,218 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import streamlit as st
+
+from config import RAG_INGEST_WORKERS, RAG_INGEST_SPOOL_DIR
+from extractors import extract_document
+
+# 任务状态
+QUEUED = "queued"
+RUNNING = "running"
+COMPLETED = "completed"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED_STATUSES = (COMPLETED, FAILED, CANCELLED)
+
+
+class IngestionCancelled(Exception):
+    """入库任务被用户取消"""
+
+
+class IngestionJob:
+    """一次文档入库任务的状态和进度，由后台线程更新、页面脚本轮询读取"""
+
+    def __init__(self, job_id, name, content_hash, created_at=None):
+        self.job_id = job_id
+        self.name = name
+        self.content_hash = content_hash
+        self.created_at = created_at or time.time()
+        self.status = QUEUED
+        self.pages_extracted = 0  # 已提取的页/幻灯片/段落数
+        self.chunks_processed = 0  # 已分块并处理（嵌入或判定为重复）的块数
+        self.chunks_indexed = 0  # 已写入索引的块数
+        self.result_chunks = 0  # 完成后该文档在知识库中的块数
+        self.messages = []  # 入库过程中的 (级别, 消息)
+        self.error = None
+        self.resumed = False
+        self._cancel_event = threading.Event()
+
+    @property
+    def finished(self):
+        return self.status in FINISHED_STATUSES
+
+    @property
+    def cancel_requested(self):
+        return self._cancel_event.is_set()
+
+    def cancel(self):
+        self._cancel_event.set()
+
+    def notify(self, level, message):
+        self.messages.append((level, message))
+
+    def check_cancelled(self):
+        if self._cancel_event.is_set():
+            raise IngestionCancelled()
+
+    def to_record(self):
+        return {"job_id": self.job_id, "name": self.name, "content_hash": self.content_hash,
+                "created_at": self.created_at, "status": self.status}
+
+
+class IngestionQueue:
+    """后台文档入库队列：线程池执行任务，上传的文件先落盘，进程崩溃后可以重新入队
+
+    任务记录和文件内容保存在 spool_dir 中，任务结束（完成、失败或取消）后删除。
+    重新执行的任务会再次分块，但已嵌入过的块直接命中持久化嵌入缓存，不会重复调用API。
+    """
+
+    def __init__(self, spool_dir=RAG_INGEST_SPOOL_DIR, workers=RAG_INGEST_WORKERS):
+        self.spool_dir = spool_dir
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="rag-ingest")
+        self._jobs = {}
+        self._lock = threading.Lock()
+        if spool_dir:
+            os.makedirs(spool_dir, exist_ok=True)
+
+    def _spool_paths(self, job_id):
+        return (os.path.join(self.spool_dir, f"{job_id}.json"),
+                os.path.join(self.spool_dir, f"{job_id}.bin"))
+
+    def _write_record(self, job):
+        if not self.spool_dir:
+            return
+        record_path, _ = self._spool_paths(job.job_id)
+        tmp_path = f"{record_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(job.to_record(), f)
+        os.replace(tmp_path, record_path)
+
+    def _remove_spool(self, job_id):
+        if not self.spool_dir:
+            return
+        for path in self._spool_paths(job_id):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def submit(self, rag_manager, file_name, data, document=None):
+        """提交一个上传的文件，立即返回任务对象
+
+        document 为页面已经解析（或正在解析）的同一文件时直接复用，不再重复解析。
+        """
+        content_hash = document.content_hash if document is not None else hashlib.sha256(data).hexdigest()
+        job = IngestionJob(uuid.uuid4().hex, file_name, content_hash)
+        # 先登记任务再写任务记录：其他会话的 resume_pending 看到记录时本进程已有该任务，不会重复入队
+        with self._lock:
+            self._jobs[job.job_id] = job
+        if self.spool_dir:
+            try:
+                # 先把文件内容落盘，再写任务记录，崩溃后记录存在就一定能找到文件
+                _, data_path = self._spool_paths(job.job_id)
+                with open(data_path, "wb") as f:
+                    f.write(data)
+                self._write_record(job)
+            except OSError:
+                with self._lock:
+                    del self._jobs[job.job_id]
+                self._remove_spool(job.job_id)
+                raise
+        self._executor.submit(self._run, job, rag_manager, data, document)
+        return job
+
+    def resume_pending(self, rag_manager):
+        """把上次进程退出时没有完成的任务重新入队，返回这些任务"""
+        if not self.spool_dir:
+            return []
+        resumed = []
+        for file_name in sorted(os.listdir(self.spool_dir)):
+            if not file_name.endswith(".json"):
+                continue
+            record_path = os.path.join(self.spool_dir, file_name)
+            try:
+                with open(record_path, encoding="utf-8") as f:
+                    record = json.load(f)
+                with open(self._spool_paths(record["job_id"])[1], "rb") as f:
+                    data = f.read()
+            except (OSError, ValueError, KeyError) as e:
+                print(f"Discarding unreadable ingestion job {file_name}: {e}")
+                os.remove(record_path)
+                continue
+            with self._lock:
+                if record["job_id"] in self._jobs:
+                    continue  # 本进程中已有该任务（已被其他会话恢复）
+                job = IngestionJob(record["job_id"], record["name"], record["content_hash"], record["created_at"])
+                job.resumed = True
+                self._jobs[job.job_id] = job
+            self._executor.submit(self._run, job, rag_manager, data)
+            resumed.append(job)
+        return resumed
+
+    def _run(self, job, rag_manager, data, document=None):
+        if job.cancel_requested:
+            job.status = CANCELLED
+            self._remove_spool(job.job_id)
+            return
+        job.status = RUNNING
+        self._write_record(job)
+
+        def track_pages(sections):
+            for section in sections:
+                job.check_cancelled()
+                job.pages_extracted += 1
+                yield section
+
+        def track_chunks(chunks_processed, chunks_indexed):
+            job.chunks_processed = chunks_processed
+            job.chunks_indexed = chunks_indexed
+            job.check_cancelled()
+
+        try:
+            if document is None:
+                document = extract_document(job.name, data, content_hash=job.content_hash)
+            sections = track_pages(document.iter_rag_sections())
+            metadata = {"name": job.name, "content_hash": job.content_hash}
+            job.result_chunks = rag_manager.add_document(sections, metadata, progress=track_chunks,
+                                                         notify=job.notify)
+            if job.result_chunks:
+                job.status = COMPLETED
+            else:
+                job.error = "No content could be extracted from the file, or the file is empty."
+                job.status = FAILED
+        except IngestionCancelled:
+            job.status = CANCELLED
+        except Exception as e:
+            print(f"Ingestion of {job.name} failed: {e}")
+            job.error = str(e)
+            job.status = FAILED
+        finally:
+            self._remove_spool(job.job_id)
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id):
+        job = self.get(job_id)
+        if job is not None and not job.finished:
+            job.cancel()
+
+    def forget(self, job_id):
+        """不再跟踪一个已结束的任务"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None and job.finished:
+                del self._jobs[job_id]
+
+
+@st.cache_resource(show_spinner=False)
+def get_ingestion_queue():
+    """进程内共享的入库队列"""
+    return IngestionQueue()
@@ -0,0 +1,54 @@
+import hashlib
+import re
+import threading
+import time
+from types import SimpleNamespace
+
+import numpy as np
+
+_TOKEN_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+
+class LocalEmbeddingClient:
+    """离线嵌入客户端，接口与 OpenAI 客户端的 embeddings.create 兼容，用于本地基准测试
+
+    向量由词哈希特征构成（相同词汇的文本向量相近），并可模拟每个请求的网络延迟。
+    """
+
+    def __init__(self, dim=768, request_latency=0.0, per_item_latency=0.0):
+        self.embeddings = _LocalEmbeddings(dim, request_latency, per_item_latency)
+
+
+class _LocalEmbeddings:
+    def __init__(self, dim, request_latency, per_item_latency):
+        self.dim = dim
+        self.request_latency = request_latency
+        self.per_item_latency = per_item_latency
+        self.request_count = 0
+        self.item_count = 0
+        self._lock = threading.Lock()
+
+    def create(self, input, model=None, **kwargs):
+        texts = [input] if isinstance(input, str) else list(input)
+        with self._lock:
+            self.request_count += 1
+            self.item_count += len(texts)
+
+        # 模拟一次HTTP往返的延迟
+        delay = self.request_latency + self.per_item_latency * len(texts)
+        if delay:
+            time.sleep(delay)
+
+        data = [SimpleNamespace(index=i, embedding=self._embed(text).tolist(), object="embedding")
+                for i, text in enumerate(texts)]
+        return SimpleNamespace(data=data, model=model, object="list")
+
+    def _embed(self, text):
+        vector = np.zeros(self.dim, dtype='float32')
+        for token in _TOKEN_PATTERN.findall(text.lower()):
+            digest = hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest()
+            bucket = int.from_bytes(digest[:4], "little") % self.dim
+            sign = 1.0 if digest[4] & 1 else -1.0
+            vector[bucket] += sign
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
@@ -1,20 +1,29 @@
 import streamlit as st
-import atexit
 from config import PERSONAS
 from database import init_db_pool
-from rag import RAGManager
+from rag import get_rag_manager
+from ingest_jobs import get_ingestion_queue
 from chat import init_chat, client
 from ui_components import render_sidebar, render_main_content
 
 # 设置页面标题和布局
 st.set_page_config(page_title="C-chatbot", layout="wide")
 
-# 初始化数据库连接池
-init_db_pool()
+# 初始化数据库连接池（进程内共享，重跑脚本时复用同一个连接池）
+try:
+    init_db_pool()
+except Exception as e:
+    # 建表或迁移失败：不继续渲染，下次运行脚本时重试
+    st.error(f"Database initialization failed: {e}")
+    st.stop()
 
-# 初始化 RAG 管理器
+# 知识库在进程内所有会话间共用（内存映射或pgvector），首次使用时载入持久化的索引
 if 'rag_manager' not in st.session_state:
-    st.session_state.rag_manager = RAGManager(api_client=client)
+    st.session_state.rag_manager = get_rag_manager(client)
+    st.session_state.rag_enabled = False  # 每个会话自己决定是否启用RAG
+    # 恢复上次进程退出时未完成的入库任务（由第一个会话接手）
+    resumed_jobs = get_ingestion_queue().resume_pending(st.session_state.rag_manager)
+    st.session_state.rag_ingest_jobs = [job.job_id for job in resumed_jobs]
 
 # 初始化会话状态
 if "current_persona" not in st.session_state:
@@ -27,7 +36,7 @@ if "current_conversation_id" not in st.session_state:
     # 检查现有会话
     from database import get_conversations, create_conversation
 
-    conversations_list = get_conversations()
+    conversations_list = get_conversations(limit=1)
     if conversations_list:
         st.session_state.current_conversation_id = conversations_list[0][0]  # 使用最新的会话
     else:
@@ -47,18 +56,6 @@ render_sidebar()
 # 渲染主内容区域
 render_main_content()
 
-
-# 关闭数据库连接函数
-def close_db_on_exit():
-    # 清空RAG知识库
-    if 'rag_manager' in st.session_state:
-        st.session_state.rag_manager.clear()
-        print("RAG knowledge base cleared.")
-
-
-# 注册退出时自动执行的关闭事件
-atexit.register(close_db_on_exit)
-
 # 主应用入口点（如果直接运行此文件）
 if __name__ == "__main__":
     pass  # 主要逻辑已在上面执行
\ No newline at end of file
@@ -0,0 +1,99 @@
+import sys
+import threading
+from collections import defaultdict
+
+import streamlit as st
+
+from caching import LRUCache
+from config import MESSAGE_CACHE_MAX_BYTES, MESSAGE_CACHE_MAX_CONVERSATIONS
+
+_MESSAGE_OVERHEAD_BYTES = 200  # 每条消息的字典和列表开销的估计
+
+
+def _message_size(message):
+    return sys.getsizeof(message["content"]) + _MESSAGE_OVERHEAD_BYTES
+
+
+class CachedConversation:
+    """一个会话已载入的消息（最新的若干页，按时间先后排列）"""
+
+    __slots__ = ("messages", "cursor", "has_more", "nbytes")
+
+    def __init__(self, messages, cursor, has_more):
+        self.messages = messages  # [{"role", "content"}]
+        self.cursor = cursor  # 已载入的最早一条消息的 (created_at, id)，读取更早一页的游标
+        self.has_more = has_more
+        self.nbytes = sum(_message_size(message) for message in messages)
+
+
+class MessageCache:
+    """进程内所有会话共享的会话消息缓存，以会话ID为键，按总字节数做LRU淘汰
+
+    save_chat 把新消息追加到已缓存的会话中，删除或清空会话时移除对应条目，因此在最近的会话之间
+    切换不需要查询数据库。snapshot() 返回消息列表的浅拷贝：各个页面会话持有自己的列表，
+    消息字典本身共享，不复制内容。
+    """
+
+    def __init__(self, max_bytes=MESSAGE_CACHE_MAX_BYTES, max_conversations=MESSAGE_CACHE_MAX_CONVERSATIONS):
+        self._cache = LRUCache(max_entries=max_conversations, max_bytes=max_bytes)
+        # 每个会话的修改版本：从数据库读取期间会话有新消息或被清空时，读到的结果不再写入缓存
+        self._versions = defaultdict(int)
+        self._lock = threading.Lock()
+
+    @property
+    def stats(self):
+        return {"conversations": len(self._cache), "bytes": self._cache.bytes}
+
+    def version(self, conversation_id):
+        with self._lock:
+            return self._versions[conversation_id]
+
+    def snapshot(self, conversation_id):
+        """返回 (消息列表副本, 游标, 是否还有更早的消息)；未缓存时返回 None"""
+        with self._lock:
+            entry = self._cache.get(conversation_id)
+            if entry is None:
+                return None
+            return list(entry.messages), entry.cursor, entry.has_more
+
+    def put(self, conversation_id, messages, cursor, has_more, version):
+        """缓存从数据库读到的最新一页；version 为读取前 version() 的值"""
+        with self._lock:
+            if self._versions[conversation_id] != version:
+                return
+            entry = CachedConversation(messages, cursor, has_more)
+            self._cache.set(conversation_id, entry, size=entry.nbytes)
+
+    def prepend(self, conversation_id, messages, before, cursor, has_more):
+        """把游标 before 之前的一页加到已缓存的会话前面（其他页面会话已经载入过这一页时不重复添加）"""
+        with self._lock:
+            entry = self._cache.get(conversation_id)
+            if entry is None or entry.cursor != before:
+                return
+            entry.messages[:0] = messages
+            entry.cursor = cursor
+            entry.has_more = has_more
+            entry.nbytes += sum(_message_size(message) for message in messages)
+            self._cache.set(conversation_id, entry, size=entry.nbytes)
+
+    def append(self, conversation_id, message):
+        """新消息追加到已缓存的会话末尾（未缓存的会话不处理，下次读取时从数据库载入）"""
+        with self._lock:
+            self._versions[conversation_id] += 1
+            entry = self._cache.get(conversation_id)
+            if entry is None:
+                return
+            entry.messages.append(message)
+            entry.nbytes += _message_size(message)
+            self._cache.set(conversation_id, entry, size=entry.nbytes)
+
+    def invalidate(self, conversation_id):
+        with self._lock:
+            self._versions[conversation_id] += 1
+            self._cache.pop(conversation_id)
+
+
+@st.cache_resource(show_spinner=False)
+def get_message_cache():
+    """进程内共享的会话消息缓存"""
+    return MessageCache()
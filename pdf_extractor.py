@@ -0,0 +1,86 @@
+"""多进程PDF文本提取
+
+PDF字节内容放进一块共享内存，页码区间分给常驻进程池中的各个工作进程；每个进程从共享内存
+打开自己的 fitz 文档，提取结果按页码顺序流式返回。本模块只依赖 fitz，工作进程以 spawn 方式
+启动，不继承Streamlit进程中的线程和连接。
+"""
+import multiprocessing
+import os
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait
+from multiprocessing import shared_memory
+
+import fitz  # PyMuPDF
+
+# 常驻进程池（按进程数区分），避免每个文档都重新启动进程
+_executors = {}
+_executors_lock = threading.Lock()
+
+# 工作进程中当前打开的文档及其共享内存名称
+_worker_document = None
+_worker_document_key = None
+
+
+def _get_executor(workers):
+    with _executors_lock:
+        executor = _executors.get(workers)
+        if executor is None:
+            executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+            _executors[workers] = executor
+        return executor
+
+
+def _extract_range(shm_name, size, start, stop):
+    global _worker_document, _worker_document_key
+    if _worker_document_key != shm_name:
+        if _worker_document is not None:
+            _worker_document.close()
+        shm = shared_memory.SharedMemory(name=shm_name)
+        try:
+            data = bytes(shm.buf[:size])
+        finally:
+            shm.close()  # 只断开映射，共享内存由主进程释放
+        _worker_document = fitz.open(stream=data, filetype="pdf")
+        _worker_document_key = shm_name
+    return [_worker_document.load_page(page_num).get_text() for page_num in range(start, stop)]
+
+
+def iter_pdf_pages(data, workers=0, pages_per_task=16, min_parallel_pages=64):
+    """按页码顺序逐页产出 (页号, 文本)，页号从1开始
+
+    workers 为0时使用全部CPU核；页数少于 min_parallel_pages 或只有一个核时在当前进程中提取，
+    省去跨进程传输的开销。同时在途的页码区间不超过 workers*2 个，内存占用与总页数无关。
+    """
+    workers = workers or os.cpu_count() or 1
+    document = fitz.open(stream=data, filetype="pdf")
+    try:
+        page_count = document.page_count
+        if workers <= 1 or page_count < max(min_parallel_pages, 2 * pages_per_task):
+            for page_num in range(page_count):
+                yield page_num + 1, document.load_page(page_num).get_text()
+            return
+    finally:
+        document.close()
+
+    executor = _get_executor(workers)
+    shm = shared_memory.SharedMemory(create=True, size=len(data))
+    pending = deque()
+    try:
+        shm.buf[:len(data)] = data
+        ranges = deque((start, min(page_count, start + pages_per_task))
+                       for start in range(0, page_count, pages_per_task))
+        while ranges or pending:
+            while ranges and len(pending) < workers * 2:
+                start, stop = ranges.popleft()
+                pending.append((start, executor.submit(_extract_range, shm.name, len(data), start, stop)))
+            start, future = pending.popleft()
+            for offset, text in enumerate(future.result()):
+                yield start + offset + 1, text
+    finally:
+        # 消费者提前停止（如取消入库）时丢弃尚未开始的区间，等正在执行的区间结束后再释放共享内存
+        for _, future in pending:
+            future.cancel()
+        wait([future for _, future in pending])
+        shm.close()
+        shm.unlink()
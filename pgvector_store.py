@@ -0,0 +1,202 @@
+import streamlit as st
+from psycopg2.extras import Json, execute_values
+
+from config import GEMINI_EMBEDDING_DIM, RAG_PGVECTOR_INDEX, RAG_PGVECTOR_EF_SEARCH, RAG_PGVECTOR_PROBES
+from database import db_connection
+
+
+def _vector_literal(vector):
+    """把向量格式化为pgvector的文本表示，例如 '[0.1,0.2,0.3]'"""
+    return "[" + ",".join(f"{float(value):.7g}" for value in vector) + "]"
+
+
+class PgVectorStore:
+    """基于PostgreSQL + pgvector的向量存储，复用 database.py 的连接池
+
+    块文本和向量持久保存在数据库中，top-k 检索在服务器端通过HNSW/IVFFlat索引完成，
+    Python进程不需要载入全部向量。同一张表可能被多个进程共用：{table}_state 中的一行记录
+    版本号和块数，每次写入都在同一个事务中更新它，读取这一行即可知道表是否变化。
+    """
+
+    def __init__(self, dim=GEMINI_EMBEDDING_DIM, table="rag_chunks", index_method=RAG_PGVECTOR_INDEX):
+        self.dim = dim
+        self.table = table
+        self.state_table = f"{table}_state"
+        self.index_method = index_method  # "hnsw" 或 "ivfflat"
+
+    def create_tables(self):
+        """创建pgvector扩展、块表、状态表和近似最近邻索引"""
+        try:
+            with db_connection() as db_conn, db_conn.cursor() as cursor:
+                cursor.execute("CREATE EXTENSION IF NOT EXISTS vector")
+                cursor.execute(f"""
+                    CREATE TABLE IF NOT EXISTS {self.table} (
+                        id BIGSERIAL PRIMARY KEY,
+                        document_name TEXT,
+                        chunk_id INTEGER,
+                        content TEXT NOT NULL,
+                        metadata JSONB,
+                        embedding vector({self.dim}) NOT NULL,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    )
+                """)
+                if self.index_method == "ivfflat":
+                    cursor.execute(f"""
+                        CREATE INDEX IF NOT EXISTS {self.table}_embedding_idx
+                        ON {self.table} USING ivfflat (embedding vector_cosine_ops) WITH (lists = 100)
+                    """)
+                else:
+                    cursor.execute(f"""
+                        CREATE INDEX IF NOT EXISTS {self.table}_embedding_idx
+                        ON {self.table} USING hnsw (embedding vector_cosine_ops)
+                    """)
+                cursor.execute(f"CREATE INDEX IF NOT EXISTS {self.table}_document_idx ON {self.table} (document_name)")
+                # 只有一行的状态表；已有的块表第一次升级时按现有行数初始化
+                cursor.execute(f"""
+                    CREATE TABLE IF NOT EXISTS {self.state_table} (
+                        id INTEGER PRIMARY KEY CHECK (id = 1),
+                        version BIGINT NOT NULL,
+                        chunk_count BIGINT NOT NULL
+                    )
+                """)
+                cursor.execute(f"""
+                    INSERT INTO {self.state_table} (id, version, chunk_count)
+                    SELECT 1, 0, COUNT(*) FROM {self.table}
+                    ON CONFLICT (id) DO NOTHING
+                """)
+                db_conn.commit()
+            return True
+        except Exception as e:
+            print(f"Failed to create pgvector tables: {e}")
+            return False
+
+    def _bump_state(self, cursor, delta=0, reset=False):
+        """在写入的同一个事务中更新版本号和块数"""
+        if reset:
+            cursor.execute(f"UPDATE {self.state_table} SET version = version + 1, chunk_count = 0 WHERE id = 1")
+        else:
+            cursor.execute(f"UPDATE {self.state_table} SET version = version + 1, chunk_count = chunk_count + %s "
+                           f"WHERE id = 1", (delta,))
+
+    def state(self):
+        """返回 (版本号, 块数)；读取失败时返回None"""
+        try:
+            with db_connection() as db_conn, db_conn.cursor() as cursor:
+                cursor.execute(f"SELECT version, chunk_count FROM {self.state_table} WHERE id = 1")
+                row = cursor.fetchone()
+                db_conn.commit()
+            return (row[0], row[1]) if row else (0, 0)
+        except Exception as e:
+            print(f"Failed to read RAG store state: {e}")
+            return None
+
+    def add(self, texts, metadata, vectors):
+        """批量写入块（一次事务，execute_values 每页多行）"""
+        rows = [
+            (chunk_metadata.get("name"), chunk_metadata.get("chunk_id"), text, Json(chunk_metadata),
+             _vector_literal(vector))
+            for text, chunk_metadata, vector in zip(texts, metadata, vectors)
+        ]
+        if not rows:
+            return 0
+        try:
+            with db_connection() as db_conn, db_conn.cursor() as cursor:
+                execute_values(
+                    cursor,
+                    f"INSERT INTO {self.table} (document_name, chunk_id, content, metadata, embedding) VALUES %s",
+                    rows,
+                    template="(%s, %s, %s, %s, %s::vector)",
+                    page_size=500
+                )
+                self._bump_state(cursor, len(rows))
+                db_conn.commit()
+            return len(rows)
+        except Exception as e:
+            print(f"Failed to insert RAG chunks: {e}")
+            return 0
+
+    def search(self, query_vector, top_k):
+        """在服务器端执行余弦相似度 top-k 检索"""
+        try:
+            with db_connection() as db_conn, db_conn.cursor() as cursor:
+                # 召回/延迟参数只在本事务内生效
+                if self.index_method == "ivfflat":
+                    cursor.execute("SET LOCAL ivfflat.probes = %s", (RAG_PGVECTOR_PROBES,))
+                else:
+                    cursor.execute("SET LOCAL hnsw.ef_search = %s", (RAG_PGVECTOR_EF_SEARCH,))
+                literal = _vector_literal(query_vector)
+                cursor.execute(f"""
+                    SELECT content, metadata, 1 - (embedding <=> %s::vector) AS score
+                    FROM {self.table}
+                    ORDER BY embedding <=> %s::vector
+                    LIMIT %s
+                """, (literal, literal, top_k))
+                rows = cursor.fetchall()
+                db_conn.commit()
+            return [{"text": content, "metadata": chunk_metadata or {}, "score": float(score)}
+                    for content, chunk_metadata, score in rows]
+        except Exception as e:
+            print(f"Failed to search RAG chunks: {e}")
+            return []
+
+    def count(self):
+        """块数（读取状态表的一行，不扫描块表）"""
+        state = self.state()
+        return state[1] if state is not None else 0
+
+    def list_documents(self):
+        """按文档名汇总块数和内容哈希"""
+        try:
+            with db_connection() as db_conn, db_conn.cursor() as cursor:
+                cursor.execute(f"""
+                    SELECT document_name, MAX(metadata->>'content_hash'), COUNT(*)
+                    FROM {self.table}
+                    GROUP BY document_name
+                    ORDER BY document_name
+                """)
+                rows = cursor.fetchall()
+                db_conn.commit()
+            return [{"name": name, "content_hash": content_hash, "chunks": chunks}
+                    for name, content_hash, chunks in rows]
+        except Exception as e:
+            print(f"Failed to list RAG documents: {e}")
+            return []
+
+    def delete_document(self, document_name, keep_hash=None):
+        """删除一个文档的所有块；指定 keep_hash 时保留该内容哈希的块（替换文档时删除旧版本）"""
+        try:
+            with db_connection() as db_conn, db_conn.cursor() as cursor:
+                if keep_hash is None:
+                    cursor.execute(f"DELETE FROM {self.table} WHERE document_name = %s", (document_name,))
+                else:
+                    cursor.execute(f"""
+                        DELETE FROM {self.table}
+                        WHERE document_name = %s AND metadata->>'content_hash' IS DISTINCT FROM %s
+                    """, (document_name, keep_hash))
+                deleted = cursor.rowcount
+                if deleted:
+                    self._bump_state(cursor, -deleted)
+                db_conn.commit()
+            return deleted
+        except Exception as e:
+            print(f"Failed to delete RAG document {document_name}: {e}")
+            return 0
+
+    def clear(self):
+        try:
+            with db_connection() as db_conn, db_conn.cursor() as cursor:
+                cursor.execute(f"TRUNCATE {self.table}")
+                self._bump_state(cursor, reset=True)
+                db_conn.commit()
+            return True
+        except Exception as e:
+            print(f"Failed to clear RAG chunks: {e}")
+            return False
+
+
+@st.cache_resource(show_spinner=False)
+def get_pgvector_store():
+    """进程内共享的pgvector存储，首次使用时创建扩展、表和索引"""
+    store = PgVectorStore()
+    store.create_tables()
+    return store
@@ -1,12 +1,786 @@
+import contextlib
+import random
+import re
+import threading
+import time
+from array import array
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+
 import streamlit as st
 import numpy as np
-from sklearn.neighbors import NearestNeighbors  # 纯Python实现，易于安装
-from openai import OpenAI
-from config import GEMINI_API_KEY, GEMINI_BASE_URL, GEMINI_EMBEDDING_DIM, GEMINI_EMBEDDING_MODEL
+from openai import (OpenAI, BadRequestError, RateLimitError, APITimeoutError, APIConnectionError,
+                    InternalServerError)
+from config import (GEMINI_API_KEY, GEMINI_BASE_URL, GEMINI_EMBEDDING_DIM, GEMINI_EMBEDDING_MODEL,
+                    RAG_EMBEDDING_BATCH_SIZE, RAG_EMBEDDING_BATCH_TOKENS, RAG_EMBEDDING_WORKERS,
+                    RAG_EMBEDDING_MAX_IN_FLIGHT, RAG_EMBEDDING_MAX_RETRIES, RAG_EMBEDDING_BACKOFF_SECONDS,
+                    RAG_EMBEDDING_BACKOFF_MAX_SECONDS, RAG_QUERY_CACHE_SIZE, RAG_QUERY_CACHE_TTL_SECONDS,
+                    RAG_RESULT_CACHE_SIZE, RAG_RESULT_CACHE_TTL_SECONDS, RAG_INDEX_TYPE, RAG_IVF_NLIST,
+                    RAG_IVF_NPROBE, RAG_IVF_MIN_TRAIN_SIZE, RAG_VECTOR_STORAGE, RAG_PQ_SUBQUANTIZERS,
+                    RAG_PQ_MIN_TRAIN_SIZE, RAG_RERANK_FACTOR, RAG_SEARCH_MODE, RAG_HYBRID_CANDIDATES,
+                    RAG_INGEST_WINDOW, RAG_DEDUP_ENABLED, RAG_COMPACT_DELETED_RATIO, RAG_INDEX_DIR,
+                    RAG_VECTOR_BACKEND, RAG_PERSIST_MAX_SEGMENTS, RAG_PERSIST_SEGMENT_RATIO)
+from caching import LRUCache
+from chunking import estimate_tokens, iter_chunks
+from dedup import SimHashIndex, simhash
+from embedding_cache import get_embedding_cache
+from rag_store import IndexWriter, OverlayList, current_generation, load_index
+
+# 进程内所有会话共享的嵌入请求并发上限
+_embedding_request_slots = threading.BoundedSemaphore(RAG_EMBEDDING_MAX_IN_FLIGHT)
+
+# 查询向量只取决于查询文本和模型，因此所有会话共享一个内存缓存
+_query_vector_cache = LRUCache(max_entries=RAG_QUERY_CACHE_SIZE, ttl=RAG_QUERY_CACHE_TTL_SECONDS)
+
+# 值得退避重试的临时错误
+_RETRYABLE_EMBEDDING_ERRORS = (RateLimitError, APITimeoutError, APIConnectionError, InternalServerError)
+
+
+def _streamlit_notify(level, message):
+    """在页面上显示入库过程中的提示（level 为 "info"、"warning" 或 "error"）"""
+    getattr(st, level)(message)
+
+
+def _chunk_metadata(metadata, chunk_id, section_metadata):
+    """块的元数据：文档元数据、段元数据（页码等）和块ID"""
+    chunk_metadata = {**metadata, **section_metadata}
+    chunk_metadata["chunk_id"] = chunk_id
+    return chunk_metadata
+
+
+class _ReadWriteLock:
+    """读写锁：检索（读）之间可以并发，修改索引（写）时独占
+
+    `with lock:` 获取写锁，同一线程可以重入；`with lock.read():` 获取读锁，持有写锁的线程也可以读。
+    有线程在等待写锁时新的读者排队，入库不会被持续不断的检索饿死。
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = None  # 持有写锁的线程
+        self._writer_depth = 0
+        self._waiting_writers = 0
+
+    def __enter__(self):
+        me = threading.get_ident()
+        with self._condition:
+            if self._writer == me:
+                self._writer_depth += 1
+                return self
+            self._waiting_writers += 1
+            try:
+                while self._writer is not None or self._readers:
+                    self._condition.wait()
+            finally:
+                self._waiting_writers -= 1
+            self._writer = me
+            self._writer_depth = 1
+        return self
+
+    def __exit__(self, *exc_info):
+        with self._condition:
+            self._writer_depth -= 1
+            if not self._writer_depth:
+                self._writer = None
+                self._condition.notify_all()
+
+    @contextlib.contextmanager
+    def read(self):
+        with self._condition:
+            if self._writer == threading.get_ident():
+                nested = True
+            else:
+                nested = False
+                while self._writer is not None or self._waiting_writers:
+                    self._condition.wait()
+                self._readers += 1
+        try:
+            yield
+        finally:
+            if not nested:
+                with self._condition:
+                    self._readers -= 1
+                    if not self._readers:
+                        self._condition.notify_all()
+
+
+class _GrowableArray:
+    """按倍数扩容的二维数组，追加的均摊开销为 O(新增行数)"""
+
+    def __init__(self, width, dtype):
+        self._buffer = np.empty((0, width), dtype=dtype)
+        self.size = 0
+
+    @classmethod
+    def wrap(cls, array):
+        """直接引用已有数组（可以是只读内存映射）；之后追加时会复制到新缓冲区"""
+        wrapped = cls(array.shape[1], array.dtype)
+        wrapped._buffer = array
+        wrapped.size = len(array)
+        return wrapped
+
+    @property
+    def view(self):
+        return self._buffer[:self.size]
+
+    def append(self, rows):
+        start, required = self.size, self.size + len(rows)
+        if required > len(self._buffer):
+            buffer = np.empty((max(required, 2 * len(self._buffer)), self._buffer.shape[1]), dtype=self._buffer.dtype)
+            buffer[:self.size] = self.view
+            self._buffer = buffer
+        self._buffer[start:required] = rows
+        self.size = required
+
+    @property
+    def nbytes(self):
+        return self.view.nbytes
+
+
+def _top_k(scores, k):
+    """从 (查询数, 候选数) 的分数矩阵中取每行 top-k，返回按分数降序排列的 (分数, 列号)"""
+    k = min(k, scores.shape[1])
+    if k < scores.shape[1]:
+        candidates = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        candidates = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+    candidate_scores = np.take_along_axis(scores, candidates, axis=1)
+    order = np.argsort(-candidate_scores, axis=1)
+    return np.take_along_axis(candidate_scores, order, axis=1), np.take_along_axis(candidates, order, axis=1)
+
+
+def _kmeans(data, clusters, iterations, rng, spherical=False):
+    """简单的k-means（spherical=True 时按内积聚类并归一化中心）"""
+    centroids = data[rng.choice(len(data), clusters, replace=False)].astype('float32')
+    for _ in range(iterations):
+        if spherical:
+            assignment = np.argmax(data @ centroids.T, axis=1)
+        else:
+            # argmin ||x - c||^2 等价于 argmax 2x·c - ||c||^2
+            assignment = np.argmax(2 * (data @ centroids.T) - (centroids ** 2).sum(axis=1), axis=1)
+        order = np.argsort(assignment, kind='stable')
+        members, starts = np.unique(assignment[order], return_index=True)
+        counts = np.diff(np.append(starts, len(data)))[:, None]
+        # 空簇重新随机初始化，其余簇取成员均值
+        updated = data[rng.integers(len(data), size=clusters)].astype('float32')
+        updated[members] = np.add.reduceat(data[order], starts, axis=0) / counts
+        centroids = updated
+        if spherical:
+            centroids /= np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+    return centroids
+
+
+class _Float32Storage:
+    """未压缩存储：每个向量 4*dim 字节"""
+    lossy = False
+
+    def __init__(self, dim):
+        self.dim = dim
+        self._vectors = _GrowableArray(dim, 'float32')
+
+    @property
+    def size(self):
+        return self._vectors.size
+
+    @property
+    def nbytes(self):
+        return self._vectors.nbytes
+
+    def append(self, vectors):
+        self._vectors.append(vectors)
+
+    def scores(self, queries, ids=None):
+        vectors = self._vectors.view if ids is None else self._vectors.view[ids]
+        return queries @ vectors.T
+
+    def reconstruct(self, ids=None):
+        return self._vectors.view if ids is None else self._vectors.view[ids]
+
+
+class _Float16Storage(_Float32Storage):
+    """半精度存储：每个向量 2*dim 字节，打分时分块转换为float32以使用BLAS"""
+    lossy = True
+    block_rows = 4096
+
+    def __init__(self, dim):
+        self.dim = dim
+        self._vectors = _GrowableArray(dim, 'float16')
+
+    def scores(self, queries, ids=None):
+        vectors = self._vectors.view if ids is None else self._vectors.view[ids]
+        result = np.empty((len(queries), len(vectors)), dtype='float32')
+        for start in range(0, len(vectors), self.block_rows):
+            block = vectors[start:start + self.block_rows].astype('float32')
+            result[:, start:start + len(block)] = queries @ block.T
+        return result
+
+    def reconstruct(self, ids=None):
+        vectors = self._vectors.view if ids is None else self._vectors.view[ids]
+        return vectors.astype('float32')
+
+
+class _Int8Storage:
+    """标量int8量化：每个向量 dim 字节加一个float32缩放系数"""
+    lossy = True
+    block_rows = 2048  # 分块转换，使临时float32块留在CPU缓存中
+
+    def __init__(self, dim):
+        self.dim = dim
+        self._codes = _GrowableArray(dim, 'int8')
+        self._scales = _GrowableArray(1, 'float32')
+
+    @property
+    def size(self):
+        return self._codes.size
+
+    @property
+    def nbytes(self):
+        return self._codes.nbytes + self._scales.nbytes
+
+    def append(self, vectors):
+        scales = np.abs(vectors).max(axis=1, keepdims=True) / 127.0
+        scales[scales == 0] = 1.0
+        self._codes.append(np.round(vectors / scales).astype('int8'))
+        self._scales.append(scales.astype('float32'))
+
+    def scores(self, queries, ids=None):
+        codes = self._codes.view if ids is None else self._codes.view[ids]
+        scales = (self._scales.view if ids is None else self._scales.view[ids])[:, 0]
+        result = np.empty((len(queries), len(codes)), dtype='float32')
+        for start in range(0, len(codes), self.block_rows):
+            block = codes[start:start + self.block_rows].astype('float32')
+            result[:, start:start + len(block)] = (queries @ block.T) * scales[start:start + len(block)]
+        return result
+
+    def reconstruct(self, ids=None):
+        codes = self._codes.view if ids is None else self._codes.view[ids]
+        scales = self._scales.view if ids is None else self._scales.view[ids]
+        return codes.astype('float32') * scales
+
+
+class _PQStorage:
+    """乘积量化（PQ）：向量切成 m 段，每段用256个中心之一的编号表示，每个向量 m 字节
+
+    检索使用非对称距离计算（ADC）：查询保持原始精度，先算出查询每段与各中心的内积表，
+    再按编码查表求和。攒够 min_train_size 个向量之前以float32暂存，训练后全部编码。
+    """
+    lossy = True
+    block_rows = 65536
+
+    def __init__(self, dim, subquantizers=RAG_PQ_SUBQUANTIZERS, min_train_size=RAG_PQ_MIN_TRAIN_SIZE):
+        if dim % subquantizers:
+            raise ValueError(f"Embedding dimension {dim} is not divisible by {subquantizers} PQ subquantizers")
+        self.dim = dim
+        self.subquantizers = subquantizers
+        self.subdim = dim // subquantizers
+        self.min_train_size = max(min_train_size, 256)
+        self.codebooks = None  # (m, 256, subdim)
+        self._staging = _GrowableArray(dim, 'float32')
+        self._codes = _GrowableArray(subquantizers, 'uint8')
+
+    @property
+    def is_trained(self):
+        return self.codebooks is not None
+
+    @property
+    def size(self):
+        return self._codes.size if self.is_trained else self._staging.size
+
+    @property
+    def nbytes(self):
+        if not self.is_trained:
+            return self._staging.nbytes
+        return self._codes.nbytes + self.codebooks.nbytes
+
+    def append(self, vectors):
+        if self.is_trained:
+            self._codes.append(self._encode(vectors))
+            return
+        self._staging.append(vectors)
+        if self._staging.size >= self.min_train_size:
+            self.train()
+
+    def train(self, iterations=10, seed=0):
+        data = self._staging.view
+        rng = np.random.default_rng(seed)
+        sample = data[rng.choice(len(data), min(len(data), 256 * 32), replace=False)]
+        self.codebooks = np.stack([
+            _kmeans(sample[:, j * self.subdim:(j + 1) * self.subdim], 256, iterations, rng)
+            for j in range(self.subquantizers)
+        ])
+        self._codes = _GrowableArray(self.subquantizers, 'uint8')
+        self._codes.append(self._encode(data))
+        self._staging = None  # 释放原始向量
+
+    def trained_state(self):
+        """码本和已有向量的编码，供持久化后直接载入（未训练时为空）"""
+        if not self.is_trained:
+            return {}
+        return {"pq_codebooks": self.codebooks, "pq_codes": self._codes.view}
+
+    def load_trained(self, state, count):
+        """载入 trained_state() 保存的码本和编码；与当前配置或向量数不一致时返回False"""
+        codebooks, codes = state.get("pq_codebooks"), state.get("pq_codes")
+        if (codebooks is None or codes is None or codebooks.shape != (self.subquantizers, 256, self.subdim)
+                or codes.shape != (count, self.subquantizers)):
+            return False
+        self.codebooks = np.asarray(codebooks, dtype='float32')
+        self._codes = _GrowableArray.wrap(codes)
+        self._staging = None
+        return True
+
+    def _encode(self, vectors):
+        codes = np.empty((len(vectors), self.subquantizers), dtype='uint8')
+        for j, codebook in enumerate(self.codebooks):
+            sub = vectors[:, j * self.subdim:(j + 1) * self.subdim]
+            codes[:, j] = np.argmax(2 * (sub @ codebook.T) - (codebook ** 2).sum(axis=1), axis=1)
+        return codes
+
+    def scores(self, queries, ids=None):
+        if not self.is_trained:
+            vectors = self._staging.view if ids is None else self._staging.view[ids]
+            return queries @ vectors.T
+
+        codes = self._codes.view if ids is None else self._codes.view[ids]
+        # 查询各段与各中心的内积表：(查询数, m, 256)
+        tables = np.einsum('qmd,mkd->qmk', queries.reshape(len(queries), self.subquantizers, self.subdim),
+                           self.codebooks)
+        segments = np.arange(self.subquantizers)
+        result = np.empty((len(queries), len(codes)), dtype='float32')
+        for row, table in enumerate(tables):
+            for start in range(0, len(codes), self.block_rows):
+                block = codes[start:start + self.block_rows]
+                result[row, start:start + len(block)] = table[segments, block].sum(axis=1)
+        return result
+
+    def reconstruct(self, ids=None):
+        if not self.is_trained:
+            return self._staging.view if ids is None else self._staging.view[ids]
+        codes = self._codes.view if ids is None else self._codes.view[ids]
+        segments = np.arange(self.subquantizers)
+        return self.codebooks[segments, codes].reshape(len(codes), self.dim)
+
+
+_VECTOR_STORAGES = {
+    "float32": _Float32Storage,
+    "float16": _Float16Storage,
+    "int8": _Int8Storage,
+    "pq": _PQStorage,
+}
+
+
+class VectorIndex:
+    """轻量级向量检索引擎：向量在写入时归一化一次，检索是一次矩阵乘法加 argpartition
+
+    storage 为 "float16"/"int8"/"pq" 时向量以压缩形式保存；若设置了 rerank_source，
+    会先按近似分数取 k*rerank_factor 个候选，再用原始向量精确重排。
+    """
+
+    def __init__(self, dim, metric="cosine", storage="float32", rerank_factor=RAG_RERANK_FACTOR):
+        self.dim = dim
+        self.metric = metric  # "cosine" 或 "ip"（内积）
+        self.storage = _VECTOR_STORAGES[storage](dim)
+        self.rerank_factor = rerank_factor
+        self.rerank_source = None  # callable(ids) -> 每个id对应的原始向量（缺失为None）
+
+    @property
+    def size(self):
+        return self.storage.size
+
+    @property
+    def vectors(self):
+        """float32存储时返回内部矩阵视图，压缩存储时返回None（避免整体解压）"""
+        return None if self.storage.lossy else self.storage.reconstruct()
+
+    @property
+    def nbytes(self):
+        return self.storage.nbytes
+
+    def __len__(self):
+        return self.size
+
+    def trained_state(self):
+        """训练得到的参数（名称 -> 数组），随索引一起持久化；在修改索引的锁内调用"""
+        if isinstance(self.storage, _PQStorage):
+            return self.storage.trained_state()
+        return {}
+
+    def attach(self, vectors, trained=None):
+        """载入已归一化的向量；float32存储直接引用该数组（如内存映射文件）而不复制
+
+        trained 为持久化的 trained_state()：与当前配置一致时直接使用保存的码本和编码，不重新训练。
+        """
+        if (trained and self.size == 0 and isinstance(self.storage, _PQStorage)
+                and self.storage.load_trained(trained, len(vectors))):
+            return
+        if self.size == 0 and not self.storage.lossy:
+            self.storage._vectors = _GrowableArray.wrap(vectors)
+        else:
+            for start in range(0, len(vectors), 65536):
+                self.storage.append(np.asarray(vectors[start:start + 65536], dtype='float32'))
+
+    def _prepare(self, vectors):
+        vectors = np.asarray(vectors, dtype='float32').reshape(-1, self.dim)
+        if self.metric == "cosine":
+            norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+            norms[norms == 0] = 1.0
+            vectors = vectors / norms
+        return np.ascontiguousarray(vectors, dtype='float32')
+
+    def add(self, vectors):
+        """追加向量，返回新向量的行号范围"""
+        vectors = self._prepare(vectors)
+        start = self.size
+        self.storage.append(vectors)
+        return range(start, self.size)
+
+    def search(self, queries, k, exclude=None):
+        """检索每个查询的 top-k，返回按分数降序排列的 (scores, indices)，形状均为 (查询数, k)
+
+        exclude 为长度等于向量数的布尔数组，为True的行（如已删除的块）分数记为 -inf。
+        """
+        queries = self._prepare(queries)
+        k = min(k, self.size)
+        if k == 0:
+            empty = np.empty((len(queries), 0))
+            return empty.astype('float32'), empty.astype('int64')
+
+        # 单次矩阵乘法计算所有查询与所有向量的相似度
+        scores = self.storage.scores(queries)
+        if exclude is not None:
+            scores[:, exclude] = -np.inf
+        scores, indices = _top_k(scores, self._candidate_count(k))
+        return self._rerank(queries, scores, indices, k)
+
+    def _candidate_count(self, k):
+        if self.storage.lossy and self.rerank_source is not None:
+            return min(self.size, k * self.rerank_factor)
+        return k
+
+    def _rerank(self, queries, scores, indices, k):
+        """用原始精度向量重新计算候选的分数，取前k个"""
+        if self.rerank_source is None or not self.storage.lossy:
+            return scores[:, :k], indices[:, :k]
+
+        scores = scores.copy()
+        for row, query in enumerate(queries):
+            valid = (indices[row] >= 0) & np.isfinite(scores[row])
+            exact_vectors = self.rerank_source(indices[row][valid].tolist())
+            found = [i for i, vector in enumerate(exact_vectors) if vector is not None]
+            if found:
+                exact = self._prepare([exact_vectors[i] for i in found]) @ query
+                positions = np.flatnonzero(valid)[found]
+                scores[row, positions] = exact
+        order = np.argsort(-scores, axis=1)[:, :k]
+        return np.take_along_axis(scores, order, axis=1), np.take_along_axis(indices, order, axis=1)
+
+
+class IVFIndex(VectorIndex):
+    """倒排文件（IVF）近似最近邻索引，适用于几十万块以上的大型知识库
+
+    用球面k-means把向量划分到 nlist 个簇，检索时只扫描与查询最接近的 nprobe 个簇。
+    nprobe 越大召回越高、延迟越高。向量数少于 min_train_size 时退化为精确检索。
+    """
+
+    def __init__(self, dim, nlist=0, nprobe=RAG_IVF_NPROBE, min_train_size=RAG_IVF_MIN_TRAIN_SIZE,
+                 retrain_factor=4, metric="cosine", storage="float32"):
+        super().__init__(dim, metric, storage)
+        self.nlist = nlist  # 0 表示按数据量自动选择
+        self.nprobe = nprobe
+        self.min_train_size = min_train_size
+        self.retrain_factor = retrain_factor  # 数据量增长到训练时的这么多倍后重新训练
+        # 为True时 add/attach 不在调用线程中训练，只把新向量分配到现有的簇（未训练时精确检索），
+        # 由调用方在 needs_training 时另行调用 train(lock=...)
+        self.deferred_training = False
+        self.centroids = None
+        self._lists = []
+        self._trained_size = 0
+
+    @property
+    def is_trained(self):
+        return self.centroids is not None
+
+    @property
+    def needs_training(self):
+        """向量数达到首次训练的门槛，或比上次训练时增长了 retrain_factor 倍"""
+        if not self.is_trained:
+            return self.size >= self.min_train_size
+        return self.size >= self.retrain_factor * self._trained_size
+
+    def add(self, vectors):
+        vectors = self._prepare(vectors)
+        start = self.size
+        self.storage.append(vectors)
+        if self.needs_training and not self.deferred_training:
+            self.train()
+        elif self.is_trained:
+            # 增量插入：新向量只需分配到最近的簇
+            self._assign(vectors, start)
+        return range(start, self.size)
+
+    def train(self, iterations=10, seed=0, lock=None):
+        """在当前向量上训练粗量化器并重新分配所有向量，返回是否完成了训练
+
+        lock 为保护本索引的锁时，k-means 和向量分配在锁外计算：只在取样、分批复制向量和最后换上
+        新的簇中心与倒排表时短暂持有锁，训练期间照常检索和追加（追加的向量换上时按新的簇分配）。
+        """
+        lock = lock if lock is not None else contextlib.nullcontext()
+        with lock:
+            count = self.size
+            if count == 0:
+                return False
+            nlist = self.nlist or int(np.clip(4 * np.sqrt(count), 16, 4096))
+            nlist = min(nlist, count)
+            rng = np.random.default_rng(seed)
+            sample_ids = np.sort(rng.choice(count, min(count, nlist * 64), replace=False))
+            sample = np.array(self.storage.reconstruct(sample_ids), dtype='float32')
+        centroids = _kmeans(sample, nlist, iterations, rng, spherical=True)
+        assignment = np.empty(count, dtype='int64')
+        for start in range(0, count, 65536):
+            ids = np.arange(start, min(count, start + 65536))
+            with lock:
+                vectors = np.array(self.storage.reconstruct(ids), dtype='float32')
+            assignment[ids] = np.argmax(vectors @ centroids.T, axis=1)
+        with lock:
+            self.centroids = centroids
+            self._lists = [array('q') for _ in range(nlist)]
+            self._trained_size = count
+            self._fill_lists(assignment, 0)
+            # 训练期间追加的向量
+            for start in range(count, self.size, 65536):
+                ids = np.arange(start, min(self.size, start + 65536))
+                self._assign(self.storage.reconstruct(ids), start)
+        return True
+
+    def trained_state(self):
+        state = super().trained_state()
+        if self.is_trained:
+            # 每个向量所在的簇，载入时据此恢复倒排表
+            assignment = np.empty(self.size, dtype='int32')
+            for cluster, members in enumerate(self._lists):
+                assignment[np.array(members, dtype='int64')] = cluster
+            state.update(ivf_centroids=self.centroids, ivf_assignment=assignment,
+                         ivf_trained_size=np.array(self._trained_size))
+        return state
+
+    def attach(self, vectors, trained=None):
+        super().attach(vectors, trained)
+        if trained and self._load_trained(trained):
+            return
+        if self.needs_training and not self.deferred_training:
+            self.train()
+
+    def _load_trained(self, state):
+        """载入保存的簇中心和分配结果；簇数、维度或向量数与当前不一致时返回False（改为重新训练）"""
+        centroids, assignment = state.get("ivf_centroids"), state.get("ivf_assignment")
+        if (centroids is None or assignment is None or centroids.shape[1] != self.dim
+                or len(assignment) != self.size or (self.nlist and len(centroids) != self.nlist)):
+            return False
+        self.centroids = np.asarray(centroids, dtype='float32')
+        self._lists = [array('q') for _ in range(len(self.centroids))]
+        self._trained_size = int(state.get("ivf_trained_size", self.size))
+        self._fill_lists(np.asarray(assignment), 0)
+        return True
+
+    def _assign(self, vectors, start):
+        self._fill_lists(np.argmax(vectors @ self.centroids.T, axis=1), start)
+
+    def _fill_lists(self, assignment, start):
+        """把从 start 开始的一批向量按簇编号加入各簇的倒排表"""
+        order = np.argsort(assignment, kind='stable')
+        clusters, boundaries = np.unique(assignment[order], return_index=True)
+        for cluster, members in zip(clusters, np.split(order + start, boundaries[1:])):
+            self._lists[cluster].extend(members.tolist())
+
+    def search(self, queries, k, nprobe=None, exclude=None):
+        if not self.is_trained:
+            return super().search(queries, k, exclude)
+
+        queries = self._prepare(queries)
+        k = min(k, self.size)
+        candidate_count = self._candidate_count(k)
+        nprobe = min(nprobe or self.nprobe, len(self.centroids))
+        result_scores = np.full((len(queries), candidate_count), -np.inf, dtype='float32')
+        result_indices = np.full((len(queries), candidate_count), -1, dtype='int64')
+        if k == 0:
+            return result_scores, result_indices
+
+        # 先选出每个查询最接近的 nprobe 个簇
+        _, probes = _top_k(queries @ self.centroids.T, nprobe)
+        for row, query in enumerate(queries):
+            candidate_ids = np.concatenate([np.frombuffer(self._lists[cluster], dtype='int64')
+                                            for cluster in probes[row]])
+            if len(candidate_ids) == 0:
+                continue
+            candidate_scores = self.storage.scores(query[None, :], candidate_ids)
+            if exclude is not None:
+                candidate_scores[:, exclude[candidate_ids]] = -np.inf
+            scores, top = _top_k(candidate_scores, candidate_count)
+            count = top.shape[1]
+            result_scores[row, :count] = scores[0]
+            result_indices[row, :count] = candidate_ids[top[0]]
+        return self._rerank(queries, result_scores, result_indices, k)
+
+
+def create_vector_index(dim, index_type=RAG_INDEX_TYPE, storage=RAG_VECTOR_STORAGE):
+    """按配置创建向量索引：'flat'（精确）或 'ivf'（近似），storage 决定向量的压缩方式"""
+    if index_type == "ivf":
+        return IVFIndex(dim, nlist=RAG_IVF_NLIST, storage=storage)
+    return VectorIndex(dim, storage=storage)
+
+
+# 词法检索的分词：保留错误码、零件号等带连接符的标识符（同时索引其组成部分），中文按单字切分
+_LEXICAL_TOKEN_PATTERN = re.compile(r"[\u4e00-\u9fff]|[^\W\u4e00-\u9fff]+(?:[-_.:/][^\W\u4e00-\u9fff]+)*")
+_LEXICAL_PART_PATTERN = re.compile(r"[-_.:/]")
+
+
+def tokenize_lexical(text):
+    tokens = []
+    for token in _LEXICAL_TOKEN_PATTERN.findall(text.lower()):
+        tokens.append(token)
+        if len(token) > 1 and _LEXICAL_PART_PATTERN.search(token):
+            tokens.extend(part for part in _LEXICAL_PART_PATTERN.split(token) if part)
+    return tokens
+
+
+class BM25Index:
+    """BM25倒排索引，倒排表以紧凑数组保存并支持增量追加
+
+    可以从持久化的只读CSR数组（基础段）构造，之后追加的文档写入增量段，检索时两段合并计分。
+    """
+
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        # 基础段：term -> 行号，行号对应 offsets[row]:offsets[row+1] 范围内的 (doc_ids, tfs)
+        self._base_vocabulary = {}
+        self._base_offsets = np.zeros(1, dtype='int64')
+        self._base_doc_ids = np.empty(0, dtype='int32')
+        self._base_tfs = np.empty(0, dtype='int32')
+        self._base_doc_lengths = np.empty(0, dtype='int32')
+        # 增量段：term -> (array('i') doc_ids, array('i') tfs)
+        self._postings = {}
+        self._doc_lengths = array('i')
+        self._total_length = 0
+        self._all_doc_lengths = None  # 合并后的文档长度缓存，追加时失效
+
+    @classmethod
+    def from_arrays(cls, vocabulary, offsets, doc_ids, tfs, doc_lengths, k1=1.5, b=0.75):
+        """用持久化的CSR数组（可以是内存映射）构造索引，不复制数据"""
+        index = cls(k1, b)
+        index._base_vocabulary = {term: row for row, term in enumerate(vocabulary)}
+        index._base_offsets = offsets
+        index._base_doc_ids = doc_ids
+        index._base_tfs = tfs
+        index._base_doc_lengths = doc_lengths
+        index._total_length = int(np.sum(doc_lengths, dtype='int64'))
+        return index
+
+    @property
+    def size(self):
+        return len(self._base_doc_lengths) + len(self._doc_lengths)
+
+    def __len__(self):
+        return self.size
+
+    def add(self, texts):
+        for text in texts:
+            doc_id = self.size
+            term_counts = {}
+            tokens = tokenize_lexical(text)
+            for token in tokens:
+                term_counts[token] = term_counts.get(token, 0) + 1
+            for term, count in term_counts.items():
+                postings = self._postings.get(term)
+                if postings is None:
+                    postings = self._postings[term] = (array('i'), array('i'))
+                postings[0].append(doc_id)
+                postings[1].append(count)
+            self._doc_lengths.append(len(tokens))
+            self._total_length += len(tokens)
+        self._all_doc_lengths = None
+
+    def _term_postings(self, term):
+        """返回某个词在两段中的 (doc_ids, tfs)"""
+        parts = []
+        row = self._base_vocabulary.get(term)
+        if row is not None:
+            start, stop = self._base_offsets[row], self._base_offsets[row + 1]
+            parts.append((self._base_doc_ids[start:stop], self._base_tfs[start:stop]))
+        postings = self._postings.get(term)
+        if postings is not None:
+            parts.append((np.frombuffer(postings[0], dtype='int32'), np.frombuffer(postings[1], dtype='int32')))
+        if not parts:
+            return None
+        if len(parts) == 1:
+            return parts[0]
+        return np.concatenate([p[0] for p in parts]), np.concatenate([p[1] for p in parts])
+
+    def scores(self, query):
+        """计算查询对所有文档的BM25分数"""
+        doc_count = self.size
+        scores = np.zeros(doc_count, dtype='float32')
+        if doc_count == 0:
+            return scores
+        if self._all_doc_lengths is None:
+            self._all_doc_lengths = np.concatenate(
+                [self._base_doc_lengths, np.frombuffer(self._doc_lengths, dtype='int32')]).astype('float32')
+        average_length = max(self._total_length / doc_count, 1.0)
+        length_norm = self.k1 * (1 - self.b + self.b * self._all_doc_lengths / average_length)
+
+        for term in set(tokenize_lexical(query)):
+            postings = self._term_postings(term)
+            if postings is None:
+                continue
+            doc_ids, tfs = postings
+            idf = np.log(1 + (doc_count - len(doc_ids) + 0.5) / (len(doc_ids) + 0.5))
+            tfs = tfs.astype('float32')
+            scores[doc_ids] += idf * tfs * (self.k1 + 1) / (tfs + length_norm[doc_ids])
+        return scores
+
+    def search(self, query, k, exclude=None):
+        """返回按分数降序排列的 (scores, indices)，只包含至少命中一个词的文档（exclude 同 VectorIndex.search）"""
+        scores = self.scores(query)
+        if exclude is not None:
+            scores[exclude] = 0
+        matched = np.flatnonzero(scores > 0)
+        if len(matched) == 0:
+            return np.empty(0, dtype='float32'), np.empty(0, dtype='int64')
+        top_scores, top = _top_k(scores[matched][None, :], k)
+        return top_scores[0], matched[top[0]]
+
+    def to_arrays(self):
+        """把两段合并导出为CSR数组，用于持久化"""
+        vocabulary = sorted(set(self._base_vocabulary) | set(self._postings))
+        offsets = np.zeros(len(vocabulary) + 1, dtype='int64')
+        doc_id_parts, tf_parts = [], []
+        for row, term in enumerate(vocabulary):
+            doc_ids, tfs = self._term_postings(term)
+            doc_id_parts.append(doc_ids)
+            tf_parts.append(tfs)
+            offsets[row + 1] = offsets[row] + len(doc_ids)
+        return {
+            "vocabulary": vocabulary,
+            "offsets": offsets,
+            "doc_ids": np.concatenate(doc_id_parts).astype('int32') if doc_id_parts else np.empty(0, dtype='int32'),
+            "tfs": np.concatenate(tf_parts).astype('int32') if tf_parts else np.empty(0, dtype='int32'),
+            "doc_lengths": np.concatenate([self._base_doc_lengths,
+                                           np.frombuffer(self._doc_lengths, dtype='int32')]).astype('int32'),
+        }
+
+
+def reciprocal_rank_fusion(rankings, k, rrf_k=60):
+    """倒数排名融合：每个结果的分数为其在各排名中 1/(rrf_k + 名次) 之和"""
+    fused = {}
+    for ranking in rankings:
+        for rank, idx in enumerate(ranking):
+            fused[idx] = fused.get(idx, 0.0) + 1.0 / (rrf_k + rank + 1)
+    return sorted(fused.items(), key=lambda item: -item[1])[:k]
 
 
 class RAGManager:
-    def __init__(self, api_client=None):
+    def __init__(self, api_client=None, embedding_cache=None, index_dir=None, vector_store=None):
         if api_client is None:
             self.client = OpenAI(
                 api_key=GEMINI_API_KEY,
@@ -19,101 +793,901 @@ class RAGManager:
         self.documents = []
         self.document_metadata = []
         self.vector_index = None
-        self.embeddings_array = None  # 存储嵌入向量
-        self.enabled = False
+        self.lexical_index = BM25Index()  # 与向量索引并行维护的关键词索引
+        # 已入库块的SimHash指纹，用于在嵌入之前跳过近似重复的块
+        self.duplicate_index = SimHashIndex() if RAG_DEDUP_ENABLED else None
+        self.skipped_duplicates = 0
+        self.saved_embedding_requests = 0
+        # 文档登记表：文档名 -> {"content_hash", "positions", "shared"}，positions 为该文档使用的块位置
+        # （包括与其他文档共用的重复块），shared 为共用块在本文档中的元数据；
+        # 删除的块先记为墓碑，积累到一定比例后再压缩
+        self.document_registry = {}
+        self._deleted_positions = set()
+        self._exclude_mask = None
+        # 后台入库线程和所有会话的页面脚本共享本对象：修改索引时持有写锁，检索时持有读锁
+        # （各会话的检索可以同时进行）
+        self._lock = _ReadWriteLock()
+        self._active_ingests = 0
+        self._training_index = False
+        self.search_mode = RAG_SEARCH_MODE
         self.embedding_dim = GEMINI_EMBEDDING_DIM  # Gemini嵌入模型的维度
         self.embedding_model = GEMINI_EMBEDDING_MODEL  # Gemini的嵌入模型
+        self.batch_size = RAG_EMBEDDING_BATCH_SIZE
+        self.batch_token_budget = RAG_EMBEDDING_BATCH_TOKENS
+        self.max_workers = RAG_EMBEDDING_WORKERS
+        self.max_retries = RAG_EMBEDDING_MAX_RETRIES
+        # 跨会话、跨重启共享的嵌入缓存
+        self.embedding_cache = embedding_cache if embedding_cache is not None else get_embedding_cache()
+        # 持久化目录：设置后每次修改知识库都会写入磁盘（新块写成追加段，删除记入日志）
+        self.index_dir = index_dir
+        self._writer = None
+        # 外部向量存储（如 PgVectorStore）：设置后块和向量保存在数据库中，检索在服务器端完成
+        self.vector_store = vector_store
+        # 外部存储最近一次读到的 (版本号, 块数)：同一张表也会被其他进程修改，检索前从数据库刷新
+        self._store_state = (None, 0)
+        # 检索结果缓存：索引每次变化（添加、清空、重建）时整体失效
+        self.index_version = 0
+        self._result_cache = (LRUCache(max_entries=RAG_RESULT_CACHE_SIZE, ttl=RAG_RESULT_CACHE_TTL_SECONDS)
+                              if RAG_RESULT_CACHE_TTL_SECONDS else None)
+
+    def add_document(self, content, metadata, progress=None, notify=None):
+        """分块并嵌入文档，返回该文档在知识库中的块数（包括与已有内容重复而共用的块）
+
+        content 可以是字符串，也可以是 (文本, 段元数据) 的可迭代对象（如逐页产出的PDF文本，
+        段元数据中的 page/slide/sheet 会写入每个块的元数据）。块按窗口流式嵌入并写入索引，
+        入库过程的内存占用与文档大小无关。
+
+        metadata 中的 name 和 content_hash 标识文档：内容未变的同名文档直接跳过；
+        内容变化时新版本入库成功后再删除旧版本。
+
+        progress(已处理块数, 已入库块数) 在每个窗口之后调用；notify(级别, 消息) 用于报告警告，
+        默认显示在Streamlit页面上（后台线程中调用时应传入自己的实现）。任一回调抛出异常都会
+        中止入库，已写入的块会被撤销。
+        """
+        notify = notify or _streamlit_notify
+        document_name = metadata.get("name", "document")
+        content_hash = metadata.get("content_hash")
+        previous = self._find_document(document_name)
+        if previous is not None and content_hash and previous["content_hash"] == content_hash:
+            notify("info", f"{document_name} is already in the knowledge base and has not changed.")
+            return previous["chunks"]
+
+        sections = [(content, {})] if isinstance(content, str) else content
+        chunks = enumerate(iter_chunks(sections))
+        chunk_count, embedded_count, indexed_count = 0, 0, 0
+        duplicate_texts, positions, owned_positions = [], [], []
+        shared = {}  # 与其他文档共用的已有块位置 -> 本文档中该块的元数据（原文档删除后改用它）
+        # 本次入库已保留的块的指纹：同一文档内的近似重复块直接跳过
+        ingest_index = SimHashIndex(self.duplicate_index.max_distance) if self.duplicate_index is not None else None
+        # 替换旧版本时不共用旧版本的块：新版本的块带着自己的元数据重新入库，旧版本随后整体删除
+        replaced_positions = set(previous.get("positions", ())) if previous is not None else set()
+        with self._lock:
+            self._active_ingests += 1  # 入库期间推迟压缩，保证记录的块位置不变
+        try:
+            while True:
+                window = [(chunk_id, chunk, section_metadata)
+                          for chunk_id, (chunk, section_metadata) in islice(chunks, RAG_INGEST_WINDOW)]
+                if not window:
+                    break
+                chunk_count += len(window)
+                fingerprints = None
+                if self.duplicate_index is not None:
+                    with self._lock:
+                        window, fingerprints, duplicates, shared_chunks = self._drop_duplicates(
+                            window, ingest_index, replaced_positions)
+                    duplicate_texts.extend(duplicates)
+                    for position, (chunk_id, _, section_metadata) in shared_chunks:
+                        positions.append(position)
+                        shared.setdefault(position, _chunk_metadata(metadata, chunk_id, section_metadata))
+                embedded_count += len(window)
+                # 只为新块生成嵌入，已有块的向量保持不变
+                new_embeddings = self.embed_batch([chunk for _, chunk, _ in window])
+                indexed_chunks, indexed_metadata, indexed_embeddings, indexed_fingerprints = [], [], [], []
+                for position, ((chunk_id, chunk, section_metadata), embedding) in enumerate(
+                        zip(window, new_embeddings)):
+                    if embedding is None:
+                        continue  # 嵌入失败的块不进入索引
+                    indexed_chunks.append(chunk)
+                    indexed_metadata.append(_chunk_metadata(metadata, chunk_id, section_metadata))
+                    indexed_embeddings.append(embedding)
+                    if fingerprints is not None:
+                        indexed_fingerprints.append(fingerprints[position])
+                window_positions = self._index_chunks(indexed_chunks, indexed_metadata, indexed_embeddings,
+                                                      indexed_fingerprints)
+                owned_positions.extend(window_positions)
+                indexed_count += len(window_positions)
+                self._train_vector_index()
+                if progress is not None:
+                    progress(chunk_count, indexed_count)
+        except BaseException:
+            # 入库中止（取消或出错）：撤销本次已写入的块，知识库保持原样
+            self._discard_partial(document_name, previous, owned_positions)
+            raise
+        finally:
+            with self._lock:
+                self._active_ingests -= 1
+
+        failed_count = embedded_count - indexed_count
+        if failed_count:
+            notify("error", f"Failed to embed {failed_count} of {embedded_count} chunks from "
+                            f"{document_name}; they were not added to the knowledge base.")
+        if duplicate_texts:
+            saved_requests = self._count_embedding_requests(duplicate_texts)
+            self.skipped_duplicates += len(duplicate_texts)
+            self.saved_embedding_requests += saved_requests
+            notify("info", f"Skipped {len(duplicate_texts)} of {chunk_count} chunks from {document_name} as "
+                           f"duplicates of existing content (saved {saved_requests} embedding requests).")
+
+        if self.vector_store is not None:
+            if indexed_count and previous is not None:
+                # 新版本已写入，删除同名文档的旧版本
+                self.vector_store.delete_document(document_name, keep_hash=content_hash)
+                self._invalidate_results()
+            return indexed_count
+
+        positions.extend(owned_positions)
+        if not positions:
+            return 0
+        with self._lock:
+            entry = {"content_hash": content_hash, "positions": array('q', sorted(set(positions))), "shared": shared}
+            # 入库期间被其他操作删除、但仍被本文档共用的块恢复为有效
+            restored = sorted(self._deleted_positions.intersection(positions))
+            self._deleted_positions.difference_update(positions)
+            self._exclude_mask = None
+            replaced = self.document_registry.get(document_name)
+            self.document_registry[document_name] = entry
+            released, reassigned = [], {}
+            if replaced is not None:
+                released = self._release_positions(replaced["positions"])
+                reassigned = self._reassign_shared(document_name, replaced["positions"])
+            self._invalidate_results()
+            self._persist(record={"op": "document", "name": document_name, "content_hash": content_hash,
+                                  "positions": entry["positions"].tolist(), "shared": shared,
+                                  "metadata": reassigned, "deleted": released, "restored": restored})
+            self._maybe_compact()
+            chunk_total = len(self.document_registry[document_name]["positions"])
+        self._train_vector_index()  # 压缩后的新索引
+        self._flush_writes()
+        return chunk_total
+
+    def _discard_partial(self, document_name, previous, owned_positions):
+        """撤销一次未完成的入库写入的块"""
+        if self.vector_store is not None:
+            if previous is not None:
+                self.vector_store.delete_document(document_name, keep_hash=previous["content_hash"])
+            else:
+                self.vector_store.delete_document(document_name)
+            self._invalidate_results()
+            return
+        if owned_positions:
+            with self._lock:
+                self._deleted_positions.update(owned_positions)
+                self._exclude_mask = None
+                self._invalidate_results()
+                self._persist(record={"op": "deleted", "deleted": list(owned_positions)})
+                self._maybe_compact()
+
+    def _drop_duplicates(self, window, ingest_index, exclude=()):
+        """去掉重复的块，返回 (保留的块, 指纹, 重复块的文本, [(被共用的已有块位置, 块)])
 
-    def add_document(self, text, metadata):
-        # 文本分块
-        chunks = self._chunk_text(text)
-        for i, chunk in enumerate(chunks):
-            self.documents.append(chunk)
-            chunk_metadata = metadata.copy()
-            chunk_metadata["chunk_id"] = i  # 为每个块添加块ID元数据
-            self.document_metadata.append(chunk_metadata)
-        # 重建索引
-        self._build_index()
-
-    def _chunk_text(self, text, chunk_size=1000, overlap=200):
-        # 简单的文本分块 (按词分块)
-        words = text.split()
-        chunks = []
-        for i in range(0, len(words), chunk_size - overlap):
-            chunk = " ".join(words[i:i + chunk_size])
-            chunks.append(chunk)
-        return chunks if chunks else [text]  # 确保至少有一个块
+        只有同一次入库（同一文档的同一版本）内才按SimHash汉明距离跳过近似重复的块；与知识库中
+        其他文档的块只有文本完全相同时才共用，近似但不相同的块（如只改了一个数字）照常入库，
+        否则检索会返回另一个文档中过时的文本。exclude 中的块位置（被替换的旧版本）不参与比较。
+        """
+        kept, fingerprints, duplicates, shared_chunks = [], [], [], []
+        for entry in window:
+            fingerprint = simhash(entry[1])
+            if ingest_index.find(fingerprint) >= 0:
+                duplicates.append(entry[1])
+                continue
+            match = self._find_identical(fingerprint, entry[1], exclude)
+            if match >= 0:
+                duplicates.append(entry[1])
+                shared_chunks.append((match, entry))
+                continue
+            ingest_index.add([fingerprint])
+            kept.append(entry)
+            fingerprints.append(fingerprint)
+        return kept, fingerprints, duplicates, shared_chunks
+
+    def _find_identical(self, fingerprint, text, exclude=()):
+        """返回知识库中文本与 text 完全相同的有效块位置（跳过 exclude 中的位置），没有时返回-1"""
+        for candidate in self.duplicate_index.matches(fingerprint, max_distance=0):
+            if candidate in self._deleted_positions or candidate in exclude:
+                continue
+            if self.documents[candidate] == text:
+                return candidate
+        return -1
+
+    def _count_embedding_requests(self, texts):
+        """估算嵌入这些文本需要的API请求数（缓存命中的文本不需要请求）"""
+        if self.embedding_cache is not None:
+            cached = self.embedding_cache.get_many(texts, record_stats=False)
+            texts = [text for text, embedding in zip(texts, cached) if embedding is None]
+        return len(self._plan_batches(texts, self.batch_size, self.batch_token_budget))
+
+    def _index_chunks(self, chunks, metadata, embeddings, fingerprints):
+        """把一个窗口的块写入向量存储或内存索引，返回写入的块位置"""
+        if not embeddings:
+            return range(0)
+        if self.vector_store is not None:
+            # 数据库中的行没有与指纹对应的位置，只做同一次上传内的去重
+            stored_count = self.vector_store.add(chunks, metadata, embeddings)
+            self._invalidate_results()
+            return range(stored_count)
+
+        with self._lock:
+            start = len(self.documents)
+            self.documents.extend(chunks)
+            self.document_metadata.extend(metadata)
+            # 增量更新向量索引和关键词索引
+            vectors = self._append_to_index(embeddings)
+            self.lexical_index.add(chunks)
+            if self.duplicate_index is not None:
+                self.duplicate_index.add(fingerprints)
+            # 新块写成一个追加段（在写入线程中完成，不占用锁）
+            self._persist(segment=(list(chunks), list(metadata), vectors,
+                                   fingerprints if self.duplicate_index is not None else None))
+            return range(start, start + len(embeddings))
+
+    def _find_document(self, name):
+        """返回已入库文档的 {"content_hash", "chunks"[, "positions"]}，不存在时返回None"""
+        if self.vector_store is not None:
+            for document in self.vector_store.list_documents():
+                if document["name"] == name:
+                    return document
+            return None
+        entry = self.document_registry.get(name)
+        if entry is None:
+            return None
+        return {"content_hash": entry["content_hash"], "chunks": len(entry["positions"]),
+                "positions": entry["positions"]}
+
+    def list_documents(self):
+        """列出知识库中的文档：[{"name", "content_hash", "chunks"}]"""
+        if self.vector_store is not None:
+            return self.vector_store.list_documents()
+        return [{"name": name, "content_hash": entry["content_hash"], "chunks": len(entry["positions"])}
+                for name, entry in sorted(self.document_registry.items())]
+
+    def remove_document(self, name):
+        """从知识库中删除一个文档，返回实际删除的块数（仍被其他文档共用的块会保留）"""
+        if self.vector_store is not None:
+            removed = self.vector_store.delete_document(name)
+            self._invalidate_results()
+            return removed
+        with self._lock:
+            entry = self.document_registry.pop(name, None)
+            if entry is None:
+                return 0
+            released = self._release_positions(entry["positions"])
+            reassigned = self._reassign_shared(name, entry["positions"])
+            self._persist(record={"op": "remove", "name": name, "deleted": released, "metadata": reassigned})
+            self._maybe_compact()
+        self._train_vector_index()
+        self._flush_writes()
+        return len(released)
+
+    def _release_positions(self, positions):
+        """把不再被任何文档使用的块记为墓碑（只标记，不移动数据），返回标记的块位置列表"""
+        positions = np.frombuffer(positions, dtype='int64')
+        in_use = [np.frombuffer(entry["positions"], dtype='int64') for entry in self.document_registry.values()]
+        if in_use:
+            positions = positions[~np.isin(positions, np.concatenate(in_use))]
+        released = positions.tolist()
+        self._deleted_positions.update(released)
+        self._exclude_mask = None
+        self._invalidate_results()
+        return released
+
+    def _reassign_shared(self, name, positions):
+        """文档 name 的块仍被其他文档共用时，改用共用文档记录的元数据（文档名、页码等）
+
+        返回 {位置: 新的元数据}，写入日志以便载入时重放。
+        """
+        reassigned = {}
+        for position in positions:
+            if position in self._deleted_positions or self.document_metadata[position].get("name") != name:
+                continue
+            for entry in self.document_registry.values():
+                chunk_metadata = entry["shared"].get(position)
+                if chunk_metadata is not None:
+                    self.document_metadata[position] = chunk_metadata
+                    reassigned[position] = chunk_metadata
+                    break
+        return reassigned
+
+    def _deleted_mask(self):
+        """已删除块的布尔掩码（供检索时排除），没有墓碑时返回None
+
+        检索在读锁内并发调用：几个检索同时重建掩码时结果相同，只是重复计算一次。
+        """
+        if not self._deleted_positions:
+            return None
+        if self._exclude_mask is None or len(self._exclude_mask) != len(self.documents):
+            mask = np.zeros(len(self.documents), dtype=bool)
+            mask[np.fromiter(self._deleted_positions, dtype='int64', count=len(self._deleted_positions))] = True
+            self._exclude_mask = mask
+        return self._exclude_mask
+
+    def _maybe_compact(self):
+        if self._active_ingests:
+            return
+        if len(self._deleted_positions) > RAG_COMPACT_DELETED_RATIO * len(self.documents):
+            self.compact()
+
+    def compact(self):
+        """物理移除墓碑块并重新编号；向量从现有索引导出，不重新嵌入
+
+        有文档正在入库时不压缩：入库任务记录的块位置在它结束之前必须保持不变。
+        """
+        with self._lock:
+            if self.vector_store is not None or not self._deleted_positions or self._active_ingests:
+                return
+            keep_ids = np.flatnonzero(~self._deleted_mask())
+            remap = np.full(len(self.documents), -1, dtype='int64')
+            remap[keep_ids] = np.arange(len(keep_ids))
+
+            vector_index = None
+            if len(keep_ids):
+                vector_index = self._new_vector_index()
+                for start in range(0, len(keep_ids), 65536):
+                    vector_index.add(self._vectors_for(keep_ids[start:start + 65536]))
+            documents = [self.documents[i] for i in keep_ids]
+            document_metadata = [self.document_metadata[i] for i in keep_ids]
+            lexical_index = BM25Index()
+            lexical_index.add(documents)
+            duplicate_index = self.duplicate_index.subset(keep_ids) if self.duplicate_index is not None else None
+            for entry in self.document_registry.values():
+                positions = remap[np.frombuffer(entry["positions"], dtype='int64')]
+                entry["positions"] = array('q', positions[positions >= 0].tolist())
+                entry["shared"] = {int(remap[position]): chunk_metadata
+                                   for position, chunk_metadata in entry["shared"].items() if remap[position] >= 0}
+
+            self.documents = documents
+            self.document_metadata = document_metadata
+            self.vector_index = vector_index
+            self.lexical_index = lexical_index
+            self.duplicate_index = duplicate_index
+            self._deleted_positions = set()
+            self._exclude_mask = None
+            self._invalidate_results()
+            # 位置已重新编号，之前的追加段和日志不再适用，整体重写为新的一代
+            self._rewrite()
 
     def _get_embedding(self, text):
-        """使用Gemini API获取嵌入向量"""
+        """使用Gemini API获取嵌入向量（优先查缓存），失败时返回None"""
+        if self.embedding_cache is not None:
+            cached = self.embedding_cache.get(text)
+            if cached is not None:
+                return cached
         try:
-            response = self.client.embeddings.create(
+            response = self._call_with_retry(lambda: self.client.embeddings.create(
                 input=text,
                 model=self.embedding_model
-            )
-            return response.data[0].embedding
+            ))
+            embedding = response.data[0].embedding
+            if self.embedding_cache is not None:
+                self.embedding_cache.put(text, embedding)
+            return embedding
         except Exception as e:
             st.error(f"Error getting embedding: {e}")  # 获取嵌入时出错
-            # 返回一个全零向量作为后备
-            return [0.0] * self.embedding_dim
+            return None
 
-    def _build_index(self):
-        if not self.documents:
-            self.vector_index = None
-            self.embeddings_array = None
-            return
+    def embed_batch(self, texts, batch_size=None, max_batch_tokens=None):
+        """将多个文本打包成批次并发请求嵌入，按输入顺序返回向量（失败的位置为None）"""
+        if self.embedding_cache is not None:
+            # 先查缓存，只为未命中的文本发送请求
+            embeddings = self.embedding_cache.get_many(texts)
+            missing = [position for position, embedding in enumerate(embeddings) if embedding is None]
+            if missing:
+                missing_texts = [texts[position] for position in missing]
+                fetched = self._embed_uncached(missing_texts, batch_size, max_batch_tokens)
+                self.embedding_cache.put_many(missing_texts, fetched)
+                for position, embedding in zip(missing, fetched):
+                    embeddings[position] = embedding
+            return embeddings
+        return self._embed_uncached(texts, batch_size, max_batch_tokens)
 
-        # 生成文档向量
-        embeddings = []
-        for doc_text in self.documents:
-            # 对每个文档生成嵌入
-            embedding = self._get_embedding(doc_text)
-            embeddings.append(embedding)
+    def _embed_uncached(self, texts, batch_size=None, max_batch_tokens=None):
+        """直接调用API批量嵌入文本"""
+        batches = self._plan_batches(texts,
+                                     batch_size or self.batch_size,
+                                     max_batch_tokens or self.batch_token_budget)
+        if len(batches) > 1 and self.max_workers > 1:
+            # 在线程池中并发发送批次请求，进程级信号量限制同时在途的请求数
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(batches))) as executor:
+                batch_results = list(executor.map(lambda batch: self._embed_request(texts, batch), batches))
+        else:
+            batch_results = [self._embed_request(texts, batch) for batch in batches]
 
-        self.embeddings_array = np.array(embeddings).astype('float32')
+        embeddings = [None] * len(texts)
+        for batch, batch_embeddings in zip(batches, batch_results):
+            for position, embedding in zip(batch, batch_embeddings):
+                embeddings[position] = embedding
+        return embeddings
 
-        # 使用scikit-learn的NearestNeighbors替代FAISS
-        self.vector_index = NearestNeighbors(n_neighbors=min(5, len(self.documents)), 
-                                             algorithm='brute', 
-                                             metric='euclidean')
-        self.vector_index.fit(self.embeddings_array)
+    def _plan_batches(self, texts, batch_size, max_batch_tokens):
+        """按数量上限和token预算把文本位置划分为批次"""
+        batches = []
+        current, current_tokens = [], 0
+        for position, text in enumerate(texts):
+            tokens = estimate_tokens(text)
+            if current and (len(current) >= batch_size or current_tokens + tokens > max_batch_tokens):
+                batches.append(current)
+                current, current_tokens = [], 0
+            current.append(position)
+            current_tokens += tokens
+        if current:
+            batches.append(current)
+        return batches
 
-    def search(self, query, top_k=3):
-        if not self.vector_index or not self.enabled:
-            return []
+    def _embed_request(self, texts, batch):
+        """发送一个批次的嵌入请求；请求过大被拒绝时对半拆分重试
+
+        在工作线程中运行，因此只打印错误，由调用方在主线程中汇报失败的块。
+        """
+        try:
+            response = self._call_with_retry(lambda: self.client.embeddings.create(
+                input=[texts[position] for position in batch],
+                model=self.embedding_model
+            ))
+            # 按返回的index映射回批次内的顺序
+            ordered = [None] * len(batch)
+            for offset, item in enumerate(response.data):
+                index = getattr(item, "index", None)
+                ordered[offset if index is None else index] = item.embedding
+            return ordered
+        except BadRequestError as e:
+            if len(batch) > 1:
+                middle = len(batch) // 2
+                return self._embed_request(texts, batch[:middle]) + self._embed_request(texts, batch[middle:])
+            print(f"Embedding request rejected: {e}")
+            return [None]
+        except Exception as e:
+            print(f"Error getting embeddings for batch of {len(batch)} chunks: {e}")
+            return [None] * len(batch)
+
+    def _call_with_retry(self, request):
+        """在并发上限内执行请求，遇到限流或临时错误时按指数退避重试"""
+        for attempt in range(self.max_retries + 1):
+            try:
+                with _embedding_request_slots:
+                    return request()
+            except _RETRYABLE_EMBEDDING_ERRORS as e:
+                if attempt == self.max_retries:
+                    raise
+                # 带随机抖动的指数退避，等待期间不占用并发名额
+                delay = min(RAG_EMBEDDING_BACKOFF_MAX_SECONDS, RAG_EMBEDDING_BACKOFF_SECONDS * (2 ** attempt))
+                delay *= random.uniform(0.5, 1.0)
+                print(f"Embedding request failed ({type(e).__name__}), retrying in {delay:.1f}s")
+                time.sleep(delay)
 
-        # 编码查询
-        query_vector = np.array([self._get_embedding(query)]).astype('float32')
+    def _append_to_index(self, embeddings):
+        """将新向量追加到索引（就地更新，不重新嵌入已有块），返回归一化后的新向量"""
+        new_vectors = np.asarray(embeddings, dtype='float32').reshape(-1, self.embedding_dim)
+        if len(new_vectors) == 0:
+            return new_vectors
+
+        if self.vector_index is None:
+            self.vector_index = self._new_vector_index()
+        new_vectors = self.vector_index._prepare(new_vectors)
+        self.vector_index.add(new_vectors)
+        self._invalidate_results()
+        return new_vectors
+
+    def _new_vector_index(self):
+        vector_index = create_vector_index(self.embedding_dim)
+        vector_index.rerank_source = self._exact_vectors
+        if isinstance(vector_index, IVFIndex):
+            # 训练在 _train_vector_index 中进行，不在修改索引的锁内
+            vector_index.deferred_training = True
+        return vector_index
+
+    def _train_vector_index(self):
+        """IVF索引需要（重新）训练时在锁外训练，完成后换上新的簇（在索引锁外调用）
+
+        训练只在取样、分批复制向量和换上结果时短暂持有锁，期间其他会话照常检索、入库线程照常写入。
+        同一时间只有一个线程训练；训练期间索引被压缩、清空或重建替换掉时，结果随旧索引一起丢弃。
+        """
+        with self._lock:
+            vector_index = self.vector_index
+            if (self._training_index or not isinstance(vector_index, IVFIndex)
+                    or not vector_index.needs_training):
+                return
+            self._training_index = True
+        trained = False
+        try:
+            trained = vector_index.train(lock=self._lock)
+        finally:
+            with self._lock:
+                self._training_index = False
+                if trained and self.vector_index is vector_index:
+                    self._invalidate_results()
+
+    @property
+    def embeddings_array(self):
+        """归一化后的嵌入矩阵（vector_index 内部矩阵的视图）；压缩存储模式下为None"""
+        return None if self.vector_index is None else self.vector_index.vectors
+
+    def _exact_vectors(self, indices, documents=None):
+        """为压缩索引的精确重排提供原始向量：从持久化嵌入缓存按块文本读取"""
+        if self.embedding_cache is None:
+            return [None] * len(indices)
+        documents = self.documents if documents is None else documents
+        return self.embedding_cache.get_many([documents[i] for i in indices], record_stats=False)
+
+    def rebuild_index(self):
+        """维护操作：为所有文档块重新生成嵌入并完整重建索引；有文档正在入库时不执行，返回False"""
+        with self._lock:
+            if self._active_ingests:
+                st.error("Rebuild skipped: documents are still being added to the knowledge base.")
+                return False
+            self.compact()
+            documents, count = self.documents, len(self.documents)
+            if not count:
+                self.vector_index = None
+                self._invalidate_results()
+                return True
+
+        # 批量生成文档向量（在锁外调用API）；有块嵌入失败时保留原索引，避免索引与文档错位
+        embeddings = self.embed_batch([documents[i] for i in range(count)])
+        failed_count = sum(1 for embedding in embeddings if embedding is None)
+        if failed_count:
+            st.error(f"Rebuild aborted: failed to embed {failed_count} of {count} chunks.")
+            return False
+
+        with self._lock:
+            if self.documents is not documents or len(self.documents) != count:
+                # 嵌入期间有新块写入，或知识库被清空、压缩，新向量与块的位置对不上
+                st.error("Rebuild aborted: the knowledge base changed during the rebuild; please try again.")
+                return False
+            self.vector_index = None
+            self._append_to_index(embeddings)
+        self._train_vector_index()
+        self.persist()
+        return True
+
+    def _invalidate_results(self):
+        """索引发生变化，丢弃所有缓存的检索结果"""
+        self.index_version += 1
+        if self._result_cache is not None:
+            self._result_cache.clear()
+
+    def _get_query_embedding(self, query):
+        """获取查询向量，重复的查询直接命中内存缓存而不调用API"""
+        cache_key = (self.embedding_model, query)
+        query_embedding = _query_vector_cache.get(cache_key)
+        if query_embedding is None:
+            query_embedding = self._get_embedding(query)
+            if query_embedding is not None:
+                _query_vector_cache.set(cache_key, query_embedding)
+        return query_embedding
+
+    def search(self, query, top_k=3, mode=None):
+        """检索知识库；mode 为 "vector"、"lexical" 或 "hybrid"（默认取 self.search_mode）"""
+        version, chunk_count = self._index_state()
+        if chunk_count == 0:
+            return []
+        mode = mode or self.search_mode
+        if self.vector_store is not None:
+            mode = "vector"  # 关键词索引只为内存索引维护
+        elif self.vector_index is None:
+            return []
 
         # 限制返回结果数量不超过文档总数
-        actual_k = min(top_k, len(self.documents))
+        actual_k = min(top_k, chunk_count)
         if actual_k == 0:
             return []
-            
-        # 搜索最近的向量
-        distances, indices = self.vector_index.kneighbors(query_vector, n_neighbors=actual_k)
 
+        # 相同查询在索引未变化时直接返回缓存结果
+        result_key = (version, mode, query, actual_k)
+        if self._result_cache is not None:
+            cached_results = self._result_cache.get(result_key)
+            if cached_results is not None:
+                return list(cached_results)
+
+        cacheable = True
+        query_embedding = None
+        if mode != "lexical":
+            # 编码查询（在锁外调用API，不阻塞后台入库）
+            query_embedding = self._get_query_embedding(query)
+            if query_embedding is None:
+                # 嵌入API不可用时退回关键词检索（不缓存，API恢复后重新走向量检索）
+                if self.vector_store is not None:
+                    return []
+                mode, cacheable = "lexical", False
+
+        if self.vector_store is not None:
+            # 在数据库服务器端完成 top-k 检索
+            results = self.vector_store.search(query_embedding, actual_k)
+        else:
+            with self._lock.read():
+                results = self._search_index(query, query_embedding, actual_k, mode)
+
+        if cacheable and self._result_cache is not None:
+            self._result_cache.set(result_key, results)
+        return list(results)
+
+    def _search_index(self, query, query_embedding, k, mode):
+        exclude = self._deleted_mask()
+        if mode == "lexical":
+            # 快速路径：只查关键词索引，不调用嵌入API
+            return self._build_results(*self.lexical_index.search(query, k, exclude=exclude))
+        if mode == "vector":
+            # 搜索最相似的向量（score 为余弦相似度，越大越相关）
+            scores, indices = self.vector_index.search(query_embedding, k, exclude=exclude)
+            return self._build_results(scores[0], indices[0])
+
+        # 混合检索：向量和关键词各取候选，按倒数排名融合（score 为融合分数）
+        candidate_k = max(k, RAG_HYBRID_CANDIDATES)
+        vector_scores, vector_indices = self.vector_index.search(query_embedding, candidate_k, exclude=exclude)
+        _, lexical_indices = self.lexical_index.search(query, candidate_k, exclude=exclude)
+        vector_ranking = [int(idx) for idx, score in zip(vector_indices[0], vector_scores[0])
+                          if idx >= 0 and np.isfinite(score)]
+        fused = reciprocal_rank_fusion([vector_ranking, lexical_indices.tolist()], k)
+        return self._build_results([score for _, score in fused], [idx for idx, _ in fused])
+
+    def _build_results(self, scores, indices):
         results = []
-        for i, idx in enumerate(indices[0]):
-            if idx >= 0 and idx < len(self.documents):  # 检查索引边界
+        for score, idx in zip(scores, indices):
+            if 0 <= idx < len(self.documents) and np.isfinite(score):  # 检查索引边界，跳过已删除的块
                 results.append({
                     "text": self.documents[idx],
                     "metadata": self.document_metadata[idx],
-                    "score": float(distances[0][i])
+                    "score": float(score)
                 })
         return results
 
-    def toggle_rag(self, enabled):
-        self.enabled = enabled
-
     def clear(self):
-        self.documents = []
-        self.document_metadata = []
-        self.vector_index = None
-        self.embeddings_array = None
+        """清空知识库；有文档正在入库时（可能是其他会话提交的）不清空，返回False"""
+        with self._lock:
+            if self._active_ingests:
+                return False
+            self.documents = []
+            self.document_metadata = []
+            self.vector_index = None
+            self.lexical_index = BM25Index()
+            if self.duplicate_index is not None:
+                self.duplicate_index = SimHashIndex()
+            self.document_registry = {}
+            self._deleted_positions = set()
+            self._exclude_mask = None
+            if self.vector_store is not None:
+                self.vector_store.clear()
+            self._invalidate_results()
+            self._rewrite()
+        self._flush_writes()
+        return True
+
+    def load_persisted(self):
+        """从持久化目录载入当前一代索引及其追加段和修改日志（基础部分按内存映射载入）"""
+        if self.vector_store is not None:
+            # 数据已在数据库中，只需刷新版本号和块数
+            return self._chunk_count() > 0
+        if not self.index_dir:
+            return False
+        generation = current_generation(self.index_dir)
+        if generation is None:
+            return False
+        try:
+            snapshot = load_index(self.index_dir, generation)
+        except Exception as e:
+            print(f"Failed to load persisted RAG index: {e}")
+            return False
+        if snapshot.embedding_model != self.embedding_model or snapshot.embedding_dim != self.embedding_dim:
+            print("Persisted RAG index was built with a different embedding model; ignoring it.")
+            return False
+
+        with self._lock:
+            # 内存映射的块文本只读，之后新增的块追加在覆盖层中
+            self.documents = OverlayList(snapshot.texts)
+            self.document_metadata = list(snapshot.metadata)
+            self.vector_index = None
+            if len(snapshot):
+                self.vector_index = self._new_vector_index()
+                self.vector_index.attach(snapshot.vectors, trained=snapshot.trained)
+            if snapshot.lexical is not None:
+                self.lexical_index = BM25Index.from_arrays(**snapshot.lexical)
+            else:
+                self.lexical_index = BM25Index()
+                self.lexical_index.add(snapshot.texts)
+            if self.duplicate_index is not None:
+                if snapshot.fingerprints is not None:
+                    self.duplicate_index = SimHashIndex.from_arrays(**snapshot.fingerprints)
+                else:
+                    self.duplicate_index = SimHashIndex()
+                    self.duplicate_index.add(simhash(text) for text in snapshot.texts)
+            # 上一次整体写入之后追加的块
+            for segment in snapshot.segments:
+                self.documents.extend(segment.texts)
+                self.document_metadata.extend(segment.metadata)
+                self._append_to_index(segment.vectors)
+                self.lexical_index.add(segment.texts)
+                if self.duplicate_index is not None:
+                    self.duplicate_index.add(segment.fingerprints.tolist() if segment.fingerprints is not None
+                                             else [simhash(text) for text in segment.texts])
+            # 共用块的原文档被删除后改用的元数据
+            for position, chunk_metadata in snapshot.metadata_updates.items():
+                if position < len(self.document_metadata):
+                    self.document_metadata[position] = chunk_metadata
+            self._deleted_positions = {position for position in snapshot.deleted.tolist()
+                                       if position < len(self.documents)}
+            self._exclude_mask = None
+            if snapshot.documents is not None:
+                self.document_registry = {
+                    name: {"content_hash": entry["content_hash"], "positions": array('q', entry["positions"]),
+                           "shared": {int(position): chunk_metadata
+                                      for position, chunk_metadata in entry.get("shared", {}).items()}}
+                    for name, entry in snapshot.documents.items()
+                }
+            else:
+                # 旧版本索引没有登记表，按块元数据中的文档名重建
+                self.document_registry = {}
+                for position, chunk_metadata in enumerate(snapshot.metadata):
+                    entry = self.document_registry.setdefault(
+                        chunk_metadata.get("name", "document"),
+                        {"content_hash": chunk_metadata.get("content_hash"), "positions": array('q'), "shared": {}})
+                    entry["positions"].append(position)
+            repaired = self._drop_missing_positions()
+            self._invalidate_results()
+
+            if self._writer is not None:
+                self._writer.close()
+            self._writer = IndexWriter(self.index_dir, generation, base_count=len(snapshot),
+                                       segment_count=len(snapshot.segments),
+                                       segment_rows=sum(len(segment) for segment in snapshot.segments))
+            # 进程在入库途中退出时写入了追加段、却没有登记到任何文档的块：记为墓碑
+            orphans = self._orphan_positions()
+            self._deleted_positions.update(orphans)
+            if repaired:
+                self._rewrite()  # 登记表经过修复，整体重写，之后载入时不必再修复
+            elif orphans:
+                self._persist(record={"op": "deleted", "deleted": orphans})
+        self._train_vector_index()
+        return True
+
+    def _drop_missing_positions(self):
+        """去掉登记表中超出块数的位置（损坏的日志或旧版本的竞争留下的），返回是否做了修改
+
+        这样的位置没有对应的块，保留下来会让之后的删除和载入全部失败；丢掉它们只影响这些文档的块数。
+        """
+        count = len(self.documents)
+        repaired = False
+        for name, entry in list(self.document_registry.items()):
+            positions = np.frombuffer(entry["positions"], dtype='int64')
+            valid = positions[(positions >= 0) & (positions < count)]
+            if len(valid) == len(positions):
+                continue
+            print(f"RAG document {name} refers to {len(positions) - len(valid)} missing chunks; dropping them.")
+            repaired = True
+            if len(valid):
+                entry["positions"] = array('q', valid.tolist())
+                entry["shared"] = {position: chunk_metadata for position, chunk_metadata in entry["shared"].items()
+                                   if position < count}
+            else:
+                del self.document_registry[name]
+        return repaired
+
+    def _orphan_positions(self):
+        """既不属于任何文档、也没有被删除的块位置"""
+        used = np.zeros(len(self.documents), dtype=bool)
+        for entry in self.document_registry.values():
+            used[np.frombuffer(entry["positions"], dtype='int64')] = True
+        if self._deleted_positions:
+            used[np.fromiter(self._deleted_positions, dtype='int64', count=len(self._deleted_positions))] = True
+        return np.flatnonzero(~used).tolist()
+
+    def persist(self):
+        """把当前知识库完整地重写为新的一代并等待写完（未配置持久化目录时不做任何事）"""
+        with self._lock:
+            self._rewrite()
+        self._flush_writes()
+
+    def close(self):
+        """等待已提交的写入完成并释放持久化目录的锁"""
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def _get_writer(self):
+        if not self.index_dir:
+            return None
+        if self._writer is None:
+            # 没有载入过持久化的索引：第一次写入时整体重写
+            self._writer = IndexWriter(self.index_dir)
+        return self._writer
+
+    def _persist(self, segment=None, record=None):
+        """在索引锁内调用：把刚完成的修改交给写入线程
+
+        segment 为新块的 (文本, 元数据, 归一化向量, 指纹)，record 为一条日志记录。追加段积累过多
+        或上一次写入失败时，改为把当前的整个知识库重写为新的一代（其中已包含这次修改）。
+        """
+        writer = self._get_writer()
+        if writer is None:
+            return
+        if writer.needs_rewrite(RAG_PERSIST_MAX_SEGMENTS, RAG_PERSIST_SEGMENT_RATIO):
+            self._rewrite()
+            return
+        if segment is not None:
+            writer.append_segment(*segment)
+        if record is not None:
+            writer.append_record(record)
+
+    def _rewrite(self):
+        """在索引锁内调用：提交把当前知识库整体重写为新一代的写入
+
+        这里只在锁内取出各部分的引用和副本，文本和向量在写入线程中按块读取；
+        之后追加的块不影响已取出的前 count 个块。
+        """
+        writer = self._get_writer()
+        if writer is None:
+            return
+        vector_index, documents = self.vector_index, self.documents
+        writer.rewrite(
+            texts=documents, metadata=self.document_metadata, count=len(documents),
+            vectors=lambda start, stop: self._vectors_for(np.arange(start, stop), vector_index, documents),
+            embedding_model=self.embedding_model, embedding_dim=self.embedding_dim,
+            lexical=self.lexical_index.to_arrays(),
+            fingerprints=self.duplicate_index.to_arrays() if self.duplicate_index is not None else None,
+            documents={name: {"content_hash": entry["content_hash"], "positions": entry["positions"].tolist(),
+                              "shared": dict(entry["shared"])}
+                       for name, entry in self.document_registry.items()},
+            deleted=set(self._deleted_positions),
+            trained=vector_index.trained_state() if vector_index is not None else None)
+
+    def _flush_writes(self):
+        """等待已提交的写入完成（在索引锁外调用）"""
+        if self._writer is not None:
+            self._writer.flush()
+
+    def _vectors_for(self, ids, vector_index=None, documents=None):
+        """按位置导出归一化向量；压缩存储时优先使用缓存中的原始向量，缺失的用解码后的近似值"""
+        vector_index = self.vector_index if vector_index is None else vector_index
+        if vector_index is None:
+            return np.empty((0, self.embedding_dim), dtype='float32')
+        vectors = vector_index.storage.reconstruct(ids).astype('float32')
+        if vector_index.storage.lossy:
+            for offset, exact in enumerate(self._exact_vectors(ids.tolist(), documents)):
+                if exact is not None:
+                    vectors[offset] = vector_index._prepare(exact)[0]
+        return vectors
+
+    def _index_state(self):
+        """返回 (版本, 有效块数)，版本作为检索结果缓存的键
+
+        外部向量存储由所有进程共用，每次都从数据库读取版本号和块数，其他进程的修改也会使
+        缓存的结果失效；读取失败时沿用上一次读到的值。
+        """
+        if self.vector_store is not None:
+            state = self.vector_store.state()
+            if state is not None:
+                self._store_state = state
+            return self._store_state
+        return self.index_version, len(self.documents) - len(self._deleted_positions)
+
+    def _chunk_count(self):
+        return self._index_state()[1]
 
     def is_empty(self):
-        return len(self.documents) == 0
+        return self._chunk_count() == 0
+
+
+@st.cache_resource(show_spinner=False)
+def get_rag_manager(_api_client=None):
+    """进程内所有会话共用的知识库
+
+    只有这一个 RAGManager 修改并持久化索引：各会话的上传、删除和清空都在它的锁内依次生效，
+    不会出现两个会话各自写出一代索引、互相覆盖对方文档的情况。是否启用RAG由各会话自己决定。
+    """
+    if RAG_VECTOR_BACKEND == "pgvector":
+        from pgvector_store import get_pgvector_store
+        manager = RAGManager(api_client=_api_client, vector_store=get_pgvector_store())
+    else:
+        manager = RAGManager(api_client=_api_client, index_dir=RAG_INDEX_DIR)
+    manager.load_persisted()
+    return manager
 
 
 # 其余函数保持不变
@@ -131,11 +1705,17 @@ def get_enhanced_prompt(user_query, search_results):
         source_tag = f"Source Document {i + 1}"
 
         page_num_str = result["metadata"].get("page", "")
+        slide_num_str = result["metadata"].get("slide", "")
+        sheet_name_str = result["metadata"].get("sheet", "")
         chunk_id_str = result["metadata"].get("chunk_id", "")
 
         location_info = ""
         if page_num_str:
             location_info = f" (Page {page_num_str})"
+        elif slide_num_str:
+            location_info = f" (Slide {slide_num_str})"
+        elif sheet_name_str:
+            location_info = f" (Sheet {sheet_name_str})"
         elif chunk_id_str != "":
             location_info = f" (Chunk {chunk_id_str})"
 
@@ -0,0 +1,433 @@
+import json
+import mmap
+import os
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows 上不加目录锁
+    fcntl = None
+
+# 持久化RAG索引的目录结构：
+#   CURRENT                     当前代的名称（原子替换）
+#   LOCK                        写入进程持有的文件锁，同一目录只有一个进程写入
+#   generations/<代>/vectors.npy       归一化float32向量，按内存映射加载
+#   generations/<代>/chunks.bin        所有块文本的UTF-8字节串联
+#   generations/<代>/chunk_offsets.npy 每个块在 chunks.bin 中的起止偏移（n+1个int64）
+#   generations/<代>/metadata.json     清单（模型、维度、块数）、每个块的元数据和文档登记表
+#   generations/<代>/deleted.npy       已删除（墓碑）块的位置，压缩前仍占据原来的行
+#   generations/<代>/lexical_*.npy     BM25倒排表（CSR数组）及 lexical_vocabulary.json 词表
+#   generations/<代>/dedup_*.npy       每个块的SimHash指纹及按段排序的查找表
+#   generations/<代>/trained_*.npy     IVF簇中心与分配、PQ码本与编码，载入时不必重新训练
+#   generations/<代>/segments/<序号>/  这一代之后新增的块（追加段）：块文本、向量、元数据和指纹
+#   generations/<代>/journal.jsonl     这一代之后的修改日志，每行一条：追加段、文档登记、删除和墓碑
+# 日常的添加和删除只写追加段和一行日志，写入量与修改的大小成正比；压缩或追加段积累过多时
+# 才把整个索引重写为新的一代，写完后原子地切换 CURRENT，读者永远不会看到写了一半的索引。
+# 日志的每一行写完才算提交，崩溃时写了一半的最后一行在载入时被忽略。
+
+_write_lock = threading.Lock()
+_LEXICAL_ARRAYS = ("offsets", "doc_ids", "tfs", "doc_lengths")
+_DEDUP_ARRAYS = ("fingerprints", "band_keys", "band_ids")
+_JOURNAL = "journal.jsonl"
+
+
+class ChunkTexts:
+    """只读的块文本序列，按需从内存映射文件中解码，不把全部文本读入内存"""
+
+    def __init__(self, chunks_path, offsets):
+        self._offsets = offsets
+        self._file = None
+        self._data = b""
+        if os.path.getsize(chunks_path):
+            self._file = open(chunks_path, "rb")
+            self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("chunk index out of range")
+        return self._data[self._offsets[index]:self._offsets[index + 1]].decode("utf-8")
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+
+class Segment:
+    """一个追加段：基础代之后新增的一批块（位置紧接在前面的块之后）"""
+
+    def __init__(self, texts, metadata, vectors, fingerprints=None):
+        self.texts = texts
+        self.metadata = metadata
+        self.vectors = vectors
+        self.fingerprints = fingerprints
+
+    def __len__(self):
+        return len(self.texts)
+
+
+class IndexSnapshot:
+    """一代持久化索引的只读视图；segments 为日志中按顺序记录的追加段"""
+
+    def __init__(self, generation, manifest, texts, metadata, vectors, lexical=None, fingerprints=None,
+                 documents=None, deleted=None, segments=(), trained=None):
+        self.generation = generation
+        self.embedding_model = manifest["embedding_model"]
+        self.embedding_dim = manifest["embedding_dim"]
+        self.texts = texts
+        self.metadata = metadata
+        self.vectors = vectors
+        self.lexical = lexical  # BM25Index.from_arrays 的参数；旧版本索引中没有
+        self.fingerprints = fingerprints  # SimHashIndex.from_arrays 的参数；旧版本索引中没有
+        self.documents = documents  # 文档名 -> {"content_hash", "positions", "shared"}；旧版本索引中没有
+        self.deleted = deleted if deleted is not None else np.empty(0, dtype='int64')
+        self.segments = list(segments)
+        self.metadata_updates = {}  # 日志中记录的块元数据修改：位置 -> 元数据（已包含追加段的位置）
+        self.trained = trained or {}  # VectorIndex.trained_state() 保存的参数；旧版本索引中没有
+
+    def __len__(self):
+        """基础部分的块数（不含追加段）"""
+        return len(self.texts)
+
+
+def current_generation(index_dir):
+    """读取当前代的名称；索引不存在时返回None"""
+    try:
+        with open(os.path.join(index_dir, "CURRENT"), encoding="utf-8") as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def load_index(index_dir, generation):
+    """按内存映射方式加载一代索引，耗时与索引大小基本无关"""
+    generation_dir = os.path.join(index_dir, "generations", generation)
+    with open(os.path.join(generation_dir, "metadata.json"), encoding="utf-8") as f:
+        payload = json.load(f)
+    offsets = np.load(os.path.join(generation_dir, "chunk_offsets.npy"), mmap_mode="r")
+    vectors = np.load(os.path.join(generation_dir, "vectors.npy"), mmap_mode="r")
+    texts = ChunkTexts(os.path.join(generation_dir, "chunks.bin"), offsets)
+
+    lexical = None
+    vocabulary_path = os.path.join(generation_dir, "lexical_vocabulary.json")
+    if os.path.exists(vocabulary_path):
+        with open(vocabulary_path, encoding="utf-8") as f:
+            lexical = {"vocabulary": json.load(f)}
+        for name in _LEXICAL_ARRAYS:
+            lexical[name] = np.load(os.path.join(generation_dir, f"lexical_{name}.npy"), mmap_mode="r")
+
+    fingerprints = None
+    if os.path.exists(os.path.join(generation_dir, "dedup_fingerprints.npy")):
+        fingerprints = {name: np.load(os.path.join(generation_dir, f"dedup_{name}.npy"), mmap_mode="r")
+                        for name in _DEDUP_ARRAYS}
+
+    deleted_path = os.path.join(generation_dir, "deleted.npy")
+    deleted = np.load(deleted_path) if os.path.exists(deleted_path) else None
+    trained = {name[len("trained_"):-len(".npy")]: np.load(os.path.join(generation_dir, name), mmap_mode="r")
+               for name in os.listdir(generation_dir) if name.startswith("trained_") and name.endswith(".npy")}
+    snapshot = IndexSnapshot(generation, payload["manifest"], texts, payload["metadata"], vectors, lexical,
+                             fingerprints, payload.get("documents"), deleted, trained=trained)
+    _replay_journal(snapshot, generation_dir)
+    return snapshot
+
+
+def _load_segment(segment_dir):
+    offsets = np.load(os.path.join(segment_dir, "chunk_offsets.npy"))
+    texts = list(ChunkTexts(os.path.join(segment_dir, "chunks.bin"), offsets))
+    with open(os.path.join(segment_dir, "metadata.json"), encoding="utf-8") as f:
+        metadata = json.load(f)
+    vectors = np.load(os.path.join(segment_dir, "vectors.npy"))
+    fingerprints_path = os.path.join(segment_dir, "fingerprints.npy")
+    fingerprints = np.load(fingerprints_path) if os.path.exists(fingerprints_path) else None
+    return Segment(texts, metadata, vectors, fingerprints)
+
+
+def _replay_journal(snapshot, generation_dir):
+    """按顺序重放这一代的修改日志：载入追加段，更新文档登记表、块元数据和墓碑"""
+    try:
+        with open(os.path.join(generation_dir, _JOURNAL), encoding="utf-8") as f:
+            lines = f.readlines()
+    except FileNotFoundError:
+        return
+    documents = dict(snapshot.documents or {})
+    deleted = set(snapshot.deleted.tolist())
+    for line in lines:
+        if not line.endswith("\n"):
+            break  # 崩溃时没有写完的最后一行
+        record = json.loads(line)
+        op = record["op"]
+        if op == "segment":
+            snapshot.segments.append(_load_segment(os.path.join(generation_dir, "segments", record["segment"])))
+        elif op == "document":
+            documents[record["name"]] = {"content_hash": record["content_hash"], "positions": record["positions"],
+                                         "shared": record.get("shared", {})}
+        elif op == "remove":
+            documents.pop(record["name"], None)
+        for position, chunk_metadata in record.get("metadata", {}).items():
+            snapshot.metadata_updates[int(position)] = chunk_metadata
+        deleted.update(record.get("deleted", ()))
+        deleted.difference_update(record.get("restored", ()))
+    snapshot.documents = documents
+    snapshot.deleted = np.array(sorted(deleted), dtype='int64')
+
+
+def _write_texts(directory, texts, count):
+    offsets = np.empty(count + 1, dtype='int64')
+    offsets[0] = 0
+    with open(os.path.join(directory, "chunks.bin"), "wb") as f:
+        for position in range(count):
+            encoded = texts[position].encode("utf-8")
+            f.write(encoded)
+            offsets[position + 1] = offsets[position] + len(encoded)
+        f.flush()
+        os.fsync(f.fileno())
+    np.save(os.path.join(directory, "chunk_offsets.npy"), offsets)
+
+
+def save_index(index_dir, texts, metadata, vectors, embedding_model, embedding_dim, lexical=None,
+               fingerprints=None, documents=None, deleted=(), trained=None, count=None, block_rows=65536):
+    """把索引原子地写成新的一代并切换 CURRENT，返回新一代的名称
+
+    vectors 可以是数组，也可以是 callable(start, stop) 按块返回归一化向量，便于从压缩索引导出。
+    lexical 为 BM25Index.to_arrays() 的结果，fingerprints 为 SimHashIndex.to_arrays() 的结果；
+    documents 为文档登记表，deleted 为已删除块的位置，trained 为 VectorIndex.trained_state()。count 为要写入的前多少个块（默认全部），
+    texts 和 metadata 在写入期间可以继续在末尾追加。
+    """
+    count = len(texts) if count is None else count
+    with _write_lock:
+        generation = f"{int(time.time() * 1000)}-{uuid.uuid4().hex[:8]}"
+        generations_dir = os.path.join(index_dir, "generations")
+        generation_dir = os.path.join(generations_dir, generation)
+        os.makedirs(generation_dir)
+
+        # 块文本与偏移
+        _write_texts(generation_dir, texts, count)
+
+        # 向量：预先分配目标文件，按块写入，避免在内存中再复制一份
+        vector_file = np.lib.format.open_memmap(os.path.join(generation_dir, "vectors.npy"), mode="w+",
+                                                dtype='float32', shape=(count, embedding_dim))
+        for start in range(0, count, block_rows):
+            stop = min(count, start + block_rows)
+            vector_file[start:stop] = vectors(start, stop) if callable(vectors) else vectors[start:stop]
+        vector_file.flush()
+        del vector_file
+
+        if lexical is not None:
+            for name in _LEXICAL_ARRAYS:
+                np.save(os.path.join(generation_dir, f"lexical_{name}.npy"), lexical[name])
+            with open(os.path.join(generation_dir, "lexical_vocabulary.json"), "w", encoding="utf-8") as f:
+                json.dump(lexical["vocabulary"], f, ensure_ascii=False)
+
+        if fingerprints is not None:
+            for name in _DEDUP_ARRAYS:
+                np.save(os.path.join(generation_dir, f"dedup_{name}.npy"), fingerprints[name])
+
+        np.save(os.path.join(generation_dir, "deleted.npy"), np.array(sorted(deleted), dtype='int64'))
+
+        for name, values in (trained or {}).items():
+            np.save(os.path.join(generation_dir, f"trained_{name}.npy"), values)
+
+        manifest = {"embedding_model": embedding_model, "embedding_dim": embedding_dim, "count": count}
+        with open(os.path.join(generation_dir, "metadata.json"), "w", encoding="utf-8") as f:
+            json.dump({"manifest": manifest, "metadata": metadata[:count], "documents": documents}, f,
+                      ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+
+        # 原子切换到新一代
+        previous = current_generation(index_dir)
+        pointer_tmp = os.path.join(index_dir, f"CURRENT.{generation}.tmp")
+        with open(pointer_tmp, "w", encoding="utf-8") as f:
+            f.write(generation)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(pointer_tmp, os.path.join(index_dir, "CURRENT"))
+
+        # 保留当前代和上一代（上一代可能仍被内存映射着），删除更早的
+        for name in os.listdir(generations_dir):
+            if name not in (generation, previous):
+                shutil.rmtree(os.path.join(generations_dir, name), ignore_errors=True)
+        return generation
+
+
+class IndexWriter:
+    """持久化目录的唯一写入者：在一个后台线程中按提交的顺序执行写入
+
+    调用方在修改内存索引的同一把锁内提交写入，磁盘上的顺序因此与内存中的修改顺序一致；
+    写文件本身不占用该锁，检索不会被磁盘I/O阻塞。目录已被另一个进程锁定时以只读方式打开，
+    本进程的修改只保存在内存中。
+    """
+
+    def __init__(self, index_dir, generation=None, base_count=0, segment_count=0, segment_rows=0):
+        self.index_dir = index_dir
+        # 以下状态在提交时更新（调用方持有索引锁）
+        self.has_generation = generation is not None  # False 表示下一次写入必须整体重写
+        self.base_count = base_count  # 当前代基础部分的块数
+        self.segment_count = segment_count  # 当前代已有的追加段数
+        self.segment_rows = segment_rows  # 追加段中的块数
+        self.failed = False  # 写入失败后磁盘上的日志与内存不再一致，下一次写入整体重写
+        # 以下状态只在写入线程中使用
+        self._generation_dir = os.path.join(index_dir, "generations", generation) if generation else None
+        self._lock_file = None
+        self.read_only = not self._lock_directory()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="rag-persist")
+        if self._generation_dir is not None and not self.read_only:
+            self._truncate_journal()
+
+    def _lock_directory(self):
+        os.makedirs(self.index_dir, exist_ok=True)
+        if fcntl is None:
+            return True
+        self._lock_file = open(os.path.join(self.index_dir, "LOCK"), "a")
+        try:
+            fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            print(f"RAG index directory {self.index_dir} is in use by another process; "
+                  f"changes made here will not be saved.")
+            self._lock_file.close()
+            self._lock_file = None
+            return False
+        return True
+
+    def _truncate_journal(self):
+        """去掉崩溃时没有写完的最后一行，之后追加的记录从新的一行开始"""
+        path = os.path.join(self._generation_dir, _JOURNAL)
+        try:
+            with open(path, "rb+") as f:
+                data = f.read()
+                if data and not data.endswith(b"\n"):
+                    f.truncate(data.rfind(b"\n") + 1)
+        except FileNotFoundError:
+            pass
+
+    def needs_rewrite(self, max_segments, segment_ratio):
+        """是否应该整体重写：还没有任何一代、上次写入失败，或追加段积累得太多"""
+        if self.read_only:
+            return False
+        return (not self.has_generation or self.failed or self.segment_count >= max_segments
+                or self.segment_rows > segment_ratio * self.base_count)
+
+    def rewrite(self, **state):
+        """提交整体重写，state 为 save_index 的参数（texts、metadata、vectors 等，不含 index_dir）"""
+        if self.read_only:
+            return
+        self.has_generation = True
+        self.failed = False
+        self.base_count = len(state["texts"]) if state.get("count") is None else state["count"]
+        self.segment_count = 0
+        self.segment_rows = 0
+        self._executor.submit(self._rewrite, state)
+
+    def append_segment(self, texts, metadata, vectors, fingerprints=None):
+        """提交一个追加段：这批块的位置紧接在之前所有块之后"""
+        if self.read_only or not texts:
+            return
+        self.segment_count += 1
+        self.segment_rows += len(texts)
+        self._executor.submit(self._append_segment, f"{self.segment_count:06d}", texts, metadata, vectors,
+                              fingerprints)
+
+    def append_record(self, record):
+        """提交一条日志记录（文档登记、删除、墓碑等）"""
+        if self.read_only:
+            return
+        self._executor.submit(self._append_record, record)
+
+    def flush(self, timeout=None):
+        """等待已提交的写入全部完成"""
+        self._executor.submit(lambda: None).result(timeout)
+
+    def close(self):
+        """写完已提交的内容并释放目录锁"""
+        self._executor.shutdown(wait=True)
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def _fail(self, e):
+        print(f"Failed to persist RAG index: {e}")
+        self.failed = True
+        self._generation_dir = None
+
+    def _rewrite(self, state):
+        try:
+            generation = save_index(self.index_dir, **state)
+        except Exception as e:
+            self._fail(e)
+            return
+        self._generation_dir = os.path.join(self.index_dir, "generations", generation)
+
+    def _append_segment(self, name, texts, metadata, vectors, fingerprints):
+        if self._generation_dir is None:
+            return
+        try:
+            segment_dir = os.path.join(self._generation_dir, "segments", name)
+            shutil.rmtree(segment_dir, ignore_errors=True)  # 上次崩溃时没有记入日志的同名段
+            os.makedirs(segment_dir)
+            _write_texts(segment_dir, texts, len(texts))
+            np.save(os.path.join(segment_dir, "vectors.npy"), np.asarray(vectors, dtype='float32'))
+            if fingerprints is not None:
+                np.save(os.path.join(segment_dir, "fingerprints.npy"), np.asarray(fingerprints, dtype='uint64'))
+            with open(os.path.join(segment_dir, "metadata.json"), "w", encoding="utf-8") as f:
+                json.dump(metadata, f, ensure_ascii=False)
+                f.flush()
+                os.fsync(f.fileno())
+            self._write_journal({"op": "segment", "segment": name, "count": len(texts)})
+        except Exception as e:
+            self._fail(e)
+
+    def _append_record(self, record):
+        if self._generation_dir is None:
+            return
+        try:
+            self._write_journal(record)
+        except Exception as e:
+            self._fail(e)
+
+    def _write_journal(self, record):
+        with open(os.path.join(self._generation_dir, _JOURNAL), "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+
+class OverlayList:
+    """在只读序列（如内存映射的块文本）之上追加新的条目，只读部分不会被修改"""
+
+    def __init__(self, base):
+        self._base = base
+        self._extra = []
+
+    def __len__(self):
+        return len(self._base) + len(self._extra)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if index < len(self._base):
+            return self._base[index]
+        return self._extra[index - len(self._base)]
+
+    def __iter__(self):
+        yield from self._base
+        yield from self._extra
+
+    def append(self, item):
+        self._extra.append(item)
+
+    def extend(self, items):
+        self._extra.extend(items)
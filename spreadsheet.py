@@ -0,0 +1,186 @@
+"""流式读取xlsx工作簿
+
+openpyxl 只读模式逐行读取，不把整张表载入内存。直接分析时每张工作表只输出结构、
+统计信息和抽样的行（前几行加上其余行的蓄水池抽样）；RAG入库时按行组逐段产出全部数据。
+"""
+import datetime
+import io
+import random
+
+import openpyxl
+
+_VALUE_KINDS = ("number", "date", "boolean", "text")
+
+
+def _value_kind(value):
+    if isinstance(value, bool):
+        return "boolean"
+    if isinstance(value, (int, float)):
+        return "number"
+    if isinstance(value, (datetime.date, datetime.time, datetime.timedelta)):
+        return "date"
+    return "text"
+
+
+def _format_value(value, max_chars):
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    elif isinstance(value, datetime.datetime) and value.time() == datetime.time():
+        value = value.date()
+    text = " ".join(str(value).split())
+    return text if len(text) <= max_chars else text[:max_chars - 1] + "…"
+
+
+def _iter_sheets(data):
+    """逐张工作表产出 (序号, 名称, 非空行的迭代器)，每行为 (行号, 值元组)"""
+    workbook = openpyxl.load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+    try:
+        for sheet_num, worksheet in enumerate(workbook.worksheets, start=1):
+            rows = ((row_num, values)
+                    for row_num, values in enumerate(worksheet.iter_rows(values_only=True), start=1)
+                    if any(value is not None and value != "" for value in values))
+            yield sheet_num, worksheet.title, rows
+    finally:
+        workbook.close()
+
+
+def _header(values, max_columns, max_chars):
+    """把第一条非空行作为表头，空单元格以列序号代替"""
+    return [_format_value(value, max_chars) if value not in (None, "") else f"Column {i}"
+            for i, value in enumerate(values[:max_columns], start=1)]
+
+
+def _extend_header(header, width, max_columns):
+    """数据行比表头宽时补上列名"""
+    for i in range(len(header) + 1, min(width, max_columns) + 1):
+        header.append(f"Column {i}")
+
+
+class _ColumnStats:
+    """单列的流式统计：各类型的值个数，数值和日期的范围，以及数值的均值"""
+
+    __slots__ = ("kinds", "empty", "ranges", "total")
+
+    def __init__(self, empty=0):
+        self.kinds = dict.fromkeys(_VALUE_KINDS, 0)
+        self.empty = empty  # 该列出现之前的行也算作空
+        self.ranges = {}  # 类型 -> [最小值, 最大值]
+        self.total = 0.0
+
+    def add(self, value):
+        if value is None or value == "":
+            self.empty += 1
+            return
+        kind = _value_kind(value)
+        self.kinds[kind] += 1
+        if kind == "number":
+            self.total += value
+        if kind in ("number", "date"):
+            value_range = self.ranges.get(kind)
+            if value_range is None:
+                self.ranges[kind] = [value, value]
+            else:
+                try:
+                    value_range[0] = min(value_range[0], value)
+                    value_range[1] = max(value_range[1], value)
+                except TypeError:
+                    pass  # 日期和时间之类不可比较的值不计入范围
+
+    def describe(self):
+        kind = max(_VALUE_KINDS, key=lambda k: self.kinds[k])
+        filled = sum(self.kinds.values())
+        if not filled:
+            return "empty"
+        parts = [kind, f"{filled} values"]
+        if self.empty:
+            parts.append(f"{self.empty} empty")
+        if kind in self.ranges:
+            minimum, maximum = self.ranges[kind]
+            parts.append(f"min {_format_value(minimum, 32)}, max {_format_value(maximum, 32)}")
+        if kind == "number":
+            parts.append(f"mean {self.total / self.kinds['number']:.4g}")
+        return ", ".join(parts)
+
+
+def iter_sheet_summaries(data, sample_rows=30, head_rows=10, max_columns=50, max_cell_chars=100):
+    """逐张工作表产出 (序号, 名称, 摘要文本)
+
+    摘要包括行列数、每列的类型和统计信息、前 head_rows 行，以及从其余行中均匀抽取的
+    最多 sample_rows 行。内存占用只与抽样行数和列数有关，与工作表的行数无关。
+    """
+    rng = random.Random(0)  # 固定种子，同一文件每次得到相同的摘要
+    for sheet_num, sheet_name, rows in _iter_sheets(data):
+        header, stats = None, []
+        head, reservoir = [], []
+        row_count, column_count, seen = 0, 0, 0
+        for row_num, values in rows:
+            if header is None:
+                header = _header(values, max_columns, max_cell_chars)
+                stats = [_ColumnStats() for _ in header]
+                column_count = len(values)
+                continue
+            row_count += 1
+            column_count = max(column_count, len(values))
+            if len(values) > len(header):
+                _extend_header(header, len(values), max_columns)
+                stats.extend(_ColumnStats(empty=row_count - 1) for _ in range(len(header) - len(stats)))
+            for column, value in zip(stats, values):
+                column.add(value)
+            for column in stats[len(values):]:
+                column.add(None)
+            if len(head) < head_rows:
+                head.append((row_num, values[:max_columns]))
+                continue
+            # 蓄水池抽样：每一行被选中的概率相同
+            seen += 1
+            if len(reservoir) < sample_rows:
+                reservoir.append((row_num, values[:max_columns]))
+            else:
+                slot = rng.randrange(seen)
+                if slot < sample_rows:
+                    reservoir[slot] = (row_num, values[:max_columns])
+
+        if header is None:
+            yield sheet_num, sheet_name, "(empty sheet)"
+            continue
+        lines = [f"{row_count} rows x {column_count} columns"]
+        if column_count > max_columns:
+            lines.append(f"(only the first {max_columns} columns are shown)")
+        lines.append("Columns:")
+        lines.extend(f"- {name}: {column.describe()}" for name, column in zip(header, stats))
+        sampled = head + sorted(reservoir)
+        if sampled:
+            if len(sampled) < row_count:
+                lines.append(f"Sample rows ({len(sampled)} of {row_count}):")
+            else:
+                lines.append("Rows:")
+            lines.append(" | ".join(["Row"] + header))
+            for row_num, values in sampled:
+                cells = [_format_value(value, max_cell_chars) if value is not None else "" for value in values]
+                lines.append(" | ".join([str(row_num)] + cells))
+        yield sheet_num, sheet_name, "\n".join(lines)
+
+
+def iter_row_groups(data, rows_per_group=100, max_columns=50, max_cell_chars=100):
+    """逐组产出 (序号, 名称, 首行号, 末行号, 文本)，覆盖全部数据行
+
+    每行写成“列名: 值”的形式并单独成段，检索到的块即使不含表头也能看懂；
+    分块器会把同一工作表的相邻行合并到块预算以内。
+    """
+    for sheet_num, sheet_name, rows in _iter_sheets(data):
+        header, group = None, []
+        for row_num, values in rows:
+            if header is None:
+                header = _header(values, max_columns, max_cell_chars)
+                continue
+            _extend_header(header, len(values), max_columns)
+            cells = [f"{name}: {_format_value(value, max_cell_chars)}"
+                     for name, value in zip(header, values) if value not in (None, "")]
+            if not cells:
+                continue
+            group.append((row_num, "; ".join(cells)))
+            if len(group) >= rows_per_group:
+                yield sheet_num, sheet_name, group[0][0], group[-1][0], "\n\n".join(text for _, text in group)
+                group = []
+        if group:
+            yield sheet_num, sheet_name, group[0][0], group[-1][0], "\n\n".join(text for _, text in group)
@@ -0,0 +1,35 @@
+import os
+import sys
+
+import pytest
+
+# 测试不读取 .streamlit/secrets.toml，所需的配置都从环境变量取得
+os.environ.setdefault("GEMINI_API_KEY", "test")
+for _name in ("DB_HOST", "DB_USER", "DB_PASSWORD", "DB_NAME"):
+    os.environ.setdefault(_name, "test")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from embedding_cache import EmbeddingCache  # noqa: E402
+from local_embeddings import LocalEmbeddingClient  # noqa: E402
+from rag import RAGManager  # noqa: E402
+
+
+def quiet_notify(level, message):
+    pass
+
+
+@pytest.fixture
+def make_manager(tmp_path):
+    """创建使用离线嵌入、临时持久化目录和临时嵌入缓存的 RAGManager；同一测试中多次调用共享同一目录"""
+    managers = []
+
+    def make():
+        manager = RAGManager(api_client=LocalEmbeddingClient(), index_dir=str(tmp_path / "index"),
+                             embedding_cache=EmbeddingCache(str(tmp_path / "embeddings.sqlite3")))
+        managers.append(manager)
+        return manager
+
+    yield make
+    for manager in managers:
+        manager.close()
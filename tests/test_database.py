@@ -0,0 +1,244 @@
+import contextlib
+import sqlite3
+
+import psycopg2
+import pytest
+
+import database
+from message_cache import MessageCache
+
+
+class _Cursor:
+    """把 psycopg2 风格的SQL交给SQLite执行（%s 占位符；LIMIT NULL 在SQLite中写作 LIMIT -1）"""
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._cursor.close()
+
+    def execute(self, sql, params=()):
+        params = list(params)
+        if "LIMIT %s" in sql and params[-1] is None:
+            params[-1] = -1
+        self._cursor.execute(sql.replace("%s", "?"), params)
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+
+class _Connection:
+    def __init__(self, connection):
+        self._connection = connection
+
+    def cursor(self):
+        return _Cursor(self._connection.cursor())
+
+    def commit(self):
+        self._connection.commit()
+
+
+@pytest.fixture
+def chat_history(monkeypatch):
+    """内存SQLite中的 chat_history 表，created_at 有大量相同的值"""
+    connection = sqlite3.connect(":memory:")
+    connection.execute("CREATE TABLE chat_history (id INTEGER PRIMARY KEY, conversation_id INTEGER, "
+                       "role TEXT, content TEXT, created_at TEXT)")
+    # 同一事务中写入的消息 created_at 相同；id 的顺序与时间顺序不同时也要按 (created_at, id) 排序
+    rows = [(1, "2024-01-01 10:00:00", "m0"), (1, "2024-01-01 10:00:00", "m1"), (1, "2024-01-01 10:00:00", "m2"),
+            (1, "2024-01-01 10:00:01", "m3"), (1, "2024-01-01 10:00:01", "m4"), (2, "2024-01-01 10:00:00", "x")]
+    connection.executemany("INSERT INTO chat_history (conversation_id, created_at, role, content) "
+                           "VALUES (?, ?, 'user', ?)", rows)
+
+    @contextlib.contextmanager
+    def db_connection():
+        yield _Connection(connection)
+
+    monkeypatch.setattr(database, "db_connection", db_connection)
+    monkeypatch.setattr(database, "flush_chats", lambda: None)
+    return connection
+
+
+def _contents(rows):
+    return [content for _, _, _, content in rows]
+
+
+def _cursor(rows):
+    return rows[0][1], rows[0][0]
+
+
+def test_message_pages_split_tied_timestamps_without_gaps(chat_history):
+    pages = []
+    rows = database.get_message_page(1, limit=2)
+    while rows:
+        pages.append(_contents(rows))
+        rows = database.get_message_page(1, limit=2, before=_cursor(rows))
+    assert pages == [["m3", "m4"], ["m1", "m2"], ["m0"]]
+
+
+def test_message_page_boundary_inside_tied_group(chat_history):
+    first = database.get_message_page(1, limit=3)
+    assert _contents(first) == ["m2", "m3", "m4"]
+    # 游标落在 created_at 相同的一组消息中间：只返回同一时刻 id 更小的消息
+    assert _contents(database.get_message_page(1, limit=3, before=_cursor(first))) == ["m0", "m1"]
+
+
+def test_message_page_without_limit_returns_everything_before_cursor(chat_history):
+    latest = database.get_message_page(1, limit=1)
+    assert _contents(latest) == ["m4"]
+    assert _contents(database.get_message_page(1, limit=None, before=_cursor(latest))) == ["m0", "m1", "m2", "m3"]
+    assert database.get_message_page(1, limit=None, before=("2024-01-01 10:00:00", 1)) == []
+
+
+class _ChatDatabase:
+    """记录 ChatWriter 写入的假数据库：可以让前几次连接失败，或让含某条内容的插入失败"""
+
+    def __init__(self, fail_connections=0, bad_content=None):
+        self.fail_connections = fail_connections
+        self.bad_content = bad_content
+        self.inserts = []  # 每次提交的一批行
+        self.updated = []  # 每次提交时更新 updated_at 的会话ID
+
+    @contextlib.contextmanager
+    def connection(self):
+        if self.fail_connections:
+            self.fail_connections -= 1
+            raise psycopg2.OperationalError("database is down")
+        yield _ChatConnection(self)
+
+
+class _ChatConnection:
+    def __init__(self, database):
+        self.database = database
+        self.rows = []
+        self.conversation_ids = []
+
+    def cursor(self):
+        return _ChatCursor(self)
+
+    def commit(self):
+        self.database.inserts.append(self.rows)
+        self.database.updated.append(self.conversation_ids)
+
+
+class _ChatCursor:
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def insert(self, rows):
+        if any(row[1] == self.connection.database.bad_content for row in rows):
+            raise psycopg2.IntegrityError("conversation does not exist")
+        self.connection.rows = rows
+
+    def execute(self, sql, params=()):
+        assert sql.startswith("UPDATE conversations")
+        self.connection.conversation_ids = params[0]
+
+
+@pytest.fixture
+def chat_database(monkeypatch):
+    def make(**kwargs):
+        fake = _ChatDatabase(**kwargs)
+        monkeypatch.setattr(database, "db_connection", fake.connection)
+        return fake
+
+    monkeypatch.setattr(database, "execute_values", lambda cursor, sql, rows, template=None: cursor.insert(rows))
+    return make
+
+
+@pytest.fixture
+def chat_writer():
+    writers = []
+
+    def make(**kwargs):
+        writer = database.ChatWriter(shutdown_timeout=5, **{"flush_interval": 60, **kwargs})
+        writers.append(writer)
+        return writer
+
+    yield make
+    for writer in writers:
+        writer.close()
+
+
+def test_chat_writer_coalesces_messages_into_one_transaction(chat_database, chat_writer):
+    fake = chat_database()
+    writer = chat_writer()
+    for i, conversation_id in enumerate([2, 1, 2, 1, 2]):
+        writer.enqueue("user", f"m{i}", conversation_id)
+    assert fake.inserts == []  # 在写入间隔内只入队
+
+    assert writer.flush(timeout=5)
+    assert len(fake.inserts) == 1
+    assert [row[1] for row in fake.inserts[0]] == ["m0", "m1", "m2", "m3", "m4"]
+    assert fake.updated == [[1, 2]]  # 每个会话的 updated_at 只更新一次
+    # 先入队的消息等待得更久，created_at 保持发送顺序
+    waits = [row[3] for row in fake.inserts[0]]
+    assert waits == sorted(waits, reverse=True)
+    assert writer.written == 5
+
+
+def test_chat_writer_batches_are_limited_to_batch_size(chat_database, chat_writer):
+    fake = chat_database()
+    writer = chat_writer(batch_size=2)
+    for i in range(5):
+        writer.enqueue("user", f"m{i}", 1)
+    assert writer.flush(timeout=5)
+    assert [[row[1] for row in rows] for rows in fake.inserts] == [["m0", "m1"], ["m2", "m3"], ["m4"]]
+
+
+def test_chat_writer_retries_whole_batch_while_database_is_down(chat_database, chat_writer):
+    fake = chat_database(fail_connections=1)
+    writer = chat_writer()
+    writer.enqueue("user", "hello", 1)
+    writer.enqueue("assistant", "hi", 1)
+    assert writer.flush(timeout=10)
+    assert [[row[1] for row in rows] for rows in fake.inserts] == [["hello", "hi"]]
+    assert writer.written == 2
+    assert writer.dropped == 0
+
+
+def test_chat_writer_skips_only_the_bad_row(chat_database, chat_writer):
+    fake = chat_database(bad_content="orphan")
+    writer = chat_writer()
+    for content in ["a", "orphan", "b"]:
+        writer.enqueue("user", content, 1)
+    assert writer.flush(timeout=5)
+    assert [[row[1] for row in rows] for rows in fake.inserts] == [["a"], ["b"]]
+    assert writer.written == 2
+    assert writer.dropped == 1
+
+
+def test_chat_writer_close_drains_the_queue(chat_database, chat_writer):
+    fake = chat_database()
+    writer = chat_writer()
+    for i in range(3):
+        writer.enqueue("user", f"m{i}", 1)
+    writer.close()
+    assert not writer._thread.is_alive()
+    assert [row[1] for rows in fake.inserts for row in rows] == ["m0", "m1", "m2"]
+    assert writer.flush(timeout=0)
+
+
+def test_save_chat_caches_the_callers_message_dict(chat_database, chat_writer, monkeypatch):
+    chat_database()
+    writer = chat_writer()
+    cache = MessageCache()
+    cache.put(1, [], None, False, cache.version(1))
+    monkeypatch.setattr(database, "CHAT_WRITE_MODE", "async")
+    monkeypatch.setattr(database, "get_chat_writer", lambda: writer)
+    monkeypatch.setattr(database, "get_message_cache", lambda: cache)
+
+    message = {"role": "user", "content": "hello"}
+    assert database.save_chat(message, 1)
+    # 显示列表、API 历史和消息缓存共用同一个字典
+    assert cache.snapshot(1)[0][0] is message
+    assert writer.flush(timeout=5)
@@ -0,0 +1,57 @@
+from message_cache import MessageCache
+
+
+def _message(content, role="user"):
+    return {"role": role, "content": content}
+
+
+def test_put_after_append_during_read_is_ignored():
+    cache = MessageCache()
+    version = cache.version(1)
+    # 从数据库读取期间另一个会话发送了新消息：读到的页已经过时，不能写入缓存
+    cache.append(1, _message("new"))
+    cache.put(1, [_message("old")], ("t0", 1), False, version)
+    assert cache.snapshot(1) is None
+
+    cache.put(1, [_message("old"), _message("new")], ("t0", 1), False, cache.version(1))
+    assert [message["content"] for message in cache.snapshot(1)[0]] == ["old", "new"]
+
+
+def test_put_after_invalidate_during_read_is_ignored():
+    cache = MessageCache()
+    version = cache.version(1)
+    cache.invalidate(1)  # 读取期间会话被清空
+    cache.put(1, [_message("cleared")], ("t0", 1), False, version)
+    assert cache.snapshot(1) is None
+
+
+def test_append_goes_to_cached_conversation_only():
+    cache = MessageCache()
+    cache.put(1, [_message("a")], ("t0", 1), False, cache.version(1))
+    cache.append(1, _message("b", "assistant"))
+    cache.append(2, _message("other"))
+    assert [message["content"] for message in cache.snapshot(1)[0]] == ["a", "b"]
+    assert cache.snapshot(2) is None
+
+
+def test_prepend_only_applies_to_matching_cursor():
+    cache = MessageCache()
+    cache.put(1, [_message("c")], ("t2", 3), True, cache.version(1))
+
+    cache.prepend(1, [_message("b")], ("t2", 3), ("t1", 2), True)
+    # 另一个页面会话用旧游标读到了同一页：不重复添加
+    cache.prepend(1, [_message("b")], ("t2", 3), ("t1", 2), True)
+    cache.prepend(1, [_message("a")], ("t1", 2), ("t0", 1), False)
+
+    messages, cursor, has_more = cache.snapshot(1)
+    assert [message["content"] for message in messages] == ["a", "b", "c"]
+    assert cursor == ("t0", 1)
+    assert has_more is False
+
+
+def test_snapshot_is_a_copy():
+    cache = MessageCache()
+    cache.put(1, [_message("a")], ("t0", 1), False, cache.version(1))
+    messages, _, _ = cache.snapshot(1)
+    messages.append(_message("local only"))
+    assert len(cache.snapshot(1)[0]) == 1
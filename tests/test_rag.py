@@ -0,0 +1,182 @@
+import json
+import os
+import threading
+
+from conftest import quiet_notify
+from embedding_cache import EmbeddingCache
+from local_embeddings import LocalEmbeddingClient
+from rag import RAGManager
+from rag_store import current_generation
+
+INTRO = "Maintenance manual for the primary loop. Read the safety section before servicing any component."
+SPEC = "The pump operates at a maximum pressure of {} bar under normal load conditions in the primary loop."
+
+
+def _pages(pressure):
+    return [(INTRO, {"page": 1}), (SPEC.format(pressure), {"page": 2})]
+
+
+def _add(manager, content, name, content_hash):
+    return manager.add_document(content, {"name": name, "content_hash": content_hash}, notify=quiet_notify)
+
+
+def test_replace_with_changed_numbers_returns_new_text(make_manager):
+    manager = make_manager()
+    _add(manager, _pages(10), "manual.txt", "v1")
+    assert _add(manager, _pages(12), "manual.txt", "v2") == 2
+    # 旧版本的块（包括文本没变的第一页）不被新版本当作重复块共用，随旧版本一起删除
+    assert manager.skipped_duplicates == 0
+
+    results = manager.search("pump maximum pressure bar", top_k=5)
+    assert "12 bar" in results[0]["text"]
+    assert all("10 bar" not in result["text"] for result in results)
+    # 未改动的页也是新版本的块，不再指向旧版本
+    assert {result["metadata"]["content_hash"] for result in results} == {"v2"}
+    assert manager.list_documents() == [{"name": "manual.txt", "content_hash": "v2", "chunks": 2}]
+
+    manager.close()
+    reloaded = make_manager()
+    assert reloaded.load_persisted()
+    results = reloaded.search("pump maximum pressure bar", top_k=5)
+    assert "12 bar" in results[0]["text"]
+    assert all("10 bar" not in result["text"] for result in results)
+
+
+def test_near_duplicates_across_documents_are_kept(make_manager):
+    manager = make_manager()
+    _add(manager, SPEC.format(10), "old.txt", "a")
+    _add(manager, SPEC.format(12), "new.txt", "b")
+    texts = {result["metadata"]["name"]: result["text"] for result in manager.search("pump pressure", top_k=5)}
+    assert "10 bar" in texts["old.txt"]
+    assert "12 bar" in texts["new.txt"]
+
+
+def test_shared_chunk_moves_to_remaining_document(make_manager):
+    manager = make_manager()
+    _add(manager, SPEC.format(10), "a.txt", "a")
+    _add(manager, SPEC.format(10), "b.txt", "b")
+    assert len(manager.documents) == 1  # 完全相同的块只嵌入一次
+
+    assert manager.remove_document("a.txt") == 0
+    assert [result["metadata"]["name"] for result in manager.search("pump pressure")] == ["b.txt"]
+
+    manager.close()
+    reloaded = make_manager()
+    reloaded.load_persisted()
+    assert [result["metadata"]["name"] for result in reloaded.search("pump pressure")] == ["b.txt"]
+
+
+class _SharedStore:
+    """内存中的外部向量存储，模拟被多个进程共用的 pgvector 表"""
+
+    def __init__(self):
+        self.rows = []
+        self.version = 0
+        self.searches = 0
+
+    def state(self):
+        return self.version, len(self.rows)
+
+    def add(self, texts, metadata, vectors):
+        self.rows.extend({"text": text, "metadata": chunk_metadata, "score": 1.0}
+                         for text, chunk_metadata in zip(texts, metadata))
+        self.version += 1
+        return len(texts)
+
+    def search(self, query_vector, top_k):
+        self.searches += 1
+        return self.rows[:top_k]
+
+
+def test_shared_store_changes_invalidate_cached_results(tmp_path):
+    store = _SharedStore()
+    manager = RAGManager(api_client=LocalEmbeddingClient(), vector_store=store,
+                         embedding_cache=EmbeddingCache(str(tmp_path / "embeddings.sqlite3")))
+    assert manager.is_empty()
+    store.add(["written by another process"], [{"name": "other.txt"}], [None])
+    assert not manager.is_empty()
+
+    assert manager.search("process")[0]["text"] == "written by another process"
+    manager.search("process")
+    assert store.searches == 1  # 表未变化，命中缓存
+
+    store.add(["second chunk"], [{"name": "other.txt"}], [None])
+    assert len(manager.search("process")) == 2
+    assert store.searches == 2
+
+
+def test_clear_is_refused_while_an_ingest_is_running(make_manager):
+    manager = make_manager()
+    _add(manager, SPEC.format(10), "a.txt", "a")
+    cleared = []
+
+    def progress(chunks_processed, chunks_indexed):
+        cleared.append(manager.clear())  # 另一个会话在入库途中点了清空
+        cleared.append(manager.rebuild_index())
+
+    manager.add_document(_pages(12), {"name": "b.txt", "content_hash": "b"}, progress=progress,
+                         notify=quiet_notify)
+    assert cleared and not any(cleared)
+    for entry in manager.document_registry.values():
+        assert all(position < len(manager.documents) for position in entry["positions"])
+    assert manager.remove_document("b.txt") == 2
+    assert manager.clear()
+    assert manager.is_empty()
+
+
+def test_load_drops_registry_positions_without_chunks(make_manager):
+    manager = make_manager()
+    _add(manager, SPEC.format(10), "a.txt", "a")
+    manager.persist()
+    manager.close()
+    generation_dir = os.path.join(manager.index_dir, "generations", current_generation(manager.index_dir))
+    with open(os.path.join(generation_dir, "journal.jsonl"), "a", encoding="utf-8") as f:
+        f.write(json.dumps({"op": "document", "name": "c.txt", "content_hash": "c", "positions": [0, 1, 3]}) + "\n")
+
+    reloaded = make_manager()
+    assert reloaded.load_persisted()
+    assert list(reloaded.document_registry["c.txt"]["positions"]) == [0]
+    assert reloaded.remove_document("c.txt") == 0
+    reloaded.close()
+    assert make_manager().load_persisted()
+
+
+def test_searches_from_different_sessions_run_concurrently(make_manager):
+    manager = make_manager()
+    _add(manager, _pages(10), "manual.txt", "v1")
+    both_inside = threading.Barrier(2, timeout=5)
+    search_index = manager._search_index
+
+    def search_together(*args):
+        both_inside.wait()  # 两个检索都进入打分后才继续：检索互斥时这里超时
+        return search_index(*args)
+
+    manager._search_index = search_together
+    results = []
+    threads = [threading.Thread(target=lambda query=query: results.append(manager.search(query, mode="lexical")))
+               for query in ("pump pressure", "safety section")]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(results) == 2 and all(results)
+
+
+def test_index_changes_wait_for_running_searches(make_manager):
+    manager = make_manager()
+    _add(manager, _pages(10), "manual.txt", "v1")
+    scoring, cleared = threading.Event(), threading.Event()
+    search_index = manager._search_index
+
+    def slow_search(*args):
+        scoring.set()
+        assert not cleared.wait(timeout=0.2)  # 检索期间清空必须等待
+        return search_index(*args)
+
+    manager._search_index = slow_search
+    clearing = threading.Thread(target=lambda: scoring.wait(5) and manager.clear() and cleared.set())
+    clearing.start()
+    assert manager.search("pump pressure", mode="lexical")
+    clearing.join(timeout=5)
+    assert cleared.is_set()
+    assert manager.is_empty()
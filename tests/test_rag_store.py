@@ -0,0 +1,179 @@
+import json
+import os
+import threading
+
+import numpy as np
+
+import rag
+from conftest import quiet_notify
+from rag import IVFIndex
+from rag_store import current_generation, load_index
+
+TOPICS = ["pumps", "valves", "turbines", "boilers", "filters", "sensors", "heaters", "coolers"]
+
+
+def _add_topics(manager, topics, version="1"):
+    for topic in topics:
+        manager.add_document(f"Service notes on {topic}: inspect {topic} weekly and log every {topic} fault.",
+                             {"name": f"{topic}.txt", "content_hash": f"{topic}-{version}"}, notify=quiet_notify)
+
+
+def _texts(manager, query):
+    return [result["text"] for result in manager.search(query, top_k=3, mode="vector")]
+
+
+def _generation_dir(manager):
+    return os.path.join(manager.index_dir, "generations", current_generation(manager.index_dir))
+
+
+def test_generation_round_trip_with_segments_and_journal(make_manager):
+    manager = make_manager()
+    _add_topics(manager, TOPICS[:6])
+    manager.persist()
+    generation = current_generation(manager.index_dir)
+    # 之后的修改只写追加段和日志，不产生新的一代
+    _add_topics(manager, TOPICS[6:])
+    manager.remove_document("valves.txt")
+    assert current_generation(manager.index_dir) == generation
+    snapshot = load_index(manager.index_dir, generation)
+    assert len(snapshot) == 6
+    assert sum(len(segment) for segment in snapshot.segments) == 2
+
+    expected = {
+        "documents": list(manager.documents),
+        "metadata": list(manager.document_metadata),
+        "registry": manager.list_documents(),
+        "deleted": set(manager._deleted_positions),
+        "results": _texts(manager, "turbines fault"),
+    }
+    manager.close()
+
+    reloaded = make_manager()
+    assert reloaded.load_persisted()
+    assert list(reloaded.documents) == expected["documents"]
+    assert reloaded.document_metadata == expected["metadata"]
+    assert reloaded.list_documents() == expected["registry"]
+    assert reloaded._deleted_positions == expected["deleted"]
+    assert _texts(reloaded, "turbines fault") == expected["results"]
+    np.testing.assert_allclose(reloaded.embeddings_array, manager.embeddings_array, atol=1e-6)
+
+
+def test_tombstones_then_compaction(make_manager, monkeypatch):
+    monkeypatch.setattr(rag, "RAG_COMPACT_DELETED_RATIO", 1.0)  # 只在显式调用时压缩
+    manager = make_manager()
+    _add_topics(manager, TOPICS)
+    manager.remove_document("pumps.txt")
+    manager.remove_document("valves.txt")
+
+    # 删除只记墓碑：块仍占着原来的位置，但不再出现在检索结果中
+    assert len(manager.documents) == len(TOPICS)
+    assert len(manager._deleted_positions) == 2
+    assert not manager.is_empty()
+    for mode in ("vector", "lexical", "hybrid"):
+        texts = [result["text"] for result in manager.search("pumps valves", top_k=8, mode=mode)]
+        assert not any("pumps" in text or "valves" in text for text in texts)
+
+    generation = current_generation(manager.index_dir)
+    manager.compact()
+    manager._flush_writes()
+    assert len(manager.documents) == len(TOPICS) - 2
+    assert not manager._deleted_positions
+    assert sorted(document["name"] for document in manager.list_documents()) == sorted(
+        f"{topic}.txt" for topic in TOPICS[2:])
+    for name, entry in manager.document_registry.items():
+        assert all(manager.document_metadata[position]["name"] == name for position in entry["positions"])
+    # 压缩后整体重写为新的一代，日志从空开始
+    assert current_generation(manager.index_dir) != generation
+    assert not os.path.exists(os.path.join(_generation_dir(manager), "journal.jsonl"))
+    results = _texts(manager, "boilers fault")
+    manager.close()
+
+    reloaded = make_manager()
+    reloaded.load_persisted()
+    assert len(reloaded.documents) == len(TOPICS) - 2
+    assert _texts(reloaded, "boilers fault") == results
+
+
+def test_torn_journal_line_is_ignored_and_truncated(make_manager):
+    manager = make_manager()
+    _add_topics(manager, TOPICS[:3])
+    manager.persist()
+    _add_topics(manager, TOPICS[3:4])
+    manager.close()
+    journal = os.path.join(_generation_dir(manager), "journal.jsonl")
+    with open(journal, "a", encoding="utf-8") as f:
+        f.write('{"op": "remove", "na')  # 写到一半时进程退出
+
+    reloaded = make_manager()
+    reloaded.load_persisted()
+    assert len(reloaded.list_documents()) == 4
+    reloaded.remove_document("pumps.txt")
+    reloaded.close()
+    # 新记录从新的一行开始，没有接在写了一半的那一行后面
+    with open(journal, encoding="utf-8") as f:
+        records = [json.loads(line) for line in f]
+    assert records[-1]["op"] == "remove" and records[-1]["name"] == "pumps.txt"
+
+    again = make_manager()
+    again.load_persisted()
+    assert [document["name"] for document in again.list_documents()] == ["boilers.txt", "turbines.txt",
+                                                                        "valves.txt"]
+
+
+def test_second_writer_on_same_directory_is_read_only(make_manager):
+    manager = make_manager()
+    _add_topics(manager, TOPICS[:2])
+    other = make_manager()
+    other.load_persisted()
+    assert other._writer.read_only
+    _add_topics(other, TOPICS[2:3])
+    manager.close()
+    other.close()
+
+    reloaded = make_manager()
+    reloaded.load_persisted()
+    assert len(reloaded.list_documents()) == 2
+
+
+def test_trained_ivf_is_loaded_without_retraining(make_manager, monkeypatch):
+    monkeypatch.setattr(rag, "create_vector_index", lambda dim: IVFIndex(dim, min_train_size=4))
+    manager = make_manager()
+    _add_topics(manager, TOPICS)
+    manager.persist()
+    assert manager.vector_index.is_trained
+    results = _texts(manager, "heaters fault")
+    manager.close()
+
+    def train(self, *args, **kwargs):
+        raise AssertionError("persisted IVF centroids should be reused")
+
+    monkeypatch.setattr(IVFIndex, "train", train)
+    reloaded = make_manager()
+    reloaded.load_persisted()
+    assert reloaded.vector_index.is_trained
+    np.testing.assert_array_equal(reloaded.vector_index.centroids, manager.vector_index.centroids)
+    assert _texts(reloaded, "heaters fault") == results
+
+
+def test_ivf_training_runs_outside_the_index_lock(make_manager, monkeypatch):
+    monkeypatch.setattr(rag, "create_vector_index", lambda dim: IVFIndex(dim, min_train_size=4))
+    manager = make_manager()
+    kmeans = rag._kmeans
+    searched = []
+
+    def kmeans_while_searching(*args, **kwargs):
+        # 训练期间另一个会话检索：锁被训练占用时会一直等到训练结束
+        thread = threading.Thread(target=lambda: searched.append(_texts(manager, "heaters fault")))
+        thread.start()
+        thread.join(timeout=5)
+        assert not thread.is_alive()
+        return kmeans(*args, **kwargs)
+
+    monkeypatch.setattr(rag, "_kmeans", kmeans_while_searching)
+    _add_topics(manager, TOPICS)
+    assert searched
+    assert manager.vector_index.is_trained
+    assert not manager.vector_index.needs_training
+    # 训练后追加的向量分配到了新的簇
+    assert sum(len(members) for members in manager.vector_index._lists) == len(TOPICS)
+    assert _texts(manager, "heaters fault")[0].startswith("Service notes on heaters")
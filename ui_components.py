@@ -1,9 +1,12 @@
 import streamlit as st
-from config import PERSONAS, TEMPLATES
-from database import create_conversation, get_conversations, update_conversation_title, delete_conversation, connect_db
-from chat import switch_conversation, get_system_prompt
-from file_processor import process_document_for_rag, process_general_file, process_image_file
-import time
+from config import PERSONAS, TEMPLATES, CONVERSATION_PAGE_SIZE, RAG_INGEST_POLL_SECONDS
+from database import (create_conversation, get_conversations, update_conversation_title, delete_conversation,
+                      clear_conversation_messages, get_db_pool)
+from chat import (switch_conversation, get_system_prompt, has_earlier_messages, load_earlier_messages,
+                  reset_message_paging)
+from file_processor import process_general_file, process_image_file, load_document
+from extractors import supported_extensions
+from ingest_jobs import get_ingestion_queue, COMPLETED, CANCELLED
 
 def render_sidebar():
     """渲染侧边栏"""
@@ -88,15 +91,30 @@ def render_conversations_tab():
                     st.session_state.current_conversation_id = new_id_val
                     st.session_state.messages = []
                     st.session_state.messages_history = [{"role": "system", "content": get_system_prompt()}]
+                    reset_message_paging()
                     st.rerun()
                 else:
                     st.error("Failed to create conversation. Check console logs for details.")
 
-    # 会话列表
-    conversations_list_ui = get_conversations()
+    # 会话列表：按标题搜索，每次只载入一页，需要时再载入更多（键集分页，每页结果有短时缓存）
+    search_text = st.text_input("Search", placeholder="Search titles", key="conversation_search").strip()
+    if st.session_state.get("conversation_list_search") != search_text:
+        st.session_state.conversation_list_search = search_text
+        st.session_state.conversation_list_pages = 1
+
+    conversations_list_ui = []
+    has_more_conversations = False
+    after = None
+    for _ in range(st.session_state.get("conversation_list_pages", 1)):
+        page = get_conversations(limit=CONVERSATION_PAGE_SIZE, after=after, search=search_text or None)
+        conversations_list_ui.extend(page)
+        has_more_conversations = len(page) == CONVERSATION_PAGE_SIZE
+        if not has_more_conversations:
+            break
+        after = (page[-1][3], page[-1][0])
 
     if not conversations_list_ui:
-        st.info("No conversations yet.")
+        st.info("No matching conversations." if search_text else "No conversations yet.")
     else:
         for conv_item in conversations_list_ui:
             conv_id, title_val, created_at, updated_at = conv_item
@@ -126,7 +144,7 @@ def render_conversations_tab():
                 if delete_conversation(conv_id):
                     # 如果删除了当前会话，则切换到另一个
                     if conv_id == st.session_state.current_conversation_id:
-                        remaining_convs = [c for c in conversations_list_ui if c[0] != conv_id]
+                        remaining_convs = get_conversations(limit=1)
                         if remaining_convs:
                             # 获取新的会话ID
                             new_conv_id = remaining_convs[0][0]
@@ -162,6 +180,10 @@ def render_conversations_tab():
                         del st.session_state.editing_title
                         st.rerun()
 
+    if has_more_conversations and st.button("Load more conversations", use_container_width=True):
+        st.session_state.conversation_list_pages = st.session_state.get("conversation_list_pages", 1) + 1
+        st.rerun()
+
 
 def render_templates_tab():
     """渲染模板选项卡"""
@@ -200,11 +222,12 @@ def render_templates_tab():
         # 应用模板按钮
         if st.form_submit_button("Apply Template", use_container_width=True):
             # 添加到聊天
-            st.session_state.messages.append({"role": "user", "content": generated_prompt})
-            st.session_state.messages_history.append({"role": "user", "content": generated_prompt})
+            template_message = {"role": "user", "content": generated_prompt}
+            st.session_state.messages.append(template_message)
+            st.session_state.messages_history.append(template_message)
 
             # 保存到数据库
-            save_chat("user", generated_prompt, st.session_state.current_conversation_id)
+            save_chat(template_message, st.session_state.current_conversation_id)
 
             # 设置标志以在重新运行后触发 get_answer()
             st.session_state.get_template_answer = True
@@ -246,15 +269,14 @@ def render_persona_tab():
             st.session_state.messages_history.insert(0, {"role": "system", "content": get_system_prompt()})
 
         # 添加系统通知
-        notification_message = f"I've switched to {selected_persona_key} mode. How can I help you?"
-        st.session_state.messages.append({
+        notification_message = {
             "role": "assistant",
-            "content": notification_message
-        })
+            "content": f"I've switched to {selected_persona_key} mode. How can I help you?"
+        }
+        st.session_state.messages.append(notification_message)
 
         # 将通知消息保存到数据库
-        save_chat("assistant", notification_message,
-                  st.session_state.current_conversation_id)
+        save_chat(notification_message, st.session_state.current_conversation_id)
 
         st.rerun()
 
@@ -277,27 +299,10 @@ def render_settings_tab():
     # 清除按钮
     if st.button("🧹 Clear Chat", use_container_width=True):
         # 清除当前会话消息
-        db_conn_clear = connect_db()
-        cursor_clear = None
         try:
-            cursor_clear = db_conn_clear.cursor()
-            cursor_clear.execute(
-                "DELETE FROM chat_history WHERE conversation_id = %s",
-                (st.session_state.current_conversation_id,)
-            )
-            db_conn_clear.commit()
+            clear_conversation_messages(st.session_state.current_conversation_id)
         except Exception as e:
             st.error(f"Clear failed: {e}")
-        finally:
-            if cursor_clear:
-                cursor_clear.close()
-            if db_conn_clear:
-                if db_conn_clear and not getattr(db_conn_clear, 'closed', True):
-                    # 如果使用连接池
-                    if hasattr(st.session_state, 'db_connection_pool'):
-                        st.session_state.db_connection_pool.putconn(db_conn_clear)
-                    else:
-                        db_conn_clear.close()
 
         # 重置会话状态
         st.session_state.messages = [{
@@ -305,6 +310,62 @@ def render_settings_tab():
             "content": "Enter your message in the input box to chat with AI!"
         }]
         st.session_state.messages_history = [{"role": "system", "content": get_system_prompt()}]
+        # 已清空的消息不能再通过“载入更早的消息”读回来
+        reset_message_paging()
+        st.rerun()
+
+    # 数据库连接池指标（进程内所有会话共享）
+    with st.expander("Database connection pool"):
+        try:
+            metrics = get_db_pool().metrics()
+        except Exception as e:
+            st.caption(f"Connection pool unavailable: {e}")
+        else:
+            st.caption(f"{metrics['in_use']} in use / {metrics['open_connections']} open "
+                       f"(max {metrics['max_connections']}, peak {metrics['peak_in_use']})")
+            st.caption(f"{metrics['checkouts']} checkouts, {metrics['waits']} waited, {metrics['timeouts']} timed out, "
+                       f"{metrics['replaced']} broken connections replaced")
+            st.caption(f"Checkout latency: avg {metrics['avg_checkout_ms']:.1f} ms, "
+                       f"max {metrics['max_checkout_ms']:.1f} ms")
+
+
+def _render_ingest_jobs():
+    """入库任务的进度和取消按钮（作为片段每隔 RAG_INGEST_POLL_SECONDS 秒单独重新运行）
+
+    有任务结束时把结果记下来并重新运行整个页面，让知识库的状态、文档列表和开关随之更新。
+    """
+    ingestion_queue = get_ingestion_queue()
+    finished_notices = []
+    for job_id in list(st.session_state.rag_ingest_jobs):
+        job = ingestion_queue.get(job_id)
+        if job is None:
+            st.session_state.rag_ingest_jobs.remove(job_id)
+            continue
+        if job.finished:
+            finished_notices.extend(job.messages)
+            if job.status == COMPLETED:
+                finished_notices.append(("success", f"Processed {job.name} and added to the knowledge base."))
+            elif job.status == CANCELLED:
+                finished_notices.append(("warning", f"Cancelled processing {job.name}."))
+            else:
+                finished_notices.append(("error", f"Could not add {job.name} to the knowledge base: {job.error}"))
+            st.session_state.rag_ingest_jobs.remove(job_id)
+            ingestion_queue.forget(job_id)
+            continue
+
+        status_col, cancel_col = st.columns([4, 1])
+        if job.cancel_requested:
+            status_col.caption(f"Cancelling {job.name}...")
+        elif job.pages_extracted == 0:
+            status_col.caption(f"⏳ {job.name}: {'resuming' if job.resumed else 'queued'}")
+        else:
+            status_col.caption(f"⏳ {job.name}: {job.pages_extracted} sections extracted, "
+                               f"{job.chunks_processed} chunks processed, {job.chunks_indexed} embedded")
+        if cancel_col.button("✖", key=f"cancel_rag_job_{job_id}", help=f"Cancel processing {job.name}"):
+            ingestion_queue.cancel(job_id)
+
+    if finished_notices:
+        st.session_state.rag_ingest_notices = finished_notices
         st.rerun()
 
 
@@ -319,33 +380,42 @@ def render_rag_tab():
     st.markdown("### Upload Documents")
     # 为 file_uploader 提供一个唯一的 key
     uploaded_file_for_rag = st.file_uploader(
-        "Upload PDF, DOCX, PPTX or TXT files for Knowledge Base",
-        type=["pdf", "docx", "pptx", "txt"],
+        "Upload PDF, DOCX, PPTX, XLSX or TXT files for Knowledge Base",
+        type=supported_extensions(),
         key="rag_file_uploader_sidebar"
     )
 
-    # 处理上传文件
+    ingestion_queue = get_ingestion_queue()
+    if "rag_ingest_jobs" not in st.session_state:
+        st.session_state.rag_ingest_jobs = []
+
+    # 处理上传文件：提交到后台入库队列，页面不等待提取和嵌入完成
     if uploaded_file_for_rag:
-        # 简单地用 session state 记录上一个处理的文件名，避免因 streamlit 保持 uploader 状态而重复处理
+        # 简单地用 session state 记录上一个处理的文件（名称和大小），避免因 streamlit 保持 uploader 状态而重复处理；
+        # 同名文件的新版本大小不同，会被重新处理并替换旧版本
+        uploaded_file_key = (uploaded_file_for_rag.name, uploaded_file_for_rag.size)
         if "last_uploaded_rag_filename" not in st.session_state or \
-                st.session_state.last_uploaded_rag_filename != uploaded_file_for_rag.name:
-
-            with st.spinner(f"Processing {uploaded_file_for_rag.name} for Knowledge Base..."):
-                # 记录当前文件名，以便下次比较
-                st.session_state.last_uploaded_rag_filename = uploaded_file_for_rag.name
-
-                initial_rag_empty_status = st.session_state.rag_manager.is_empty()  # 处理前状态
-                processing_result = process_document_for_rag(uploaded_file_for_rag)
-                st.success(processing_result)
-
-                # 检查处理后RAG状态是否真的改变了（从空变为非空）
-                current_rag_empty_status = st.session_state.rag_manager.is_empty()  # 处理后状态
-                if initial_rag_empty_status and not current_rag_empty_status:
-                    needs_rerun_after_rag_processing = True  # 设置标志
+                st.session_state.last_uploaded_rag_filename != uploaded_file_key:
+            # 记录当前文件，以便下次比较
+            st.session_state.last_uploaded_rag_filename = uploaded_file_key
+            # 与直接分析共用同一份解析结果：同一文件已被分析过时不再重新解析
+            uploaded_data = uploaded_file_for_rag.getvalue()
+            job = ingestion_queue.submit(st.session_state.rag_manager, uploaded_file_for_rag.name, uploaded_data,
+                                         document=load_document(uploaded_file_for_rag.name, uploaded_data))
+            st.session_state.rag_ingest_jobs.append(job.job_id)
+
+    # 上次刷新进度时结束的任务，结果显示一次
+    for level, message in st.session_state.pop("rag_ingest_notices", []):
+        getattr(st, level)(message)
+
+    # 入库任务进度：只有这一部分定时重新运行，页面其余部分不随进度刷新
+    has_active_jobs = any(job is not None and not job.finished
+                          for job in map(ingestion_queue.get, st.session_state.rag_ingest_jobs))
+    st.fragment(_render_ingest_jobs, run_every=RAG_INGEST_POLL_SECONDS if has_active_jobs else None)()
 
     # RAG状态显示和控制
     is_rag_empty_now = st.session_state.rag_manager.is_empty()
-    is_rag_enabled_now = st.session_state.rag_manager.enabled
+    is_rag_enabled_now = st.session_state.get("rag_enabled", False)
 
     if is_rag_empty_now:
         st.info("Knowledge base is empty. Please upload documents first.")
@@ -355,7 +425,7 @@ def render_rag_tab():
         # 为 toggle 提供唯一的 key
         rag_toggle_button_state = st.toggle("Enable RAG", value=is_rag_enabled_now, key="rag_toggle_enabled_sb")
         if rag_toggle_button_state != is_rag_enabled_now:
-            st.session_state.rag_manager.toggle_rag(rag_toggle_button_state)
+            st.session_state.rag_enabled = rag_toggle_button_state
             status_message = "enabled" if rag_toggle_button_state else "disabled"
             st.success(f"RAG has been {status_message}.")
             needs_rerun_after_rag_processing = True  # 切换后也需要rerun
@@ -363,14 +433,53 @@ def render_rag_tab():
     # 清空知识库按钮
     if not is_rag_empty_now:
         # 为 button 提供唯一的 key
-        if st.button("Clear Knowledge Base", use_container_width=True, key="clear_rag_button_sb"):
-            st.session_state.rag_manager.clear()
-            st.session_state.rag_manager.toggle_rag(False)
-            # 清空后，重置 last_uploaded_rag_filename，允许重新上传同名文件
-            if "last_uploaded_rag_filename" in st.session_state:
-                del st.session_state.last_uploaded_rag_filename
-            st.success("Knowledge base has been cleared.")
-            needs_rerun_after_rag_processing = True  # 清空后也需要rerun
+        # 入库任务进行中时不能清空（任务记录的块位置会失效）；其他会话的任务由 clear() 自己检查
+        if st.button("Clear Knowledge Base", use_container_width=True, key="clear_rag_button_sb",
+                     disabled=has_active_jobs):
+            if st.session_state.rag_manager.clear():
+                st.session_state.rag_enabled = False
+                # 清空后，重置 last_uploaded_rag_filename，允许重新上传同名文件
+                if "last_uploaded_rag_filename" in st.session_state:
+                    del st.session_state.last_uploaded_rag_filename
+                st.success("Knowledge base has been cleared.")
+                needs_rerun_after_rag_processing = True  # 清空后也需要rerun
+            else:
+                st.warning("Documents are still being added to the knowledge base (possibly from another "
+                           "session). Try again when they finish.")
+
+    # 知识库中的文档，可以单独删除
+    if not is_rag_empty_now:
+        with st.expander("Documents in Knowledge Base"):
+            for document in st.session_state.rag_manager.list_documents():
+                doc_col, remove_col = st.columns([4, 1])
+                doc_col.caption(f"{document['name']} ({document['chunks']} chunks)")
+                if remove_col.button("🗑️", key=f"remove_rag_document_{document['name']}",
+                                     help=f"Remove {document['name']}"):
+                    removed_count = st.session_state.rag_manager.remove_document(document['name'])
+                    # 允许之后重新上传同一个文件
+                    if "last_uploaded_rag_filename" in st.session_state:
+                        del st.session_state.last_uploaded_rag_filename
+                    if st.session_state.rag_manager.is_empty():
+                        st.session_state.rag_enabled = False
+                    st.success(f"Removed {document['name']} ({removed_count} chunks).")
+                    needs_rerun_after_rag_processing = True
+
+    # 向量索引内存占用
+    vector_index = st.session_state.rag_manager.vector_index
+    if vector_index is not None:
+        st.caption(f"Index: {len(vector_index)} chunks, {vector_index.nbytes / 1024 / 1024:.1f} MB")
+
+    # 入库去重统计
+    if st.session_state.rag_manager.skipped_duplicates:
+        st.caption(f"Near-duplicates skipped: {st.session_state.rag_manager.skipped_duplicates} chunks "
+                   f"({st.session_state.rag_manager.saved_embedding_requests} embedding requests saved)")
+
+    # 嵌入缓存命中统计（每次命中都省去一次嵌入API调用）
+    embedding_cache = st.session_state.rag_manager.embedding_cache
+    if embedding_cache is not None:
+        cache_stats = embedding_cache.stats()
+        st.caption(f"Embedding cache: {cache_stats['hits']} hits / {cache_stats['misses']} misses "
+                   f"({cache_stats['entries']} vectors, {cache_stats['bytes'] / 1024 / 1024:.1f} MB)")
 
     # 在所有RAG选项卡UI元素渲染完毕后，检查是否需要rerun
     if needs_rerun_after_rag_processing:
@@ -384,6 +493,12 @@ def render_main_content():
 
     st.title("🤖 C-bot")
 
+    # 会话较长时只显示最新的一页，更早的消息按需载入
+    if has_earlier_messages():
+        if st.button("⬆️ Load earlier messages", use_container_width=True):
+            load_earlier_messages()
+            st.rerun()
+
     # 显示对话的历史列表
     for message_item in st.session_state.messages:
         # 聊天窗口
@@ -399,9 +514,11 @@ def render_main_content():
         with st.chat_message("user"):
             st.write(user_input_text)
         # 把用户的消息添加到会话历史中
-        st.session_state.messages.append({"role": "user", "content": user_input_text})
-        st.session_state.messages_history.append({"role": "user", "content": user_input_text})
-        save_chat('user', user_input_text)
+        # 显示列表、API 历史和消息缓存共用同一个字典
+        user_message = {"role": "user", "content": user_input_text}
+        st.session_state.messages.append(user_message)
+        st.session_state.messages_history.append(user_message)
+        save_chat(user_message)
         get_answer()
 
     # 检查是否需要为模板获取答案
@@ -423,25 +540,15 @@ def render_main_content():
         # 添加音频文件处理的UI反馈
         if file_extension in ["mp3", "wav", "m4a", "ogg"]:
             with st.status("处理音频文件...", expanded=True) as status:
-                st.write("⏳ 上传音频文件...")
-                st.write("🔊 准备音频数据...")
-                # 创建处理进度条
-                progress_bar = st.progress(0)
-                for i in range(1, 101):
-                    # 增加延迟以更好地展示进度
-                    if i == 25:
-                        st.write("🎯 正在转录音频内容...")
-                    elif i == 50:
-                        st.write("📝 分析音频内容...")
-                    elif i == 75:
-                        st.write("🧠 生成理解结果...")
-                    # 更新进度条
-                    progress_bar.progress(i)
-                    if i < 100:  # 不要让最后一步太快
-                        time.sleep(0.02)
+                st.write("🎯 正在转录音频内容...")
+                # 按实际转录完成的片段数更新进度条
+                progress_bar = st.progress(0.0)
+
+                def report_progress(done, total):
+                    progress_bar.progress(done / total, text=f"已转录 {done}/{total} 个片段")
 
                 # 处理文件
-                extracted_text_general = process_general_file(general_uploaded_file)
+                extracted_text_general = process_general_file(general_uploaded_file, progress=report_progress)
                 st.write("✅ 音频处理完成!")
                 status.update(label="音频处理完成!", state="complete")
         else:
@@ -454,11 +561,12 @@ def render_main_content():
             st.session_state.uploaded_file_name = general_uploaded_file.name  # 记录文件名
 
             # 将内容添加到聊天记录
-            st.session_state.messages.append({"role": "user", "content": extracted_text_general})
-            st.session_state.messages_history.append({"role": "user", "content": extracted_text_general})
+            file_message = {"role": "user", "content": extracted_text_general}
+            st.session_state.messages.append(file_message)
+            st.session_state.messages_history.append(file_message)
 
             # 保存到数据库
-            save_chat('user', extracted_text_general, st.session_state.current_conversation_id)
+            save_chat(file_message, st.session_state.current_conversation_id)
 
             # 获取AI答案
             get_answer()
\ No newline at end of file